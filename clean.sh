@@ -2,3 +2,4 @@
 
 rm log/*
 rm -rf database/*
+rm -rf metrics/*
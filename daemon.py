@@ -7,15 +7,18 @@ import os
 from os.path import abspath, join, dirname
 import signal
 import sys
-import thrift
+import threading
 import time
-import uuid
 import requests
 
 import sinaspider.config
+from sinaspider.connection_pool import SchedulerConnectionPool
 from sinaspider.downloader import Downloader, DownloaderType
 import sinaspider.log
+import sinaspider.metrics
 import sinaspider.pipeline
+import sinaspider.replay
+import sinaspider.ring_buffer
 import sinaspider.scheduler
 import sinaspider.utils
 import sinaspider.services
@@ -23,12 +26,7 @@ import sinaspider.sina_pipeline
 
 class CookieUploader(object):
     def start(self):
-        addr = sinaspider.config.SCHEDULER_CONFIG['addr']
-        port = sinaspider.config.SCHEDULER_CONFIG['port']
-        transport = thrift.transport.TSocket.TSocket(addr, port)
-        transport = thrift.transport.TTransport.TBufferedTransport(transport)
-        protocol = thrift.protocol.TBinaryProtocol.TBinaryProtocol(transport)
-        client = sinaspider.services.scheduler_service.Client(protocol)
+        pool = SchedulerConnectionPool.instance()
         # Read cookie file
         fcookie = 'cookies.json'
         cookie_dict = None
@@ -38,9 +36,8 @@ class CookieUploader(object):
         for user, cookie in cookie_dict.items():
             cookie = sinaspider.services.ttypes.Cookie(user, cookie)
             cookies.append(cookie)
-        transport.open()
-        client.submit_cookies(cookies)
-        transport.close()
+        pool.call('submit_cookies', cookies)
+        pool.close()
 
 class StoreCookie(object):
     def start(self):
@@ -70,98 +67,39 @@ class StoreCookie(object):
         print('Complete.')
 
 
-class HotWeiboLinkSeederDaemon(sinaspider.utils.Daemon):
+class MetricsServerDaemon(sinaspider.utils.Daemon):
+    """
+    Serve the metrics of all of the crawler processes at /metrics.
+    """
     def __init__(self, pid_file):
         sinaspider.utils.Daemon.__init__(
             self, pid_file, self.__class__.__name__)
-        self.links = []
-        self.links.append(sinaspider.sina_pipeline._TRENDING_TWEETS_LINK + '&uuid=%s')
-        for i in range(1, 21):
-            link = sinaspider.sina_pipeline._HOT_WEIBO_RANK_HOURLY % (i-1, i)
-            self.links.append(link + '&uuid=%s')
-            link = sinaspider.sina_pipeline._HOT_WEIBO_RANK_DAYLY % (i-1, i)
-            self.links.append(link + '&uuid=%s')
-        self.running = True 
-        self.interval = sinaspider.config.SCHEDULER_CONFIG['hot_weibo_link_seeder_interval']
-    def run(self):
-        signal.signal(signal.SIGINT, self.exit_gracefully)
-        signal.signal(signal.SIGTERM, self.exit_gracefully)
-        sinaspider.log.configure_logger('.weibo_seeder.log')
-        logger = logging.getLogger(self.name)
-        addr = sinaspider.config.SCHEDULER_CONFIG['addr']
-        port = sinaspider.config.SCHEDULER_CONFIG['port']
-        transport = thrift.transport.TSocket.TSocket(addr, port)
-        transport = thrift.transport.TTransport.TBufferedTransport(transport)
-        protocol = thrift.protocol.TBinaryProtocol.TBinaryProtocol(transport)
-        client = sinaspider.services.scheduler_service.Client(protocol)
-        self.running = True
-        while self.running:
-            try:
-                if not transport.isOpen():
-                    transport.open()
-                patch = uuid.uuid4().hex
-                links = [link % patch for link in self.links]
-                client.submit_links(links)
-                transport.close()
-                logger.info('Submit links: %s' % self.links)
-                passed = 0
-                while self.running and passed < self.interval:
-                    time.sleep(1)
-                    passed += 1
-            except Exception:
-                pass
-        if not transport.isOpen():
-            transport.close()
- 
-    def exit_gracefully(self, sig, func):
-        self.running = False
- 
-class TopicLinkSeederDeamon(sinaspider.utils.Daemon):
-    def __init__(self, pid_file):
-        sinaspider.utils.Daemon.__init__(
-            self, pid_file, self.__class__.__name__)
-        self.links = []
-        for idx in range(1, sinaspider.config.DOWNLOADER_CONFIG['num_topic_pages']+1):
-            link = sinaspider.sina_pipeline._TOPIC_PAGE_LINK % idx
-            self.links.append(link)
-        self.running = True 
-        self.interval = sinaspider.config.SCHEDULER_CONFIG['topic_link_seeder_interval']
+        self.server = None
+
     def run(self):
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
-        sinaspider.log.configure_logger('.topic_seeder.log')
+        sinaspider.log.configure_logger('.metrics.log')
         logger = logging.getLogger(self.name)
-        addr = sinaspider.config.SCHEDULER_CONFIG['addr']
-        port = sinaspider.config.SCHEDULER_CONFIG['port']
-        transport = thrift.transport.TSocket.TSocket(addr, port)
-        transport = thrift.transport.TTransport.TBufferedTransport(transport)
-        protocol = thrift.protocol.TBinaryProtocol.TBinaryProtocol(transport)
-        client = sinaspider.services.scheduler_service.Client(protocol)
-        self.running = True
-        while self.running:
-            try:
-                if not transport.isOpen():
-                    transport.open()
-                client.submit_topic_links(self.links)
-                transport.close()
-                logger.info('Submit links: %s' % self.links)
-                passed = 0
-                while self.running and passed < self.interval:
-                    time.sleep(1)
-                    passed += 1
-            except Exception:
-                pass
-        if not transport.isOpen():
-            transport.close()
- 
+        self.server = sinaspider.metrics.MetricsServer(
+            sinaspider.config.METRICS_CONFIG['addr'],
+            sinaspider.config.METRICS_CONFIG['port'])
+        logger.info('Serving metrics at %s:%s' % self.server.server_address[:2])
+        self.server.serve_forever()
+        self.server.server_close()
+        logger.info('Metrics server stopped')
+
     def exit_gracefully(self, sig, func):
-        self.running = False
- 
+        # shutdown() waits for serve_forever(), which runs in this thread.
+        threading.Thread(target=self.server.shutdown).start()
+
 class SinaSpiderDaemon(sinaspider.utils.Daemon):
     def __init__(self, pid_file):
         sinaspider.utils.Daemon.__init__(
             self, pid_file, self.__class__.__name__)
         self.manager = None
+        self.page_queue = None
+        self.recorder = None
         self.downloaders = list()
         self.engine_server = None
 
@@ -172,28 +110,43 @@ class SinaSpiderDaemon(sinaspider.utils.Daemon):
         self.manager = multiprocessing.Manager()
         sinaspider.log.configure_logger('.downloader.log')
         logger = logging.getLogger(self.name)
+        sinaspider.metrics.start(self.name)
         logger.info('Init pipeline engine')
-        queue = self.manager.Queue(-1)
-        pipeline = sinaspider.sina_pipeline.SinaPipeline(queue)
+        self.page_queue = sinaspider.pipeline.create_page_queue(self.manager)
+        pipeline = sinaspider.sina_pipeline.SinaPipeline(self.page_queue)
+        if sinaspider.config.DOWNLOADER_CONFIG['record_dir']:
+            self.recorder = sinaspider.replay.CorpusWriter(
+                sinaspider.config.DOWNLOADER_CONFIG['record_dir'])
+            pipeline.register_recorder(self.recorder)
         engine = sinaspider.pipeline.PipelineEngine(pipeline, self.manager)
         self.engine_server = multiprocessing.Process(name=engine.name,
                                                      target=engine.run)
         self.engine_server.start()
 
-        for idx in range(
-                sinaspider.config.DOWNLOADER_CONFIG['num_downloaders']):
-            name = sinaspider.config.DOWNLOADER_CONFIG['name_prefix'] + '-' + str(
-                idx)
+        if sinaspider.config.DOWNLOADER_CONFIG['engine'] == 'asyncio':
+            # Imported here since aiohttp is only required by this engine.
+            from sinaspider.async_downloader import AsyncDownloader
+            name = 'async-' + sinaspider.config.DOWNLOADER_CONFIG['name_prefix']
             logger.debug('Creating %s' % name)
-            downloader = Downloader(name, pipeline, DownloaderType.LINK_DOWNLOADER)
-            self.downloaders.append(downloader)
-        for idx in range(
-                sinaspider.config.DOWNLOADER_CONFIG['num_topic_downloaders']):
-            name = 'topic-' + sinaspider.config.DOWNLOADER_CONFIG['name_prefix'] + '-' + str(
-                idx)
-            logger.debug('Creating %s' % name)
-            downloader = Downloader(name, pipeline, DownloaderType.TOPIC_DOWNLOADER)
+            downloader = AsyncDownloader(name, pipeline,
+                                         [DownloaderType.LINK_DOWNLOADER,
+                                          DownloaderType.TOPIC_DOWNLOADER])
             self.downloaders.append(downloader)
+        else:
+            for idx in range(
+                    sinaspider.config.DOWNLOADER_CONFIG['num_downloaders']):
+                name = sinaspider.config.DOWNLOADER_CONFIG['name_prefix'] + '-' + str(
+                    idx)
+                logger.debug('Creating %s' % name)
+                downloader = Downloader(name, pipeline, DownloaderType.LINK_DOWNLOADER)
+                self.downloaders.append(downloader)
+            for idx in range(
+                    sinaspider.config.DOWNLOADER_CONFIG['num_topic_downloaders']):
+                name = 'topic-' + sinaspider.config.DOWNLOADER_CONFIG['name_prefix'] + '-' + str(
+                    idx)
+                logger.debug('Creating %s' % name)
+                downloader = Downloader(name, pipeline, DownloaderType.TOPIC_DOWNLOADER)
+                self.downloaders.append(downloader)
 
         self.timer = sinaspider.utils.RepeatingTimer(
             sinaspider.config.DOWNLOADER_CONFIG['proxy_interval'],
@@ -209,6 +162,12 @@ class SinaSpiderDaemon(sinaspider.utils.Daemon):
             downloader.join()
             logger.debug('%s finished.' % downloader.name)
         self.timer.join()
+        self.engine_server.join()
+        if isinstance(self.page_queue, sinaspider.ring_buffer.PageRingBuffer):
+            self.page_queue.close()
+        if self.recorder:
+            self.recorder.close()
+        sinaspider.metrics.stop()
         logger.info('Daemon stopped')
 
     def exit_gracefully(self, sig, func):
@@ -238,10 +197,8 @@ if __name__ == '__main__':
             daemon = sinaspider.scheduler.SchedulerServerDaemon(pid_file)
         elif target == 'spider':
             daemon = SinaSpiderDaemon(pid_file)
-        elif target == 'weibo_seeder':
-            daemon = HotWeiboLinkSeederDaemon(pid_file)
-        elif target == 'topic_seeder':
-            daemon = TopicLinkSeederDeamon(pid_file)
+        elif target == 'metrics':
+            daemon = MetricsServerDaemon(pid_file)
         elif target == 'loginer':
             daemon = StoreCookie()
         elif target == 'uploader':
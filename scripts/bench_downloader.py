@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Load test the downloaders against a local fake Weibo and report links/s and
+how the injected faults were recovered.
+
+Usage: bench_downloader.py [options]
+
+Links of every url shape in sina_pipeline are downloaded by Downloader
+threads or one AsyncDownloader through the fake proxy. Pages recorded in a
+corpus are served as is, see sinaspider.replay.
+"""
+
+import argparse
+import json
+from os.path import dirname, abspath
+import sys
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sinaspider.config import *
+from sinaspider.downloader import Downloader, DownloaderType
+from sinaspider.sina_pipeline import (_RETWEET_LINKS, _TOPIC_PAGE_LINK,
+                                      _TRENDING_TWEETS_LINK, _USER_TWEETS_LINKS,
+                                      _USER_INFO_LINK, _TWEET_LONGTEXT_LINK)
+from tests.system_tests.fake_weibo import *
+
+def make_links(count):
+    """
+    Return a list of distinct fake links cycling through the url shapes.
+    """
+    shapes = [
+        lambda idx: _TRENDING_TWEETS_LINK + '&uuid=%s' % idx,
+        lambda idx: _USER_TWEETS_LINKS['top_page'] % (100505, idx, 100505,
+                                                      100505, 2018),
+        lambda idx: _RETWEET_LINKS % (idx, 1, idx),
+        lambda idx: _USER_INFO_LINK % (idx, idx),
+        lambda idx: _TWEET_LONGTEXT_LINK % (idx, idx),
+        lambda idx: _TOPIC_PAGE_LINK % idx,
+    ]
+    return [fake_link(shapes[idx % len(shapes)](idx)) for idx in range(count)]
+
+def create_downloaders(args, scheduler, sink):
+    downloaders = list()
+    if args.engine == 'asyncio':
+        from sinaspider.async_downloader import AsyncDownloader
+        downloader = AsyncDownloader('bench-async', sink,
+                                     [DownloaderType.LINK_DOWNLOADER])
+        downloaders.append(downloader)
+    else:
+        for idx in range(args.downloaders):
+            downloader = Downloader('bench-%s' % idx, sink,
+                                    DownloaderType.LINK_DOWNLOADER)
+            downloaders.append(downloader)
+    for downloader in downloaders:
+        downloader.pool = scheduler
+        downloader.update_proxies_callback()
+    return downloaders
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--links', type=int, default=2000)
+    parser.add_argument('--engine', choices=['thread', 'asyncio'],
+                        default='thread')
+    parser.add_argument('--downloaders', type=int, default=8)
+    parser.add_argument('--corpus', default=None)
+    parser.add_argument('--sysbusy', type=float, default=0)
+    parser.add_argument('--passport', type=float, default=0)
+    parser.add_argument('--slow', type=float, default=0)
+    parser.add_argument('--slow-delay', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=0)
+    parser.add_argument('--requests-timeout', type=float, default=2)
+    parser.add_argument('--rate', type=float,
+                        default=DOWNLOADER_CONFIG['rate_limit_rate'])
+    parser.add_argument('--max-rate', type=float,
+                        default=DOWNLOADER_CONFIG['rate_limit_max_rate'])
+    parser.add_argument('--deadline', type=float, default=600)
+    args = parser.parse_args()
+
+    DOWNLOADER_CONFIG['requests_timeout'] = args.requests_timeout
+    DOWNLOADER_CONFIG['requests_total_timeout'] = args.requests_timeout * 2
+    DOWNLOADER_CONFIG['cookie_update_interval'] = 0
+    DOWNLOADER_CONFIG['rate_limit_rate'] = args.rate
+    DOWNLOADER_CONFIG['rate_limit_max_rate'] = max(args.rate, args.max_rate)
+    SCHEDULER_CONFIG['client_failover_interval'] = 0.1
+    server = FakeWeiboServer(corpus=args.corpus, sysbusy=args.sysbusy,
+                             passport=args.passport, slow=args.slow,
+                             timeout=args.timeout, slow_delay=args.slow_delay,
+                             hang=args.requests_timeout * 2)
+    server.start()
+    links = make_links(args.links)
+    scheduler = LocalScheduler(links, [server.proxy])
+    sink = PageSink()
+    downloaders = create_downloaders(args, scheduler, sink)
+    start = time.time()
+    for downloader in downloaders:
+        downloader.start()
+    deadline = start + args.deadline
+    while len(sink.pages) < len(links) and time.time() < deadline:
+        time.sleep(0.05)
+    seconds = time.time() - start
+    for downloader in downloaders:
+        downloader.stop()
+    for downloader in downloaders:
+        downloader.join()
+    server.stop()
+
+    print('%s of %s links in %.3f s, %.1f links/s' %
+          (len(sink.pages), len(links), seconds, len(sink.pages) / seconds))
+    print('resubmitted links: %s' % scheduler.resubmitted)
+    print('server: %s' % json.dumps(server.stats(), sort_keys=True))
+    proxy = 'http://%s:%s' % server.server_address[:2]
+    limiter = downloaders[0].limiter
+    for host in sorted(set(host for host, _ in limiter.buckets)):
+        print('rate of %s: %.1f/s' % (host, limiter.rate(host, proxy)))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Compare the slotted entities of sina_pipeline with the plain __dict__
+entities they replaced: memory per object, construction time and pickling.
+
+Usage: bench_entities.py [number of objects]
+"""
+
+from os.path import dirname, abspath
+import pickle
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sinaspider.sina_pipeline import SinaTweet, SinaFlow
+
+
+class DictTweet(object):
+    """
+    SinaTweet before it was slotted.
+    """
+    def __init__(self):
+        self.tid = 0
+        self.uid = 0
+        self.otid = 0
+        self.ouid = 0
+        self.content = ''
+        self.time = 0
+        self.coordinates = ''
+        self.platform = ''
+        self.num_comments = 0
+        self.num_loves = 0
+        self.num_reposts = 0
+        self.num_topics = 0
+        self.num_atnames = 0
+        self.num_links = 0
+        self.num_videos = 0
+        self.num_images = 0
+
+class DictFlow(object):
+    """
+    SinaFlow before it was slotted.
+    """
+    def __init__(self):
+        self.tag = ''
+        self.a = ''
+        self.b = ''
+
+def memory_per_object(cls, num):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [cls() for _ in range(num)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # Exclude the list holding the objects.
+    return (size - sys.getsizeof(objects)) / num
+
+def bench(cls, num):
+    memory = memory_per_object(cls, num)
+    construct = timeit.timeit(cls, number=num) / num
+    obj = cls()
+    for name, value in (('tid', 4215871378431270), ('uid', 1642634100),
+                        ('content', '转发微博'), ('a', 1642634100)):
+        if hasattr(obj, name):
+            setattr(obj, name, value)
+    size = len(pickle.dumps(obj))
+    dump = timeit.timeit(lambda: pickle.dumps(obj), number=num) / num
+    data = pickle.dumps(obj)
+    load = timeit.timeit(lambda: pickle.loads(data), number=num) / num
+    print('%-10s %8.1f B %8.0f ns %8d B %8.0f ns %8.0f ns' %
+          (cls.__name__, memory, construct * 1e9, size, dump * 1e9, load * 1e9))
+
+if __name__ == '__main__':
+    num = 100000
+    if len(sys.argv) > 1:
+        num = int(sys.argv[1])
+    print('%-10s %10s %11s %10s %11s %11s' %
+          ('class', 'memory', 'construct', 'pickled', 'dumps', 'loads'))
+    for cls in (DictTweet, SinaTweet, DictFlow, SinaFlow):
+        bench(cls, num)
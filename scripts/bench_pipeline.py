@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Replay a recorded corpus through SinaPipeline without Weibo or the scheduler,
+and report throughput, run time of every node and peak memory.
+
+Usage: bench_pipeline.py corpus [inline|engine] [repeat]
+
+- inline: Run the pipeline in this process in micro-batches. Reports run time
+          percentiles of every node.
+- engine: Run a PipelineEngine with its worker processes, as the daemon does.
+
+Records are written to a temporary database which is removed afterwards.
+Record a corpus by setting DOWNLOADER.record_dir in config.json.
+"""
+
+from os.path import dirname, abspath
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sinaspider.config import *
+import sinaspider.pipeline
+import sinaspider.ring_buffer
+from sinaspider.replay import read_corpus, StubSchedulerClient, NodeTimer
+from sinaspider.sina_pipeline import SinaPipeline
+
+def bench_inline(pages, db_dir):
+    pipeline = SinaPipeline(queue.Queue(), db_dir)
+    client = StubSchedulerClient()
+    timer = NodeTimer()
+    pipeline.register_scheduler_client(client)
+    pipeline.register_observer(timer)
+    pipeline.open()
+    size = PIPELINE_CONFIG['batch_size']
+    start = time.time()
+    for idx in range(0, len(pages), size):
+        pipeline.start_batch(pages[idx:idx + size])
+    pipeline.close()
+    seconds = time.time() - start
+    report(len(pages), seconds)
+    print('%-28s %8s %10s %10s %10s %10s' %
+          ('node', 'runs', 'p50 ms', 'p90 ms', 'p99 ms', 'total s'))
+    for node in pipeline.nodes():
+        samples = timer.samples[node.name]
+        points = timer.percentiles(node.name)
+        print('%-28s %8s %10.3f %10.3f %10.3f %10.3f' %
+              ((node.name, len(samples)) +
+               tuple(point * 1000 for point in points) + (sum(samples),)))
+    for dtype, count in client.links.items():
+        print('%s links submitted: %s' % (dtype.name, count))
+
+def bench_engine(pages, db_dir):
+    manager = multiprocessing.Manager()
+    page_queue = sinaspider.pipeline.create_page_queue(manager)
+    pipeline = SinaPipeline(page_queue, db_dir)
+    engine = sinaspider.pipeline.PipelineEngine(pipeline, manager,
+                                                StubSchedulerClient())
+    server = multiprocessing.Process(name=engine.name, target=engine.run)
+    start = time.time()
+    server.start()
+    for page in pages:
+        page_queue.put(page)
+    while page_queue.qsize() > 0:
+        time.sleep(0.01)
+    # Workers finish their current batches before exiting.
+    os.kill(server.pid, signal.SIGTERM)
+    server.join()
+    seconds = time.time() - start
+    if isinstance(page_queue, sinaspider.ring_buffer.PageRingBuffer):
+        page_queue.close()
+    report(len(pages), seconds)
+
+def report(count, seconds):
+    print('%s pages in %.3f s, %.1f pages/s' % (count, seconds,
+                                                count / seconds))
+    # ru_maxrss is in kilobytes on Linux
+    for name, who in (('self', resource.RUSAGE_SELF),
+                      ('children', resource.RUSAGE_CHILDREN)):
+        print('peak RSS of %s: %.1f MB' %
+              (name, resource.getrusage(who).ru_maxrss / 1024))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: %s corpus [inline|engine] [repeat]' % sys.argv[0])
+        sys.exit(2)
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'inline'
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    pages = list(read_corpus(sys.argv[1])) * repeat
+    db_dir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    METRICS_CONFIG['dir'] = os.path.join(db_dir, 'metrics')
+    try:
+        if mode == 'inline':
+            bench_inline(pages, db_dir)
+        elif mode == 'engine':
+            bench_engine(pages, db_dir)
+        else:
+            print('Unknown mode')
+            sys.exit(2)
+    finally:
+        shutil.rmtree(db_dir)
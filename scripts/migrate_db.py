@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Rewrite databases written with pickled keys and values into the record
+format of sinaspider.sina_pipeline.RecordCodec. The old database is kept as
+<name>.pickle.
+
+Usage: migrate_db.py [database directory]
+"""
+
+from os.path import dirname, abspath, join, isdir
+import os
+import pickle
+import plyvel
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sinaspider.sina_pipeline import SinaFlow
+
+_DB_NAMES = ['tweets.db', 'users.db', 'flows.db', 'topics.db']
+_BATCH_SIZE = 10000
+
+def is_pickled(data):
+    return data[:1] == b'\x80'
+
+def migrate_record(db_name, key, value):
+    """
+    Return the migrated (key, value), or None if already migrated.
+    """
+    if not is_pickled(value):
+        return None
+    if db_name == 'flows.db':
+        entry = SinaFlow()
+        entry.a = pickle.loads(key)
+        entry.b = pickle.loads(value)
+    else:
+        entry = pickle.loads(value)
+    return entry.record()
+
+def migrate(db_dir, db_name):
+    path = join(db_dir, db_name)
+    tmp_path = path + '.migrating'
+    db = plyvel.DB(path)
+    new_db = plyvel.DB(tmp_path, create_if_missing=True)
+    migrated = 0
+    kept = 0
+    wb = new_db.write_batch()
+    for key, value in db:
+        record = migrate_record(db_name, key, value)
+        if record is None:
+            record = (key, value)
+            kept += 1
+        else:
+            migrated += 1
+        wb.put(*record)
+        if (migrated + kept) % _BATCH_SIZE == 0:
+            wb.write()
+            wb = new_db.write_batch()
+    wb.write()
+    new_db.close()
+    db.close()
+    os.rename(path, path + '.pickle')
+    os.rename(tmp_path, path)
+    print('%s: %s migrated, %s kept.' % (db_name, migrated, kept))
+
+if __name__ == '__main__':
+    db_dir = join(dirname(dirname(abspath(__file__))), 'database')
+    if len(sys.argv) > 1:
+        db_dir = sys.argv[1]
+    for db_name in _DB_NAMES:
+        if isdir(join(db_dir, db_name)):
+            migrate(db_dir, db_name)
@@ -0,0 +1,341 @@
+"""
+An asyncio downloader. One AsyncDownloader drives hundreds of requests in
+flight from a single thread, instead of one blocking request per Downloader
+thread.
+"""
+
+import aiohttp
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+import urllib.parse
+import uuid
+
+from sinaspider.config import *
+from sinaspider.connection_pool import SchedulerConnectionPool, CONNECTION_ERRORS
+from sinaspider.downloader import DownloaderType, FetchedPage, parse_content_type
+from sinaspider.downloader import (_DOWNLOAD_SECONDS, _RESPONSES, _ERRORS,
+                                   _SYSBUSY, _EXPIRED)
+from sinaspider.proxy import ProxyTracker, is_banned
+from sinaspider.ratelimit import RateLimiter
+
+
+class AsyncDownloader(threading.Thread):
+    """
+    An asyncio downloader. It follows the same contract as Downloader: links
+    are grabbed from the scheduler, downloaded through the proxies granted by
+    the scheduler and fed to the pipeline as FetchedPage.
+
+    The number of requests in flight is capped globally by the number of
+    workers, and per proxy and per host by semaphores. Requests are paced per
+    host and proxy by the RateLimiter shared with other downloaders.
+
+    Blocking calls run in two executors of their own: feeding the pipeline,
+    which blocks while it is congested, and calling the scheduler.
+    """
+
+    def __init__(self, name, pipeline, dtypes):
+        """
+        Input:
+        - name: A string of downloader name.
+        - pipeline: A Pipeline to feed responses.
+        - dtypes: A list of DownloaderType whose links are downloaded.
+        """
+        threading.Thread.__init__(self, name=name)
+        self.pipeline = pipeline
+        self.dtypes = dtypes
+        self.pool = SchedulerConnectionPool.instance()
+        self.limiter = RateLimiter.instance()
+        self.downloading = False
+        self.user_identity = None
+        self.proxies = ProxyTracker.from_config() # Granted proxies
+        self.pending = dict() # Grabbed but not downloaded links -> dtype
+        self.queue = None
+        self.loop = None
+        self.session = None
+        self.feed_executor = None
+        self.rpc_executor = None
+        self.cookie_lock = None
+        self.cookie_updated = 0
+        self.host_slots = collections.defaultdict(lambda: asyncio.Semaphore(
+            DOWNLOADER_CONFIG['async_per_host_concurrency']))
+        self.proxy_slots = collections.defaultdict(lambda: asyncio.Semaphore(
+            DOWNLOADER_CONFIG['async_per_proxy_concurrency']))
+
+    def run(self):
+        logger = logging.getLogger(self.name)
+        logger.info('Starting %s' % self.name)
+        self.downloading = True
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.feed_executor = concurrent.futures.ThreadPoolExecutor(
+            DOWNLOADER_CONFIG['async_feed_threads'], self.name + '-feed')
+        self.rpc_executor = concurrent.futures.ThreadPoolExecutor(
+            DOWNLOADER_CONFIG['async_rpc_threads'], self.name + '-rpc')
+        try:
+            self.loop.run_until_complete(self._main())
+        except Exception:
+            logger.exception('Unkown failure, exiting...')
+        finally:
+            self.loop.close()
+            self.feed_executor.shutdown()
+            self.rpc_executor.shutdown()
+        logger.info('Downloader stopped.')
+
+    def stop(self):
+        self.downloading = False
+
+    async def _call(self, method, *args):
+        """
+        Call the scheduler in the executor of scheduler calls.
+        """
+        return await self.loop.run_in_executor(self.rpc_executor,
+                                               self.pool.call, method, *args)
+
+    async def _main(self):
+        logger = logging.getLogger(self.name)
+        self.queue = asyncio.Queue()
+        self.cookie_lock = asyncio.Lock()
+        interval = SCHEDULER_CONFIG['client_failover_interval']
+        registered = False
+        while self.downloading and not registered:
+            try:
+                await self._call('register_downloader', self.name)
+                registered = True
+                self.user_identity = await self._call('request_user_identity',
+                                                      self.name)
+            except CONNECTION_ERRORS:
+                logger.exception('Exception while initializing, reconecting...')
+                await asyncio.sleep(interval)
+        timeout = aiohttp.ClientTimeout(
+            total=DOWNLOADER_CONFIG['requests_total_timeout'],
+            sock_read=DOWNLOADER_CONFIG['requests_timeout'])
+        connector = aiohttp.TCPConnector(
+            limit=DOWNLOADER_CONFIG['async_concurrency'], ssl=False)
+        async with aiohttp.ClientSession(timeout=timeout,
+                                         connector=connector) as session:
+            self.session = session
+            tasks = [asyncio.ensure_future(self._grabber(dtype))
+                     for dtype in self.dtypes]
+            tasks.extend(asyncio.ensure_future(self._worker())
+                         for _ in range(DOWNLOADER_CONFIG['async_concurrency']))
+            await asyncio.gather(*tasks)
+        if registered:
+            await self._unregister()
+
+    async def _unregister(self):
+        """
+        Return links not downloaded yet to the scheduler and unregister.
+        """
+        logger = logging.getLogger(self.name)
+        try:
+            logger.debug('Unregiser downloader.')
+            await self._call('unregister_downloader', self.name)
+            await self._resubmit(self.pending)
+        except Exception:
+            logger.exception('Failed to return links to scheduler.')
+
+    async def _resubmit(self, pending):
+        """
+        Return links to the scheduler so that they are downloaded again.
+
+        Input:
+        - pending: A dict of link -> DownloaderType.
+        """
+        links = [link for link, dtype in pending.items()
+                 if dtype == DownloaderType.LINK_DOWNLOADER]
+        topic_links = [link for link, dtype in pending.items()
+                       if dtype == DownloaderType.TOPIC_DOWNLOADER]
+        if links:
+            links = [link + '&uuid=%s' % uuid.uuid4().hex for link in links]
+            await self._call('submit_links', links)
+        if topic_links:
+            # Topic links just grabbed are not due yet unless forced.
+            topic_links = [link + '&uuid=%s' % uuid.uuid4().hex
+                           for link in topic_links]
+            await self._call('submit_topic_links', topic_links)
+
+    async def _grabber(self, dtype):
+        """
+        Keep the queue filled with links of the type.
+        """
+        logger = logging.getLogger(self.name)
+        if dtype == DownloaderType.LINK_DOWNLOADER:
+            method = 'grab_links'
+        else:
+            method = 'grab_topic_links'
+        interval = SCHEDULER_CONFIG['client_failover_interval']
+        while self.downloading:
+            if self.queue.qsize() >= DOWNLOADER_CONFIG['async_concurrency']:
+                await asyncio.sleep(0.1)
+                continue
+            if self.pipeline.congested():
+                size = DOWNLOADER_CONFIG['congested_link_batch_size']
+            else:
+                size = DOWNLOADER_CONFIG['link_batch_size']
+            try:
+                links = await self._call(method, size)
+            except CONNECTION_ERRORS:
+                logger.exception('Connection error.')
+                await asyncio.sleep(interval)
+                continue
+            if len(links) == 0:
+                logger.warn('No links available. Waiting...')
+                await self._sleep(interval)
+                continue
+            for link in links:
+                self.pending[link] = dtype
+                self.queue.put_nowait(link)
+
+    async def _sleep(self, seconds):
+        """
+        Sleep while still responding to stop().
+        """
+        deadline = time.time() + seconds
+        while self.downloading and time.time() < deadline:
+            await asyncio.sleep(min(1, deadline - time.time()))
+
+    async def _worker(self):
+        logger = logging.getLogger(self.name)
+        while self.downloading:
+            try:
+                link = await asyncio.wait_for(self.queue.get(), 1)
+            except asyncio.TimeoutError:
+                continue
+            try:
+                page = await self._download(link)
+                if page is None:
+                    continue
+                fed = await self.loop.run_in_executor(self.feed_executor,
+                                                      self.pipeline.feed, page)
+                if not fed:
+                    await self._resubmit({link: self.pending[link]})
+                del self.pending[link]
+            except Exception:
+                logger.exception('Exception in downloading %s' % link)
+                if link not in self.pending:
+                    continue
+                # Return the link, or leave it pending for _unregister() if
+                # the scheduler is unreachable.
+                try:
+                    await self._resubmit({link: self.pending[link]})
+                    del self.pending[link]
+                except CONNECTION_ERRORS:
+                    logger.exception('Failed to return %s to scheduler.' % link)
+
+    async def _download(self, link):
+        """
+        Download the link. Return a FetchedPage, or None if stopped.
+        """
+        logger = logging.getLogger(self.name)
+        host = urllib.parse.urlsplit(link).netloc
+        while self.downloading:
+            address = self.proxies.choose()
+            if address is None:
+                logger.debug('No proxies, waiting...')
+                await asyncio.sleep(0.5)
+                continue
+            proxy = 'http://%s:%s' % (address.addr, address.port)
+            await self._sleep(self.limiter.reserve(host, proxy))
+            if not self.downloading:
+                break
+            try:
+                async with self.proxy_slots[proxy], self.host_slots[host]:
+                    start = time.time()
+                    async with self.session.get(link, proxy=proxy) as res:
+                        body = await res.read()
+                        content_type, charset = parse_content_type(
+                            res.headers.get('content-type', None))
+                        page = FetchedPage(link, str(res.url), res.status,
+                                           content_type, charset, body)
+                    latency = time.time() - start
+                    _DOWNLOAD_SECONDS.observe(latency)
+                _RESPONSES.inc(status=page.status)
+                if is_banned(page.status, page.final_url):
+                    logger.warn('Proxy %s is banned: %s' % (address,
+                                                           page.final_url))
+                    await self._proxy_failed(address)
+                    continue
+                if 'weibo.com/sorry?sysbusy' in page.final_url:
+                    self.limiter.sysbusy(host, proxy)
+                    _SYSBUSY.inc()
+                    continue
+                self.limiter.success(host, proxy)
+                if self._is_login(page):
+                    self.proxies.success(address, latency)
+                    return page
+                _EXPIRED.inc()
+                logger.info('Session expired. Relogin...')
+                await self._update_cookie()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _ERRORS.inc(error=e.__class__.__name__)
+                logger.warn('aiohttp exception: %s' % e)
+                await self._proxy_failed(address)
+        return None
+
+    async def _proxy_failed(self, address):
+        """
+        Record a failure of the proxy. Resign it to the scheduler once it is
+        quarantined.
+        """
+        if not self.proxies.failure(address):
+            return
+        logging.getLogger(self.name).info('Resign proxy %s' % address)
+        try:
+            await self._call('resign_proxy', address, self.name)
+        except CONNECTION_ERRORS:
+            logging.getLogger(self.name).exception('Failed to resign proxy.')
+
+    def _is_login(self, page):
+        url = page.final_url.split('?')[0]
+        if 'passport.weibo.com/visitor/visitor' in url:
+            return False
+        return True
+
+    async def _update_cookie(self):
+        """
+        Replace the session cookie. Concurrent expirations share one update.
+        """
+        logger = logging.getLogger(self.name)
+        requested = time.time()
+        async with self.cookie_lock:
+            if self.cookie_updated > requested:
+                return
+            while self.downloading:
+                await asyncio.sleep(DOWNLOADER_CONFIG['cookie_update_interval'])
+                try:
+                    cookie = await self._call('request_cookie', self.name)
+                except CONNECTION_ERRORS:
+                    logger.exception('Connection error.')
+                    await asyncio.sleep(
+                        SCHEDULER_CONFIG['client_failover_interval'])
+                    continue
+                if cookie.user != 'NULL':
+                    break
+                logger.info('No cookies. Retry later...')
+            else:
+                return
+            logger.info('Get cookie: %s' % cookie)
+            cookie_dict = dict()
+            for entry in cookie.cookie.split(';'):
+                if entry == '':
+                    continue
+                _idx = entry.find('=')
+                cookie_dict[entry[:_idx]] = entry[_idx+1:]
+            self.session.cookie_jar.clear()
+            self.session.cookie_jar.update_cookies(cookie_dict)
+            self.cookie_updated = time.time()
+
+    def update_proxies_callback(self):
+        """
+        Update the proxy list later via the timer.
+        """
+        logger = logging.getLogger(self.name)
+        proxies = self.pool.call('request_proxies', self.name,
+                                 DOWNLOADER_CONFIG['async_proxy_pool_size'])
+        logger.debug('Get proxies: %s' % proxies)
+        self.proxies.update(proxies)
+
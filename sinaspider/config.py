@@ -20,5 +20,6 @@ with open(os.path.join(dir_path(), 'config.json')) as _config_fd:
 
 DOWNLOADER_CONFIG = CONFIG['DOWNLOADER']
 LOGGER_CONFIG = CONFIG['LOGGER']
+METRICS_CONFIG = CONFIG['METRICS']
 PIPELINE_CONFIG = CONFIG['PIPELINE']
 SCHEDULER_CONFIG = CONFIG['SCHEDULER_SERVICE']
@@ -0,0 +1,220 @@
+"""
+A pool of persistent connections to the scheduler service.
+"""
+
+import contextlib
+import logging
+import os
+import socket
+import threading
+import time
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport, TSocket
+
+from sinaspider.config import *
+from sinaspider.services.scheduler_service import Client
+
+# Exceptions which indicate the connection is broken.
+CONNECTION_ERRORS = (TTransport.TTransportException, socket.timeout, OSError)
+
+# Methods which may be sent again if their reply is lost. The grab methods are
+# not: the scheduler hands out a batch of links only once. Neither is
+# resign_proxy: every resignation is a strike against the proxy.
+IDEMPOTENT_METHODS = frozenset([
+    'register_downloader', 'unregister_downloader', 'request_user_identity',
+    'resign_user_identity', 'submit_links', 'submit_topic_links',
+    'request_proxy', 'request_proxies', 'submit_proxies',
+    'request_cookie', 'submit_cookies', 'report_seed'])
+
+
+class SchedulerConnection(object):
+    """
+    A scheduler client along with its transport.
+    """
+
+    def __init__(self, addr, port, timeout):
+        """
+        Input:
+        - addr: A string of scheduler address.
+        - port: An integer of scheduler port.
+        - timeout: An integer of socket timeout in seconds.
+        """
+        self.socket = TSocket.TSocket(addr, port)
+        self.socket.setTimeout(timeout * 1000)
+        self.transport = TTransport.TBufferedTransport(self.socket)
+        protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+        self.client = Client(protocol)
+        self.timeout = timeout
+        self.last_used = 0
+
+    def open(self):
+        self.transport.open()
+        self.socket.handle.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.last_used = time.time()
+
+    def close(self):
+        if self.transport.isOpen():
+            self.transport.close()
+
+    def is_healthy(self, max_idle):
+        """
+        Return True if the connection is open, was used within max_idle
+        seconds and has not been closed by the scheduler.
+        """
+        if not self.transport.isOpen():
+            return False
+        if time.time() - self.last_used > max_idle:
+            return False
+        handle = self.socket.handle
+        try:
+            handle.setblocking(False)
+            # A readable idle socket means the peer closed it.
+            return handle.recv(1, socket.MSG_PEEK) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            if handle.fileno() != -1:
+                handle.settimeout(self.timeout)
+
+
+class SchedulerConnectionPool(object):
+    """
+    A pool of scheduler connections shared by all threads of a process. A
+    thread checks out a connection, owns it exclusively while calling the
+    scheduler and returns it afterwards, so connections are reused instead of
+    being opened and closed around every call.
+
+    Usage:
+
+        pool = SchedulerConnectionPool.instance()
+        links = pool.call('grab_links', 30)
+    """
+    _instance = None
+    _instance_pid = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, addr, port, size, timeout, max_idle, max_retries,
+                 backoff, max_backoff):
+        """
+        Input:
+        - addr: A string of scheduler address.
+        - port: An integer of scheduler port.
+        - size: An integer of maximum number of connections.
+        - timeout: An integer of socket timeout in seconds.
+        - max_idle: An integer of seconds after which an idle connection is
+                    reopened.
+        - max_retries: An integer of how many times a call is tried.
+        - backoff: A float of the first delay in seconds before a retry.
+        - max_backoff: A float of the maximum delay before a retry.
+        """
+        self.addr = addr
+        self.port = port
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle = list() # Idle connections, most recently used at the end
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.name = self.__class__.__name__
+
+    @classmethod
+    def instance(cls):
+        """
+        Return the pool of current process. A forked child gets its own pool.
+        """
+        pid = os.getpid()
+        if cls._instance_pid != pid:
+            with cls._instance_lock:
+                if cls._instance_pid != pid:
+                    cls._instance = cls(
+                        SCHEDULER_CONFIG['addr'], SCHEDULER_CONFIG['port'],
+                        SCHEDULER_CONFIG['client_pool_size'],
+                        SCHEDULER_CONFIG['client_timeout'],
+                        SCHEDULER_CONFIG['client_max_idle'],
+                        SCHEDULER_CONFIG['client_max_retries'],
+                        SCHEDULER_CONFIG['client_backoff'],
+                        SCHEDULER_CONFIG['client_failover_interval'])
+                    cls._instance_pid = pid
+        return cls._instance
+
+    def _checkout(self):
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    conn = SchedulerConnection(self.addr, self.port,
+                                               self.timeout)
+                    conn.open()
+                    return conn
+                if conn.is_healthy(self.max_idle):
+                    return conn
+                conn.close()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _checkin(self, conn):
+        conn.last_used = time.time()
+        with self.lock:
+            self.idle.append(conn)
+        self.slots.release()
+
+    def _discard(self, conn):
+        conn.close()
+        self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a scheduler client for the current thread. A connection
+        which fails while checked out is closed instead of being returned.
+        """
+        conn = self._checkout()
+        try:
+            yield conn.client
+        except BaseException:
+            self._discard(conn)
+            raise
+        self._checkin(conn)
+
+    def call(self, method, *args):
+        """
+        Call the named scheduler method. Reconnect with exponential backoff
+        if the connection is broken, and raise the last connection error if
+        all of retries fail.
+
+        A call which fails after its request is sent is retried only if the
+        method is in IDEMPOTENT_METHODS, as the scheduler may have served it.
+        """
+        logger = logging.getLogger(self.name)
+        delay = self.backoff
+        for attempt in range(1, self.max_retries + 1):
+            sent = False
+            try:
+                with self.connection() as client:
+                    getattr(client, 'send_' + method)(*args)
+                    sent = True
+                    return getattr(client, 'recv_' + method)()
+            except CONNECTION_ERRORS as e:
+                if attempt == self.max_retries or \
+                        (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                logger.warning('%s failed: %s. Retry in %s seconds' %
+                               (method, e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def close(self):
+        """
+        Close all of idle connections.
+        """
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle.clear()
@@ -4,21 +4,39 @@ A multithread downloader.
 
 import aenum
 import logging
-import random
 import requests
 import socket
 import threading
 import time
-from thrift.protocol import TBinaryProtocol
-from thrift.transport import TTransport, TSocket
+from thrift.transport import TTransport
+import urllib.parse
 import uuid
 
 from sinaspider.config import *
-from sinaspider.services.scheduler_service import Client
+from sinaspider.connection_pool import SchedulerConnectionPool
+import sinaspider.metrics
+from sinaspider.proxy import ProxyTracker, is_banned
+from sinaspider.ratelimit import RateLimiter
 from sinaspider.services.ttypes import *
 from sinaspider.sina_login import SinaSessionLoginer
 
 
+_DOWNLOAD_SECONDS = sinaspider.metrics.histogram(
+    'sinaspider_download_seconds', 'Seconds of a request which got a response.')
+_RESPONSES = sinaspider.metrics.counter(
+    'sinaspider_download_responses_total', 'Responses by HTTP status.',
+    ['status'])
+_ERRORS = sinaspider.metrics.counter(
+    'sinaspider_download_errors_total',
+    'Failed requests, e.g. of proxy errors, by exception.', ['error'])
+_SYSBUSY = sinaspider.metrics.counter(
+    'sinaspider_download_sysbusy_total',
+    'Requests redirected to the sysbusy page.')
+_EXPIRED = sinaspider.metrics.counter(
+    'sinaspider_download_expired_total',
+    'Requests redirected to the visitor passport as the session expired.')
+
+
 class DownloaderType(aenum.Enum):
     TOPIC_DOWNLOADER = 0 # Trending topics
     LINK_DOWNLOADER = aenum.auto() # Normal
@@ -26,6 +44,81 @@ class DownloaderType(aenum.Enum):
     UNDEFINED = aenum.auto()
 
 
+class FetchedPage(object):
+    """
+    A downloaded page. This is the only thing handed over from downloaders to
+    the pipeline, so it keeps the raw body and a few headers instead of the
+    whole requests.Response.
+    """
+
+    def __init__(self, url, final_url, status, content_type, charset, body,
+                 fetched_at=None):
+        """
+        Input:
+        - url: A string of requested link.
+        - final_url: A string of url after redirects.
+        - status: An integer of HTTP status code.
+        - content_type: A string of media type, e.g. 'text/html', or None.
+        - charset: A string of charset, or None.
+        - body: A bytes of page content.
+        - fetched_at: A float of timestamp when downloaded.
+        """
+        self.url = url
+        self.final_url = final_url
+        self.status = status
+        self.content_type = content_type
+        self.charset = charset
+        self.body = body
+        self.fetched_at = fetched_at if fetched_at else time.time()
+        self.cleaned = False # Set once cleaned_text is filled by the pipeline
+        self.cleaned_text = None
+
+    @classmethod
+    def from_response(cls, url, response):
+        """
+        Build a page from a requests.Response of the requested url.
+        """
+        content_type, charset = parse_content_type(
+            response.headers.get('content-type', None))
+        return cls(url, response.url, response.status_code, content_type,
+                   charset or response.encoding, response.content)
+
+    @property
+    def text(self):
+        return self.body.decode(self.charset or 'utf-8', errors='replace')
+
+    def __repr__(self):
+        return '%s(url=%s, final_url=%s, status=%s, content_type=%s, '\
+            'charset=%s, size=%s)' % (self.__class__.__name__, self.url,
+            self.final_url, self.status, self.content_type, self.charset,
+            len(self.body))
+
+
+def parse_content_type(header):
+    """
+    Return a tuple of (media type, charset) of a Content-Type header.
+    """
+    if header is None:
+        return (None, None)
+    entries = header.split(';')
+    charset = None
+    for entry in entries[1:]:
+        name, _, value = entry.strip().partition('=')
+        if name.lower() == 'charset':
+            charset = value.strip('"\'')
+    return (entries[0].strip().lower(), charset)
+
+
+def proxy_urls(address):
+    """
+    Return a dict of requests proxies of a ProxyAddress.
+    """
+    return {
+        'http': 'http://%s:%s' % (address.addr, address.port),
+        'https': 'https://%s:%s' % (address.addr, address.port)
+    }
+
+
 class Downloader(threading.Thread):
     """
     A simple downloader. The downloader starts, it grabs a batch of links from
@@ -47,20 +140,13 @@ class Downloader(threading.Thread):
         self.downloading = False
         self.pipeline = pipeline
 
-        self.proxy_lock = threading.Lock() # Protects updating of proxies.
-        self.proxies = set() 
-        self.transport = TSocket.TSocket(SCHEDULER_CONFIG['addr'],
-                                    SCHEDULER_CONFIG['port'])
-        self.transport.setTimeout(20*1000)
-        self.transport = TTransport.TBufferedTransport(
-            self.transport)
-        protocol = TBinaryProtocol.TBinaryProtocol(
-            self.transport)
-        self.client = Client(protocol)
+        self.proxies = ProxyTracker.from_config() # Granted proxies
+        self.pool = SchedulerConnectionPool.instance() # Shared by downloaders
+        self.limiter = RateLimiter.instance() # Shared by downloaders
         if dtype == DownloaderType.LINK_DOWNLOADER:
-            self.link_graber = self.client.grab_links
+            self.link_graber = 'grab_links'
         elif dtype == DownloaderType.TOPIC_DOWNLOADER:
-            self.link_graber = self.client.grab_topic_links
+            self.link_graber = 'grab_topic_links'
         elif dtype == DownloaderType.UNDEFINED:
             import os
             os._exit(1)
@@ -72,15 +158,15 @@ class Downloader(threading.Thread):
         logger.info('Starting %s' % self.name)
         self.downloading = True
         interval = SCHEDULER_CONFIG['client_failover_interval']
+        registered = False
         while self.downloading:
             try:
-                if not self.transport.isOpen():
-                    self.transport.open()
-                self.client.register_downloader(self.name)
+                self.pool.call('register_downloader', self.name)
+                registered = True
                 logger.debug('Registered')
-                self.user_identity = self.client.request_user_identity(self.name)
+                self.user_identity = self.pool.call('request_user_identity',
+                                                    self.name)
                 logger.debug('Get user identity: %s' % self.user_identity)
-                self.transport.close()
                 break
             except (TTransport.TTransportException, socket.timeout) as e:
                 logger.exception(
@@ -92,11 +178,11 @@ class Downloader(threading.Thread):
 
         while self.downloading:
             try:
-                if not self.transport.isOpen():
-                    self.transport.open()
-                self.links = self.link_graber(
-                    DOWNLOADER_CONFIG['link_batch_size'])
-                self.transport.close()
+                if self.pipeline.congested():
+                    size = DOWNLOADER_CONFIG['congested_link_batch_size']
+                else:
+                    size = DOWNLOADER_CONFIG['link_batch_size']
+                self.links = self.pool.call(self.link_graber, size)
                 if len(self.links) == 0:
                     logger.warn('No links available. Waiting...')
                     time.sleep(interval)
@@ -105,68 +191,92 @@ class Downloader(threading.Thread):
                 for _ in range(len(self.links)):
                     link = self.links[-1]
                     logger.debug('Downloading %s.' % link)
-                    response = self._download(link)
+                    page = self._download(link)
                     if not self.downloading:
                         break
-                    if not response:
+                    if not page:
                         continue
-                    self.pipeline.feed(response)
+                    if not self.pipeline.feed(page):
+                        self._resubmit([link])
                     del self.links[-1]
             except (TTransport.TTransportException, socket.timeout) as e:
                 logger.exception('Connection error.')
-                if self.transport.isOpen():
-                    self.transport.close()
                 time.sleep(interval)
             except Exception:
                 logger.exception('Unkown failure, exiting...')
                 self.downloading = False
 
-        if self.transport.isOpen():
-            # TODO: submit uncrawled links to scheduler.
-            logger.debug('Unregiser downloader.')
-            self.client.unregister_downloader(self.name)
-            if len(self.links) > 0:
-                if self.downloader_type == DownloaderType.LINK_DOWNLOADER:
-                    for idx in range(len(self.links)):
-                        patch = '&uuid=%s' % uuid.uuid4().hex
-                        self.links[idx] = self.links[idx] + patch
-                    self.client.submit_links(self.links)
-                elif self.downloader_type == DownloaderType.TOPIC_DOWNLOADER:
-                    self.client.submit_topic_links(self.links)
-            logger.debug('Closing connection to scheduler.')
-            self.transport.close()
+        if registered:
+            try:
+                logger.debug('Unregiser downloader.')
+                self.pool.call('unregister_downloader', self.name)
+                if len(self.links) > 0:
+                    self._resubmit(self.links)
+            except Exception:
+                logger.exception('Failed to return links to scheduler.')
         logger.info('Downloader stopped.')
 
+    def _resubmit(self, links):
+        """
+        Return links to the scheduler so that they are downloaded again.
+        """
+        if self.downloader_type == DownloaderType.LINK_DOWNLOADER:
+            # Bypass the dead links check of scheduler.
+            links = [link + '&uuid=%s' % uuid.uuid4().hex for link in links]
+            self.pool.call('submit_links', links)
+        elif self.downloader_type == DownloaderType.TOPIC_DOWNLOADER:
+            # Topic links just grabbed are not due yet unless forced.
+            links = [link + '&uuid=%s' % uuid.uuid4().hex for link in links]
+            self.pool.call('submit_topic_links', links)
+
     def _download(self, link):
         """
-        Download the link.
+        Download the link. Return a FetchedPage, or None if failed.
 
         Input:
         - link: A string of link to be downloaded.
         """
         logger = logging.getLogger(self.name)
+        host = urllib.parse.urlsplit(link).netloc
         _proxy = None
         while self.downloading:
             try:
-                if len(self.proxies) == 0:
+                address = self.proxies.choose()
+                if address is None:
                     time.sleep(0.5)
                     logger.debug('No proxies, waiting...')
                     continue
-                self.proxy_lock.acquire()
-                proxy = random.choice(self.proxies)
-                self.proxy_lock.release()
+                proxy = proxy_urls(address)
                 if _proxy != proxy:
                     self.session.close()
+                _proxy = proxy
                 logger.debug('Using proxy: %s' % proxy)
+                self._wait(self.limiter.reserve(host, proxy['http']))
+                if not self.downloading:
+                    break
+                start = time.time()
                 response = self.session.get(link, proxies=proxy, 
                             timeout=DOWNLOADER_CONFIG['requests_timeout'],
                             verify=False)
+                latency = time.time() - start
+                _DOWNLOAD_SECONDS.observe(latency)
+                _RESPONSES.inc(status=response.status_code)
+                if is_banned(response.status_code, response.url):
+                    logger.warn('Proxy %s is banned: %s' % (address,
+                                                           response.url))
+                    self._proxy_failed(address)
+                    continue
                 if 'weibo.com/sorry?sysbusy' in response.url:
-                    #logger.debug('Too fast. Waiting...')
-                    #time.sleep(DOWNLOADER_CONFIG['sysbusy_wait_latency'])
+                    logger.debug('Too fast. Slowing down...')
+                    self.limiter.sysbusy(host, proxy['http'])
+                    _SYSBUSY.inc()
                     continue
+                self.limiter.success(host, proxy['http'])
                 if self._is_login(response):
-                    return response
+                    # Throttled or expired responses do not vouch for the proxy.
+                    self.proxies.success(address, latency)
+                    return FetchedPage.from_response(link, response)
+                _EXPIRED.inc()
                 logger.info('Session expired. Relogin...')
                 #self.loginer.login(self.user_identity)
                 self._update_cookie()
@@ -176,7 +286,9 @@ class Downloader(threading.Thread):
                     requests.exceptions.ReadTimeout, 
                     # BadStatusLine aborts the connection
                     requests.exceptions.ConnectionError) as e:
+                _ERRORS.inc(error=e.__class__.__name__)
                 logger.warn('requests exception: %s' % e)
+                self._proxy_failed(address)
             except requests.exceptions.MissingSchema as e:
                 break
             except Exception:
@@ -184,6 +296,27 @@ class Downloader(threading.Thread):
         return None
             
 
+    def _proxy_failed(self, address):
+        """
+        Record a failure of the proxy. Resign it to the scheduler once it is
+        quarantined.
+        """
+        if not self.proxies.failure(address):
+            return
+        logging.getLogger(self.name).info('Resign proxy %s' % address)
+        try:
+            self.pool.call('resign_proxy', address, self.name)
+        except (TTransport.TTransportException, socket.timeout):
+            logging.getLogger(self.name).exception('Failed to resign proxy.')
+
+    def _wait(self, seconds):
+        """
+        Sleep while still responding to stop().
+        """
+        deadline = time.time() + seconds
+        while self.downloading and time.time() < deadline:
+            time.sleep(min(1, deadline - time.time()))
+
     def _is_login(self, response):
         """
         Should be implemented inline.
@@ -198,10 +331,7 @@ class Downloader(threading.Thread):
         cookie = None
         while True:
             time.sleep(DOWNLOADER_CONFIG['cookie_update_interval'])
-            if not self.transport.isOpen():
-                self.transport.open()
-            cookie = self.client.request_cookie(self.name)
-            self.transport.close()
+            cookie = self.pool.call('request_cookie', self.name)
             if cookie.user != 'NULL':
                 break
             logger.info('No cookies. Retry later...')
@@ -224,22 +354,8 @@ class Downloader(threading.Thread):
         Update the proxy list later via the timer.
         """
         logger = logging.getLogger(self.name)
-        if not self.transport.isOpen():
-            self.transport.open()
-        proxies = self.client.request_proxies(self.name, 
+        proxies = self.pool.call('request_proxies', self.name,
                         DOWNLOADER_CONFIG['proxy_pool_size'])
         logger.debug('Get proxies: %s' % proxies)
-        self.transport.close()
-        new_proxies = list()
-        for proxy in proxies:
-            _proxy = {
-                'http': 'http://%s:%s' % (proxy.addr, proxy.port), 
-                'https': 'https://%s:%s' % (proxy.addr, proxy.port)
-            }
-            new_proxies.append(_proxy)
-        logger.debug('Old proxies: %s' % self.proxies)
-        self.proxy_lock.acquire()
-        self.proxies = new_proxies
-        self.proxy_lock.release()
-        logger.debug('New proxies: %s' % self.proxies)
+        self.proxies.update(proxies)
 
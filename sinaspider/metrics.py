@@ -0,0 +1,388 @@
+"""
+Metrics of the crawler: counters, gauges and histograms.
+
+Every process updates its metrics in memory. Once start() is called, the
+process writes a snapshot of them into the metrics directory periodically.
+MetricsServer merges the snapshots of all processes and serves them at
+/metrics in the Prometheus text format:
+- Counters and histograms are summed over the processes, including the ones
+  which have exited.
+- Gauges are taken from the latest snapshot which is not stale.
+
+Usage:
+
+    _RESPONSES = sinaspider.metrics.counter(
+        'sinaspider_download_responses_total', 'Responses by status.',
+        ['status'])
+    _RESPONSES.inc(status=200)
+"""
+
+import bisect
+import collections
+import contextlib
+import functools
+import http.server
+import json
+import logging
+import os
+from os.path import join, dirname, abspath, isabs, isdir
+import threading
+import time
+
+from sinaspider.config import *
+import sinaspider.utils
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+_METRICS = collections.OrderedDict() # Name -> Metric
+_lock = threading.Lock() # Guards the registry and the process state below
+_owner = os.getpid() # Process whose updates the metrics hold
+_name = None # Name of the snapshot of this process
+_timer = None
+
+
+class Metric(object):
+    """
+    A metric with a value per combination of label values. Subclass
+    implements the update methods.
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        Input:
+        - name: A string of metric name.
+        - help: A string of description.
+        - labels: A list of label names.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = dict() # Tuple of label values -> value
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def reset(self):
+        with self.lock:
+            self.series = dict()
+
+    def snapshot(self):
+        """
+        Return a json-compatible dict of the metric.
+        """
+        with self.lock:
+            series = [[list(key), value] for key, value in self.series.items()]
+        return {'kind': self.kind, 'help': self.help,
+                'labels': list(self.labels), 'series': series}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    """
+    A histogram. The value of a series is a list of the count of each bucket
+    and +Inf, the sum and the count of observations.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Input:
+        - buckets: A sorted list of upper bounds of the buckets.
+        """
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = [0] * (len(self.buckets) + 3)
+                self.series[key] = series
+            series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in the with block.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def snapshot(self):
+        snapshot = Metric.snapshot(self)
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+def _register(cls, name, *args):
+    with _lock:
+        metric = _METRICS.get(name)
+        if metric is None:
+            metric = cls(name, *args)
+            _METRICS[name] = metric
+        assert type(metric) is cls, '%s is registered as a %s' % (
+            name, metric.kind)
+        return metric
+
+def counter(name, help, labels=()):
+    """
+    Return the counter of the name, registering it if new.
+    """
+    return _register(Counter, name, help, labels)
+
+def gauge(name, help, labels=()):
+    """
+    Return the gauge of the name, registering it if new.
+    """
+    return _register(Gauge, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    """
+    Return the histogram of the name, registering it if new.
+    """
+    return _register(Histogram, name, help, labels, buckets)
+
+def timed(histogram, label='method'):
+    """
+    Decorate a method to observe its run time in the histogram, labelled by
+    the method name.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**{label: method.__name__}):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+### Snapshots
+
+def metrics_dir():
+    """
+    Return a string of the directory of snapshots.
+    """
+    path = METRICS_CONFIG['dir']
+    if not isabs(path):
+        path = join(dirname(dirname(abspath(__file__))), path)
+    return path
+
+def start(name):
+    """
+    Start writing snapshots of current process under the name. A forked
+    process must call it again: the metrics inherited from the parent are
+    reset so that they are not counted twice.
+    """
+    global _owner, _name, _timer
+    with _lock:
+        pid = os.getpid()
+        if _name is not None and _owner == pid:
+            return
+        if _owner != pid:
+            for metric in _METRICS.values():
+                metric.reset()
+            _owner = pid
+        _name = name
+        if not isdir(metrics_dir()):
+            os.makedirs(metrics_dir(), exist_ok=True)
+        _timer = sinaspider.utils.RepeatingTimer(
+            METRICS_CONFIG['flush_interval'], flush)
+        _timer.daemon = True
+        _timer.start()
+
+def stop():
+    """
+    Stop writing snapshots after writing the last one. Processes call it
+    before exiting.
+    """
+    global _name, _timer
+    flush()
+    with _lock:
+        if _timer is not None and _owner == os.getpid():
+            _timer.stop()
+        _name = None
+        _timer = None
+
+def flush():
+    """
+    Write a snapshot of current process now.
+    """
+    if _name is None or _owner != os.getpid():
+        return
+    with _lock:
+        metrics = list(_METRICS.values())
+    snapshot = {
+        'name': _name,
+        'pid': _owner,
+        'time': time.time(),
+        'metrics': dict((metric.name, metric.snapshot()) for metric in metrics)
+    }
+    path = join(metrics_dir(), '%s-%s.json' % (_name, _owner))
+    try:
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(snapshot, fd)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        logging.getLogger(_name).exception('Failed to write metrics.')
+
+def collect(directory, stale_after):
+    """
+    Return a dict of name -> merged metric of the snapshots in the directory.
+    A merged metric is a snapshot whose series is a dict of tuple of label
+    values -> value.
+
+    Input:
+    - directory: A string of the directory of snapshots.
+    - stale_after: A float of seconds after which gauges of a snapshot are
+                   ignored.
+    """
+    snapshots = list()
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(join(directory, name)) as fd:
+                snapshots.append(json.load(fd))
+        except (OSError, ValueError):
+            continue # Removed or being replaced
+    snapshots.sort(key=lambda snapshot: snapshot['time'])
+    now = time.time()
+    merged = dict()
+    for snapshot in snapshots:
+        stale = now - snapshot['time'] > stale_after
+        for name, metric in snapshot['metrics'].items():
+            if metric['kind'] == 'gauge' and stale:
+                continue
+            target = merged.get(name)
+            if target is None:
+                target = dict(metric, series=dict())
+                merged[name] = target
+            for key, value in metric['series']:
+                key = tuple(key)
+                if metric['kind'] == 'gauge' or key not in target['series']:
+                    target['series'][key] = value
+                elif metric['kind'] == 'counter':
+                    target['series'][key] += value
+                else:
+                    target['series'][key] = [a + b for a, b in
+                                             zip(target['series'][key], value)]
+    return merged
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+def render(merged):
+    """
+    Return a string of merged metrics in the Prometheus text format.
+    """
+    lines = list()
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['kind']))
+        for key in sorted(metric['series']):
+            value = metric['series'][key]
+            if metric['kind'] != 'histogram':
+                lines.append('%s%s %s' % (name, _labels(metric['labels'], key),
+                                          value))
+                continue
+            cumulative = 0
+            bounds = [repr(float(b)) for b in metric['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (
+                    name, _labels(metric['labels'], key, [('le', bound)]),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (name, _labels(metric['labels'], key),
+                                          value[-2]))
+            lines.append('%s_count%s %s' % (name,
+                                            _labels(metric['labels'], key),
+                                            value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+### Exposition
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render(collect(self.server.directory,
+                              self.server.stale_after)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """
+    An HTTP server of the metrics of all processes at /metrics.
+    """
+    daemon_threads = True
+
+    def __init__(self, addr, port, directory=None, stale_after=None):
+        """
+        Input:
+        - addr: A string of address to listen on.
+        - port: An integer of port to listen on.
+        - directory: A string of the directory of snapshots. Default to
+                     metrics_dir().
+        - stale_after: A float of seconds, see collect(). Default to
+                       METRICS_CONFIG['stale_after'].
+        """
+        http.server.ThreadingHTTPServer.__init__(self, (addr, port),
+                                                 MetricsHandler)
+        self.directory = directory if directory else metrics_dir()
+        self.stale_after = stale_after
+        if stale_after is None:
+            self.stale_after = METRICS_CONFIG['stale_after']
+        if not isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
@@ -3,13 +3,33 @@ A simple html processing pipeline.
 """
 
 import logging
-import concurrent.futures
+import multiprocessing
 import os
+import queue
 import signal
 import threading
+import time
 
 from sinaspider.config import *
 import sinaspider.log
+import sinaspider.metrics
+import sinaspider.ring_buffer
+
+_NODE_SECONDS = sinaspider.metrics.histogram(
+    'sinaspider_pipeline_node_seconds', 'Seconds of a run of a pipeline node.',
+    ['node'])
+_FED_PAGES = sinaspider.metrics.counter(
+    'sinaspider_pipeline_fed_pages_total',
+    'Pages fed to the pipeline by outcome: queued or shed.',
+    ['outcome'])
+_QUEUE_DEPTH = sinaspider.metrics.gauge(
+    'sinaspider_pipeline_queue_depth', 'Pages waiting in the pipeline queue.')
+_PAGE_DELAY = sinaspider.metrics.histogram(
+    'sinaspider_pipeline_page_delay_seconds',
+    'Seconds from downloading a page to processing it.')
+_BATCH_SECONDS = sinaspider.metrics.histogram(
+    'sinaspider_pipeline_batch_seconds',
+    'Seconds of running the pipeline for a micro-batch.')
 
 
 class PipelineNode(object):
@@ -22,6 +42,7 @@ class PipelineNode(object):
     def __init__(self, name):
         self.name = name
         self.children = list()
+        self.observer = None
 
     def forward(self, node):
         """
@@ -38,12 +59,40 @@ class PipelineNode(object):
         """
         pass
 
+    def begin_batch(self):
+        """
+        Called before a batch of pages flows through the pipeline. Override
+        this to set up state shared by the pages of a batch.
+        """
+        pass
+
+    def end_batch(self):
+        """
+        Called after a batch of pages flowed through the pipeline. Override
+        this to commit the work accumulated during the batch.
+        """
+        pass
+
+    def register_storage_writer(self, writer):
+        """
+        Override this if the node writes to the storage.
+
+        Input:
+        - writer: A sinaspider.store.StorageWriter.
+        """
+        pass
+
     def start(self, client, *kws):
         """
         Runs current node.
         """
         try:
+            start = time.time()
             kws = self.run(client, *kws)
+            seconds = time.time() - start
+            _NODE_SECONDS.observe(seconds, node=self.name)
+            if self.observer is not None:
+                self.observer(self, seconds)
             if kws: # Empty response. Exit the pipeline 
                 for child in self.children:
                     child.start(client, *kws)
@@ -55,7 +104,7 @@ class PipelineNode(object):
 class Pipeline(object):
     """
     A pipeline is composed of a series of pipeline node. The downloader feed each
-    response to the pipeline, the response flow through the pipeline.
+    page to the pipeline, the page flow through the pipeline.
     """
 
     def __init__(self, name, head, queue):
@@ -63,55 +112,208 @@ class Pipeline(object):
         Input:
         - name: A string of pipeline node name.
         - head: A PipelineNode which acts as an entry of the pipeline.
-        - queue: A multiprocess.Queue.
+        - queue: A multiprocess.Queue, or a PageRingBuffer created by
+                 create_page_queue().
         """
         self.name = name
         self.head = head
         self.scheduler_client = None
         self.queue = queue
+        self.recorder = None
+        self._congested = False
 
-    def start(self, response):
+    def start(self, page):
         """
-        Start the pipeline with the response
+        Start the pipeline with the page.
+
+        Input:
+        - page: A sinaspider.downloader.FetchedPage.
         """
         logger = logging.getLogger(self.name)
         try:
             assert self.scheduler_client, 'Scheduler client is not registered yet.'
-            self.head.start(self.scheduler_client, response)
+            self.head.start(self.scheduler_client, page)
         except Exception:
             logger.exception('Exception in pipeline.')
 
-    def eat(self):
-        return self.queue.get()
+    def start_batch(self, pages):
+        """
+        Start the pipeline with a batch of pages. Every node sees
+        begin_batch() before the first page and end_batch() after the last.
 
-    def feed(self, response):
-        self.queue.put(response)
+        Input:
+        - pages: A list of sinaspider.downloader.FetchedPage.
+        """
+        logger = logging.getLogger(self.name)
+        nodes = self.nodes()
+        for node in nodes:
+            node.begin_batch()
+        for page in pages:
+            self.start(page)
+        for node in nodes:
+            try:
+                node.end_batch()
+            except Exception:
+                logger.exception('Exception while ending batch of %s.' %
+                                 node.name)
+
+    def nodes(self):
+        """
+        Return a list of nodes reachable from the head, each of which appears
+        once even if it has several parents.
+        """
+        nodes = list()
+        seen = set()
+        stack = [self.head]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+        return nodes
+
+    def eat(self, timeout=None):
+        """
+        Return the next page. Raise queue.Empty if no page arrives within
+        timeout.
+        """
+        return self.queue.get(timeout=timeout)
+
+    def eat_batch(self, size, latency, timeout=None):
+        """
+        Return a list of at most size pages. Once the first page arrives, wait
+        at most latency seconds for the rest. Raise queue.Empty if no page
+        arrives within timeout.
+        """
+        pages = [self.queue.get(timeout=timeout)]
+        deadline = time.time() + latency
+        while len(pages) < size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                pages.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pages
+
+    def congested(self):
+        """
+        Return True if the queue has risen to the high watermark and not yet
+        drained to the low watermark. Downloaders should slow down meanwhile.
+        """
+        size = self.queue.qsize()
+        if size >= PIPELINE_CONFIG['high_watermark']:
+            self._congested = True
+        elif size <= PIPELINE_CONFIG['low_watermark']:
+            self._congested = False
+        return self._congested
+
+    def feed(self, page):
+        """
+        Put a page into the queue. While the pipeline is congested, the page is
+        either shed at once or held until the queue drains, according to
+        PIPELINE_CONFIG['overflow_policy'].
+
+        Return False if the page is shed, in which case the caller still owns
+        its link.
+        """
+        logger = logging.getLogger(self.name)
+        if self.congested():
+            if PIPELINE_CONFIG['overflow_policy'] == 'shed':
+                logger.warn('Pipeline congested. Shed %s' % page.url)
+                _FED_PAGES.inc(outcome='shed')
+                return False
+            deadline = time.time() + PIPELINE_CONFIG['block_timeout']
+            while self.congested():
+                if time.time() >= deadline:
+                    logger.warn('Pipeline congested for %s seconds. Shed %s' %
+                                (PIPELINE_CONFIG['block_timeout'], page.url))
+                    _FED_PAGES.inc(outcome='shed')
+                    return False
+                time.sleep(0.1)
+        self.queue.put(page)
+        _FED_PAGES.inc(outcome='queued')
+        if self.recorder:
+            self.recorder.write(page)
+        return True
 
     def register_scheduler_client(self, client):
         self.scheduler_client = client
 
+    def register_observer(self, observer):
+        """
+        Time every node. observer(node, seconds) is called after each run of
+        a node.
+        """
+        for node in self.nodes():
+            node.observer = observer
+
+    def register_recorder(self, recorder):
+        """
+        Record every page fed to the pipeline.
+
+        Input:
+        - recorder: A sinaspider.replay.CorpusWriter.
+        """
+        self.recorder = recorder
+
+    def open(self):
+        """
+        Called by the engine before it starts the workers. Override this to
+        start the resources shared by the workers.
+        """
+        pass
+
+    def close(self):
+        """
+        Called by the engine after all of the workers stopped.
+        """
+        pass
+
+
+def create_page_queue(manager):
+    """
+    Return the queue between downloaders and the pipeline engine according to
+    PIPELINE_CONFIG['transport']: a shared memory PageRingBuffer for 'shm',
+    or a queue of the manager otherwise.
+
+    Input:
+    - manager: A multiprocessing.Manager.
+    """
+    if PIPELINE_CONFIG['transport'] == 'shm':
+        return sinaspider.ring_buffer.PageRingBuffer(
+            PIPELINE_CONFIG['ring_slots'], PIPELINE_CONFIG['ring_slot_size'])
+    return manager.Queue(-1)
+
 
 class PipelineEngine(object):
     """
-    A pipeline engine. The engine executes the pipeline by a process pool. Users
-    should only feed inputs to the pipeline.
+    A pipeline engine. The engine executes the pipeline by a pool of worker
+    processes, each of which takes pages from the pipeline queue directly.
+    Users should only feed inputs to the pipeline.
     """
 
-    def __init__(self, pipeline, manager):
+    def __init__(self, pipeline, manager, scheduler_client=None):
         """
         Input:
         - pipeline: A Pipeline which defines a flow of computations.
         - manager: A multiprocessing.Manager.
+        - scheduler_client: A client which takes links found by the pipeline.
+                            Default to a SchedulerServiceClient.
         """
         self.pipeline = pipeline
         self.manager = manager
         self.name = self.__class__.__name__
-        queue = self.manager.Queue(-1)
 
-        self.executor = concurrent.futures.ProcessPoolExecutor(
-            max_workers=PIPELINE_CONFIG['engine_pool_size'])
-        self.scheduler_client = sinaspider.scheduler.SchedulerServiceClient(
-            queue)
+        self.workers = list()
+        self.stopped = multiprocessing.Event() # Tells workers to exit
+        self.scheduler_client = scheduler_client
+        if scheduler_client is None:
+            self.scheduler_client = sinaspider.scheduler.SchedulerServiceClient(
+                self.manager.Queue(-1))
         self.scheduler_client_thread = threading.Thread(
             name='SchedulerServiceClient', target=self.scheduler_client.run)
         self.pipeline.register_scheduler_client(self.scheduler_client)
@@ -125,26 +327,62 @@ class PipelineEngine(object):
         signal.signal(signal.SIGINT, self.sig_handler)
         sinaspider.log.configure_logger('.engine.log')
         logger = logging.getLogger(self.name)
+        sinaspider.metrics.start(self.name)
         logger.info('Starting scheduler client...')
         self.scheduler_client_thread.start()
+        self.pipeline.open()
         logger.info('Running pipeline...')
         self.running = True
+        for idx in range(PIPELINE_CONFIG['engine_pool_size']):
+            worker = multiprocessing.Process(name='%s-%s' % (self.name, idx),
+                                             target=self.work)
+            worker.start()
+            self.workers.append(worker)
         while self.running:
-            try:
-                response = self.pipeline.eat()
-                logger.debug('Processing %s' % str(response))
-                self.executor.submit(self.pipeline.start, response)
-            except Exception:
-                logger.exception('Exception during submit %s' % str(response))
+            _QUEUE_DEPTH.set(self.pipeline.queue.qsize())
+            self.stopped.wait(1)
+        logger.info('Stopping engine workers.')
+        self.stopped.set()
+        for worker in self.workers:
+            worker.join()
+        self.pipeline.close()
         logger.info('Stopping scheduler client')
         self.scheduler_client_thread.join()
-        logger.info('Stopping engine executor.')
-        self.executor.shutdown()
+        sinaspider.metrics.stop()
         logger.info('Stopped.')
 
+    def work(self):
+        """
+        Entry of a worker process. Run the pipeline for micro-batches of pages
+        until the engine stops.
+        """
+        # The engine process coordinates the shutdown.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        name = multiprocessing.current_process().name
+        logger = logging.getLogger(name)
+        sinaspider.metrics.start(name)
+        while not self.stopped.is_set():
+            try:
+                pages = self.pipeline.eat_batch(PIPELINE_CONFIG['batch_size'],
+                                                PIPELINE_CONFIG['batch_latency'],
+                                                1)
+            except queue.Empty:
+                continue
+            except Exception:
+                logger.exception('Exception while taking pages.')
+                continue
+            logger.debug('Processing %s pages' % len(pages))
+            now = time.time()
+            for page in pages:
+                _PAGE_DELAY.observe(now - page.fetched_at)
+            with _BATCH_SECONDS.time():
+                self.pipeline.start_batch(pages)
+        sinaspider.metrics.stop()
+
     def sig_handler(self, sig, func):
         """
-        Handler for signal.SIGTERM. The handler shuts down the engine executor.
+        Handler for signal.SIGTERM. The handler shuts down the engine workers.
         """
         self.running = False
         self.scheduler_client.stop()
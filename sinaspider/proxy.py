@@ -0,0 +1,253 @@
+"""
+Health of proxies.
+
+Every proxy is scored by an EWMA of its success rate and of its latency.
+Proxies are drawn at random weighted by success rate / latency, so fast and
+healthy proxies take most of the requests while new ones still get tried.
+A proxy failing max_failures times in a row is quarantined, for twice as
+long every time it is quarantined again without a success in between, and is
+dropped after max_strikes quarantines.
+
+Downloaders track the proxies granted to them and resign the quarantined ones
+to the scheduler, which tracks all of the proxies it hands out. The scheduler
+learns only of resigns, each of which counts as a failure, so that proxies
+resigned more often are handed out less.
+"""
+
+import random
+import threading
+import time
+import urllib.parse
+
+from sinaspider.config import *
+
+# Statuses of a proxy refusing to serve, e.g. it asks for authentication.
+BAN_STATUSES = {407}
+# Domains of the pages weibo answers with, including their subdomains.
+WEIBO_DOMAINS = ('weibo.com', 'weibo.cn', 'sina.com.cn')
+
+
+def is_banned(status, final_url):
+    """
+    Return True if a response tells that the proxy is banned or broken: the
+    proxy refused the request, or answered with a page not from weibo.
+    """
+    if status in BAN_STATUSES:
+        return True
+    host = (urllib.parse.urlsplit(final_url).hostname or '').lower()
+    return not any(host == domain or host.endswith('.' + domain)
+                   for domain in WEIBO_DOMAINS)
+
+
+class ProxyStats(object):
+    """
+    Health of a proxy.
+    """
+    __slots__ = ('ok', 'latency', 'failures', 'last_failure', 'strikes',
+                 'released')
+
+    def __init__(self, latency):
+        self.ok = 1.0 # EWMA of successes, optimistic for new proxies
+        self.latency = latency # EWMA of seconds of successful requests
+        self.failures = 0 # Consecutive failures
+        self.last_failure = None # Timestamp
+        self.strikes = 0 # Quarantines since the last success
+        self.released = 0 # Timestamp the quarantine ends at
+
+    def __repr__(self):
+        return '%s(ok=%.3f, latency=%.3f, failures=%s, strikes=%s)' % (
+            self.__class__.__name__, self.ok, self.latency, self.failures,
+            self.strikes)
+
+
+class ProxyTracker(object):
+    """
+    A thread-safe tracker of the health of a set of proxies, keyed by
+    ProxyAddress.
+    """
+
+    def __init__(self, alpha=0.2, max_failures=3, quarantine=60,
+                 max_strikes=4, latency=1.0, seed=None):
+        """
+        Input:
+        - alpha: A float of the weight of the latest request in the EWMAs.
+        - max_failures: An integer of consecutive failures to quarantine a
+                        proxy at.
+        - quarantine: A float of seconds of the first quarantine.
+        - max_strikes: An integer of quarantines in a row to drop a proxy at.
+        - latency: A float of the latency new proxies are assumed to have.
+        - seed: A seed of the generator of random draws.
+        """
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.quarantine_seconds = quarantine
+        self.max_strikes = max_strikes
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.stats = dict() # ProxyAddress -> ProxyStats
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """
+        Return a tracker configured by SCHEDULER_CONFIG.
+        """
+        return cls(SCHEDULER_CONFIG['proxy_ewma_alpha'],
+                   SCHEDULER_CONFIG['proxy_max_try'],
+                   SCHEDULER_CONFIG['proxy_quarantine'],
+                   SCHEDULER_CONFIG['proxy_max_strikes'])
+
+    def __len__(self):
+        return len(self.stats)
+
+    def __contains__(self, proxy):
+        return proxy in self.stats
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.stats))
+
+    def add(self, proxies):
+        """
+        Track the proxies not tracked yet, and mark all of them as the most
+        recently listed, see prune(). Return the number of proxies added.
+        """
+        count = 0
+        with self.lock:
+            for proxy in proxies:
+                stats = self.stats.pop(proxy, None)
+                if stats is None:
+                    stats = ProxyStats(self.latency)
+                    count += 1
+                self.stats[proxy] = stats
+        return count
+
+    def update(self, proxies):
+        """
+        Track exactly the proxies, keeping the health of those tracked before.
+        """
+        with self.lock:
+            self.stats = dict((proxy, self.stats.get(proxy) or
+                               ProxyStats(self.latency)) for proxy in proxies)
+
+    def remove(self, proxy):
+        with self.lock:
+            self.stats.pop(proxy, None)
+
+    def _weight(self, stats):
+        return stats.ok / max(stats.latency, 0.01)
+
+    def healthy(self, now=None):
+        """
+        Return a list of the proxies not in quarantine.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            return [proxy for proxy, stats in self.stats.items()
+                    if stats.released <= now]
+
+    def sample(self, size, now=None):
+        """
+        Return a list of at most size distinct proxies, drawn by their weights
+        from the proxies not in quarantine. If all of them are, the ones
+        released the soonest are returned.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            candidates = [(proxy, self._weight(stats)) for proxy, stats in
+                          self.stats.items() if stats.released <= now]
+            if not candidates:
+                proxies = sorted(self.stats, key=lambda proxy:
+                                 self.stats[proxy].released)
+                return proxies[:size]
+            # Weighted sampling without replacement (Efraimidis-Spirakis)
+            keys = [(self.random.random() ** (1.0 / weight), proxy)
+                    for proxy, weight in candidates if weight > 0]
+            keys.sort(key=lambda key: key[0], reverse=True)
+            return [proxy for _, proxy in keys[:size]]
+
+    def choose(self, now=None):
+        """
+        Return a proxy drawn by weight, or None if no proxies are tracked.
+        """
+        proxies = self.sample(1, now)
+        return proxies[0] if proxies else None
+
+    def success(self, proxy, latency):
+        """
+        Record a successful request of the proxy which took latency seconds.
+        """
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+            stats.ok += self.alpha * (1 - stats.ok)
+            stats.latency += self.alpha * (latency - stats.latency)
+            stats.failures = 0
+            stats.strikes = 0
+
+    def failure(self, proxy, now=None):
+        """
+        Record a failed request of the proxy. Return True if the proxy is
+        quarantined by this failure.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return False
+            stats.ok -= self.alpha * stats.ok
+            stats.failures += 1
+            stats.last_failure = now
+            if stats.failures < self.max_failures:
+                return False
+            return self._quarantine(proxy, stats, now)
+
+    def quarantine(self, proxy, now=None):
+        """
+        Record a failure of the proxy and quarantine it at once, e.g. it is
+        resigned by a downloader. Return False if the proxy is not tracked or
+        in quarantine already.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return False
+            stats.ok -= self.alpha * stats.ok
+            stats.last_failure = now
+            return self._quarantine(proxy, stats, now)
+
+    def _quarantine(self, proxy, stats, now):
+        """
+        Return True if the proxy is quarantined or dropped.
+        """
+        stats.failures = 0
+        if stats.released > now:
+            return False
+        stats.strikes += 1
+        if stats.strikes >= self.max_strikes:
+            del self.stats[proxy]
+        else:
+            stats.released = now + \
+                self.quarantine_seconds * 2 ** (stats.strikes - 1)
+        return True
+
+    def prune(self, size, now=None):
+        """
+        Keep at most size proxies. The ones in quarantine are dropped first,
+        then the ones of the most strikes, then the lowest weights, then the
+        least recently listed.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if len(self.stats) <= size:
+                return
+            recency = dict((proxy, idx) for idx, proxy in enumerate(self.stats))
+            def rank(proxy):
+                stats = self.stats[proxy]
+                return (stats.released <= now, -stats.strikes,
+                        self._weight(stats), recency[proxy])
+            proxies = sorted(self.stats, key=rank, reverse=True)
+            for proxy in proxies[size:]:
+                del self.stats[proxy]
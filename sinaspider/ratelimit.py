@@ -0,0 +1,199 @@
+"""
+Politeness of the downloaders: a token bucket per pair of host and proxy,
+whose rate adapts to how weibo responds.
+
+Weibo answers a client which is too fast with weibo.com/sorry?sysbusy. The
+rate of a bucket is cut by a factor on sysbusy and grows additively while
+requests succeed (AIMD), so every proxy converges to the fastest rate weibo
+tolerates instead of retrying into sysbusy.
+
+Usage:
+
+    limiter = RateLimiter.instance()
+    time.sleep(limiter.reserve(host, proxy))
+    ...
+    limiter.sysbusy(host, proxy) # or limiter.success(host, proxy)
+"""
+
+import os
+import threading
+import time
+
+from sinaspider.config import *
+import sinaspider.metrics
+
+_WAIT_SECONDS = sinaspider.metrics.counter(
+    'sinaspider_rate_limit_wait_seconds_total',
+    'Seconds requests were delayed by the rate limiter.')
+_SLOWDOWNS = sinaspider.metrics.counter(
+    'sinaspider_rate_limit_slowdowns_total',
+    'Rates of host and proxy pairs cut on sysbusy.')
+
+
+class TokenBucket(object):
+    """
+    A token bucket of an adaptive rate. Not thread-safe, see RateLimiter.
+
+    Tokens are reserved ahead: a request takes a token even if the bucket is
+    empty and waits until the token would have been refilled. Concurrent
+    requests are spaced by 1 / rate seconds this way.
+    """
+
+    def __init__(self, rate, burst, min_rate, max_rate, increase, decrease,
+                 cooldown, now=None):
+        """
+        Input:
+        - rate: A float of the initial requests per second.
+        - burst: A float of the capacity of the bucket.
+        - min_rate, max_rate: Floats of the bounds of the rate.
+        - increase: A float of requests per second the rate grows by every
+                    second of successful requests.
+        - decrease: A float factor of the rate on sysbusy.
+        - cooldown: A float of seconds within which the rate is cut once, so
+                    that a burst of sysbusy responses of requests in flight
+                    counts as one.
+        - now: A float of current timestamp.
+        """
+        now = time.time() if now is None else now
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.tokens = burst
+        self.updated = now # Timestamp of the last refill
+        self.decreased = now - cooldown # Timestamp of the last cut
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, now):
+        """
+        Take a token. Return a float of seconds to wait before the request.
+        """
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def success(self, now):
+        """
+        Grow the rate by increase every 1 / rate seconds, i.e. every second at
+        the current rate.
+        """
+        self._refill(now)
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def sysbusy(self, now):
+        """
+        Cut the rate and drop the tokens left. Return True if the rate was cut,
+        or False within the cooldown of the last cut.
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, 0)
+        if now - self.decreased < self.cooldown:
+            return False
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.decreased = now
+        return True
+
+
+class RateLimiter(object):
+    """
+    The token buckets of pairs of host and proxy, shared by all downloaders of
+    a process. Buckets idle for a while are dropped, as proxies are replaced
+    over time.
+    """
+    _instance = None
+    _instance_pid = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, rate, burst, min_rate, max_rate, increase, decrease,
+                 cooldown, max_idle=600):
+        """
+        Input:
+        - rate, burst, min_rate, max_rate, increase, decrease, cooldown: See
+          TokenBucket.
+        - max_idle: A float of seconds after which an unused bucket is dropped.
+        """
+        self.args = (rate, burst, min_rate, max_rate, increase, decrease,
+                     cooldown)
+        self.max_idle = max_idle
+        self.buckets = dict() # (host, proxy) -> TokenBucket
+        self.lock = threading.Lock()
+        self._prune_size = 1024 # Number of buckets to drop the idle ones at
+
+    @classmethod
+    def instance(cls):
+        """
+        Return the limiter of current process. A forked child gets its own.
+        """
+        pid = os.getpid()
+        if cls._instance_pid != pid:
+            with cls._instance_lock:
+                if cls._instance_pid != pid:
+                    cls._instance = cls(
+                        DOWNLOADER_CONFIG['rate_limit_rate'],
+                        DOWNLOADER_CONFIG['rate_limit_burst'],
+                        DOWNLOADER_CONFIG['rate_limit_min_rate'],
+                        DOWNLOADER_CONFIG['rate_limit_max_rate'],
+                        DOWNLOADER_CONFIG['rate_limit_increase'],
+                        DOWNLOADER_CONFIG['rate_limit_decrease'],
+                        DOWNLOADER_CONFIG['rate_limit_cooldown'])
+                    cls._instance_pid = pid
+        return cls._instance
+
+    def _bucket(self, host, proxy, now):
+        bucket = self.buckets.get((host, proxy))
+        if bucket is None:
+            if len(self.buckets) > self._prune_size:
+                self.buckets = dict(
+                    (key, bucket) for key, bucket in self.buckets.items()
+                    if now - bucket.updated < self.max_idle)
+                self._prune_size = max(1024, 2 * len(self.buckets))
+            bucket = TokenBucket(*self.args, now=now)
+            self.buckets[(host, proxy)] = bucket
+        return bucket
+
+    def rate(self, host, proxy):
+        """
+        Return a float of the current rate of the pair.
+        """
+        with self.lock:
+            return self._bucket(host, proxy, time.time()).rate
+
+    def reserve(self, host, proxy):
+        """
+        Take a token of the pair. Return a float of seconds to wait before
+        sending the request.
+        """
+        now = time.time()
+        with self.lock:
+            delay = self._bucket(host, proxy, now).reserve(now)
+        if delay > 0:
+            _WAIT_SECONDS.inc(delay)
+        return delay
+
+    def success(self, host, proxy):
+        """
+        Tell that a request of the pair was answered normally.
+        """
+        now = time.time()
+        with self.lock:
+            self._bucket(host, proxy, now).success(now)
+
+    def sysbusy(self, host, proxy):
+        """
+        Tell that a request of the pair was answered by sysbusy.
+        """
+        now = time.time()
+        with self.lock:
+            cut = self._bucket(host, proxy, now).sysbusy(now)
+        if cut:
+            _SLOWDOWNS.inc()
@@ -0,0 +1,124 @@
+"""
+Record downloaded pages to disk and replay them through the pipeline
+without Weibo or the scheduler.
+
+A corpus is a directory of:
+- index.jsonl: One page per line, with url, final_url, status, headers,
+               fetched_at and the body file name.
+- bodies/: Page bodies, one file per page.
+"""
+
+import collections
+import json
+import os
+from os.path import join, isdir
+import threading
+
+from sinaspider.downloader import DownloaderType, FetchedPage, parse_content_type
+
+
+class CorpusWriter(object):
+    """
+    Append pages to a corpus. Safe to share between downloader threads.
+    """
+
+    def __init__(self, path):
+        """
+        Input:
+        - path: A string of the corpus directory. Created if missing.
+        """
+        self.path = path
+        if not isdir(join(path, 'bodies')):
+            os.makedirs(join(path, 'bodies'))
+        self.lock = threading.Lock()
+        self.index = open(join(path, 'index.jsonl'), 'a')
+        self.count = sum(1 for _ in os.listdir(join(path, 'bodies')))
+
+    def write(self, page):
+        """
+        Input:
+        - page: A FetchedPage.
+        """
+        headers = dict()
+        if page.content_type:
+            headers['content-type'] = page.content_type
+            if page.charset:
+                headers['content-type'] += '; charset=%s' % page.charset
+        with self.lock:
+            self.count += 1
+            body = join('bodies', '%08d' % self.count)
+            with open(join(self.path, body), 'wb') as fd:
+                fd.write(page.body)
+            entry = dict(url=page.url, final_url=page.final_url,
+                         status=page.status, headers=headers,
+                         fetched_at=page.fetched_at, body=body)
+            self.index.write(json.dumps(entry) + '\n')
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.index.close()
+
+
+def read_corpus(path):
+    """
+    Yield FetchedPage of a corpus in the recorded order.
+    """
+    with open(join(path, 'index.jsonl')) as index:
+        for line in index:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            with open(join(path, entry['body']), 'rb') as fd:
+                body = fd.read()
+            content_type, charset = parse_content_type(
+                entry['headers'].get('content-type', None))
+            yield FetchedPage(entry['url'], entry['final_url'], entry['status'],
+                              content_type, charset, body, entry['fetched_at'])
+
+
+class StubSchedulerClient(object):
+    """
+    A scheduler client which only counts the links submitted by the pipeline.
+    It can replace SchedulerServiceClient in a PipelineEngine.
+    """
+
+    def __init__(self):
+        self.links = collections.Counter() # DownloaderType -> number of links
+        self.seeds = dict() # Seed link -> last reported digest
+        self.running = False
+
+    def run(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def submit_links(self, links, dtype=DownloaderType.LINK_DOWNLOADER):
+        self.links[dtype] += len(links)
+
+    def report_seed(self, link, digest):
+        self.seeds[link] = digest
+
+
+class NodeTimer(object):
+    """
+    A pipeline observer which collects run time of every node. Register it
+    by Pipeline.register_observer().
+    """
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list) # Node name -> seconds
+
+    def __call__(self, node, seconds):
+        self.samples[node.name].append(seconds)
+
+    def percentiles(self, name, points=(50, 90, 99)):
+        """
+        Return a list of run time in seconds of the node at the percentiles.
+        """
+        samples = sorted(self.samples[name])
+        if not samples:
+            return [0 for _ in points]
+        return [samples[min(len(samples) - 1, len(samples) * point // 100)]
+                for point in points]
@@ -0,0 +1,129 @@
+"""
+A shared memory ring buffer of downloaded pages.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import struct
+
+from sinaspider.downloader import FetchedPage
+
+
+class PageRingBuffer(object):
+    """
+    A bounded queue of FetchedPage between processes. Pages are written into
+    fixed-size slots of a shared memory block by the downloaders and read back
+    by the pipeline workers, so a page body is copied into the block once and
+    never goes through a pickling process.
+
+    It provides the same put/get/qsize interface as a multiprocessing queue.
+    The ring must be created before forking the processes which use it.
+
+    A page too large for a slot is pickled through an overflow queue instead,
+    and its slot holds a marker in place of the record, so that it still
+    takes its turn and counts against the capacity of the ring. A marker is
+    read back as whichever overflow page was queued first, so pages too large
+    for a slot may be delivered out of order, relative to each other and to
+    the pages in slots.
+
+    Slot layout:
+    - 4-byte length of the record, then the record
+    - record: header, url, final_url, content_type, charset, body
+    """
+    _LENGTH = struct.Struct('>I')
+    _OVERFLOW = 0xFFFFFFFF # Length of a slot whose page is in the overflow queue
+    _HEADER = struct.Struct('>dHIIIII') # fetched_at, status, string sizes, body size
+
+    def __init__(self, slots, slot_size):
+        """
+        Input:
+        - slots: An integer of the number of pages the ring can hold.
+        - slot_size: An integer of maximum bytes of an encoded page.
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=slots * slot_size)
+        self.head = multiprocessing.RawValue('Q', 0) # Next slot to read
+        self.tail = multiprocessing.RawValue('Q', 0) # Next slot to write
+        self.put_lock = multiprocessing.Lock()
+        self.get_lock = multiprocessing.Lock()
+        self.free = multiprocessing.Semaphore(slots)
+        self.filled = multiprocessing.Semaphore(0)
+        self.overflow = multiprocessing.Queue()
+
+    def qsize(self):
+        return self.tail.value - self.head.value
+
+    def put(self, page, block=True, timeout=None):
+        """
+        Write a page into the next free slot. Raise queue.Full if no slot is
+        free within timeout.
+        """
+        strings = [s.encode() if s else b'' for s in (page.url, page.final_url,
+                   page.content_type, page.charset)]
+        header = self._HEADER.pack(page.fetched_at, page.status,
+                                   *[len(s) for s in strings], len(page.body))
+        size = len(header) + sum(len(s) for s in strings) + len(page.body)
+        if not self.free.acquire(block, timeout):
+            raise queue.Full
+        if self._LENGTH.size + size > self.slot_size:
+            # Queued before its marker is written, so get() never waits long.
+            self.overflow.put(page)
+            size, chunks = self._OVERFLOW, []
+        else:
+            chunks = [header] + strings + [page.body]
+        with self.put_lock:
+            offset = (self.tail.value % self.slots) * self.slot_size
+            buf = self.shm.buf
+            self._LENGTH.pack_into(buf, offset, size)
+            offset += self._LENGTH.size
+            for data in chunks:
+                buf[offset:offset + len(data)] = data
+                offset += len(data)
+            self.tail.value += 1
+        self.filled.release()
+
+    def get(self, block=True, timeout=None):
+        """
+        Read the page in the oldest filled slot. Raise queue.Empty if no page
+        arrives within timeout.
+        """
+        if not self.filled.acquire(block, timeout):
+            raise queue.Empty
+        with self.get_lock:
+            offset = (self.head.value % self.slots) * self.slot_size
+            size = self._LENGTH.unpack_from(self.shm.buf, offset)[0]
+            offset += self._LENGTH.size
+            if size != self._OVERFLOW:
+                record = bytes(self.shm.buf[offset:offset + size])
+            self.head.value += 1
+        if size == self._OVERFLOW:
+            page = self.overflow.get()
+        else:
+            page = self._decode(record)
+        self.free.release()
+        return page
+
+    def _decode(self, record):
+        fields = self._HEADER.unpack_from(record)
+        fetched_at, status = fields[:2]
+        offset = self._HEADER.size
+        strings = []
+        for size in fields[2:6]:
+            strings.append(record[offset:offset + size].decode() or None)
+            offset += size
+        body = record[offset:offset + fields[6]]
+        url, final_url, content_type, charset = strings
+        return FetchedPage(url, final_url, status, content_type, charset, body,
+                           fetched_at)
+
+    def close(self):
+        """
+        Release the shared memory. Called by the creator once all of the
+        processes using it have stopped.
+        """
+        self.shm.close()
+        self.shm.unlink()
+        self.overflow.close()
@@ -2,20 +2,30 @@
 A simple scheduler.
 """
 
+import collections
+import hashlib
+import heapq
 import logging
 import os
 from os.path import abspath, dirname, join, isdir
 import pickle
 import plyvel
+import queue
 import requests
 import signal
+import socket
+import struct
 import time
 import threading
+import urllib.parse
 from thrift.protocol import TBinaryProtocol
 from thrift.transport import TTransport, TSocket
 from thrift.server import TServer
 
+import sinaspider.connection_pool
 import sinaspider.log
+import sinaspider.metrics
+from sinaspider.proxy import ProxyTracker
 import sinaspider.services.scheduler_service as scheduler_service
 import sinaspider.services.ttypes as ttypes
 from sinaspider.config import *
@@ -23,30 +33,554 @@ import sinaspider.utils
 import sinaspider.sina_pipeline
 from sinaspider.downloader import DownloaderType
 
+_RPC_SECONDS = sinaspider.metrics.histogram(
+    'sinaspider_scheduler_rpc_seconds',
+    'Seconds of a scheduler RPC, including waiting for the lock.', ['method'])
+_FRONTIER_LINKS = sinaspider.metrics.gauge(
+    'sinaspider_scheduler_frontier_links',
+    'Links waiting in the frontier by link class.', ['link_class'])
+_TOPIC_LINKS = sinaspider.metrics.gauge(
+    'sinaspider_scheduler_topic_links', 'Topic links waiting.')
+_PROXIES = sinaspider.metrics.gauge(
+    'sinaspider_scheduler_proxies', 'Proxies by whether in quarantine.',
+    ['state'])
+_DEAD_LINK_LOOKUPS = sinaspider.metrics.counter(
+    'sinaspider_scheduler_dead_link_lookups_total',
+    'Lookups of the dead links filter by result: negative, positive, or '
+    'false_positive for a positive not found in dead_links.db.', ['result'])
+_DEAD_LINKS_FILTER_SIZE = sinaspider.metrics.gauge(
+    'sinaspider_scheduler_dead_links_filter_size',
+    'Links added to the dead links filter.')
+_DEAD_LINKS_FILTER_ERROR_RATE = sinaspider.metrics.gauge(
+    'sinaspider_scheduler_dead_links_filter_expected_error_rate',
+    'Estimated false positive rate of the dead links filter under its load.')
+_SEED_REPORTS = sinaspider.metrics.counter(
+    'sinaspider_scheduler_seed_reports_total',
+    'Reported visits of seed links by whether the content changed.',
+    ['changed'])
+
 class LinkType:
     LINK = 0
     TOPIC_LINK = 1
 
+# Query parameters which do not change the content of a page. 'uuid' is
+# appended by downloaders to ask for a recrawl, '_tries' is the
+# retry counter of the pipeline, and '__rnd' is weibo's own cache buster.
+_FORCE_PARAM = 'uuid'
+_TRIES_PARAM = '_tries'
+_VOLATILE_PARAMS = {_FORCE_PARAM, _TRIES_PARAM, '__rnd'}
+
+def canonicalize_link(link):
+    """
+    Return a tuple of (canonical link, tries, force).
+
+    The canonical link has lower-cased scheme and host, no fragment, no
+    volatile parameters and sorted query parameters. Parameters are sorted
+    without being decoded so that the link stays byte-identical to what the
+    pipeline generated.
+
+    - tries: An integer of the retry counter carried by '_tries'.
+    - force: A bool of whether the link asks for a recrawl by 'uuid'.
+    """
+    parts = urllib.parse.urlsplit(link.strip())
+    path, query = parts.path, parts.query
+    if not query and '&' in path:
+        # Parameters appended to a link without a query, e.g. '/u/1&uuid=ff'
+        path, _, query = path.partition('&')
+    tries = 1
+    force = False
+    params = []
+    for param in query.split('&'):
+        if not param:
+            continue
+        name, _, value = param.partition('=')
+        if name == _TRIES_PARAM:
+            if value.isdigit():
+                tries = max(tries, int(value))
+        elif name == _FORCE_PARAM:
+            force = True
+        elif name not in _VOLATILE_PARAMS:
+            params.append(param)
+    params.sort()
+    canonical = urllib.parse.urlunsplit((parts.scheme.lower(),
+                                         parts.netloc.lower(),
+                                         path or '/',
+                                         '&'.join(params), ''))
+    return (canonical, tries, force)
+
+def strip_link(link):
+    """
+    Return the link as submitted, without the 'uuid' and '_tries' parameters
+    the scheduler interprets itself. Links are handed out in this form, so
+    that downloaders and the pipeline see what the pipeline generated.
+    """
+    link, hash_, fragment = link.strip().partition('#')
+    base, sep, query = link.partition('?')
+    if not sep:
+        base, sep, query = link.partition('&')
+    params = [param for param in query.split('&') if param and
+              param.partition('=')[0] not in (_FORCE_PARAM, _TRIES_PARAM)]
+    if params:
+        base += sep + '&'.join(params)
+    return base + hash_ + fragment
+
+def link_fingerprint(canonical):
+    """
+    Return the 8-byte fingerprint of a canonical link.
+    """
+    return hashlib.blake2b(canonical.encode(), digest_size=8).digest()
+
+def render_link(link, tries):
+    """
+    Put the retry counter back to a link stripped by strip_link() for the
+    pipeline.
+    """
+    if tries <= 1:
+        return link
+    # Parameters may be appended to a link without a query, see
+    # canonicalize_link().
+    sep = '&' if '?' in link or '&' in link else '?'
+    return '%s%s%s=%s' % (link, sep, _TRIES_PARAM, tries)
+
+class LinkFrontier(object):
+    """
+    A disk-backed FIFO queue of pending link records.
+
+    Every record is appended to a LevelDB under a monotonically increasing
+    sequence key, so a submission is durable as soon as it returns. A window of
+    records at the head of the queue is prefetched into memory to serve grabs.
+    Popped records are deleted from the head, which keeps the on-disk sequence
+    keys contiguous: the size of the queue is the distance between the first
+    and the last key, and recovering from a restart needs two seeks only.
+
+    Layout:
+    - b'q' + 8-byte big-endian sequence number -> key + value
+    - b'i' + key -> 8-byte big-endian sequence number, for duplicate check.
+    """
+    _QUEUE_PREFIX = b'q'
+    _INDEX_PREFIX = b'i'
+    _SEQ = struct.Struct('>Q')
+    _KEY_SIZE = struct.Struct('>H')
+
+    def __init__(self, db_path, window_size, sync=False):
+        """
+        Input:
+        - db_path: A string of LevelDB path.
+        - window_size: An integer of how many records prefetched into memory.
+        - sync: A bool of whether to fsync on every submission.
+        """
+        self.db_path = db_path
+        self.window_size = window_size
+        self.sync = sync
+        self.db = None
+        self.window = collections.deque() # Prefetched (sequence, key, value)
+        self.head = 0 # Sequence of the first pending record
+        self.tail = 0 # Sequence assigned to the next submitted record
+        self._next_load = 0 # Sequence of the next record to be prefetched
+
+    def open(self):
+        self.db = plyvel.DB(self.db_path, create_if_missing=True)
+        prefix = self._QUEUE_PREFIX
+        with self.db.iterator(prefix=prefix, include_value=False) as it:
+            for key in it:
+                self.head = self._SEQ.unpack(key[len(prefix):])[0]
+                break
+        with self.db.iterator(prefix=prefix, include_value=False,
+                              reverse=True) as it:
+            for key in it:
+                self.tail = self._SEQ.unpack(key[len(prefix):])[0] + 1
+                break
+        if self.tail < self.head:
+            self.tail = self.head
+        self._next_load = self.head
+        self.window.clear()
+
+    def close(self):
+        if self.db and not self.db.closed:
+            self.db.close()
+        self.window.clear()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def __contains__(self, key):
+        return self.db.get(self._INDEX_PREFIX + key) is not None
+
+    def push(self, records):
+        """
+        Append records whose keys are not pending yet. Return the number of
+        records appended.
+
+        Input:
+        - records: An iterable of (key, value) bytes pairs.
+        """
+        count = 0
+        batch = set()
+        with self.db.write_batch(sync=self.sync) as wb:
+            for key, value in records:
+                index_key = self._INDEX_PREFIX + key
+                if key in batch or self.db.get(index_key) is not None:
+                    continue
+                batch.add(key)
+                seq = self._SEQ.pack(self.tail)
+                wb.put(self._QUEUE_PREFIX + seq,
+                       self._KEY_SIZE.pack(len(key)) + key + value)
+                wb.put(index_key, seq)
+                self.tail += 1
+                count += 1
+        return count
+
+    def pop(self, size):
+        """
+        Remove and return at most size (key, value) pairs from the head of the
+        queue.
+        """
+        size = min(size, len(self))
+        if len(self.window) < size:
+            self._prefetch(max(size, self.window_size))
+        records = []
+        with self.db.write_batch() as wb:
+            for _ in range(min(size, len(self.window))):
+                seq, key, value = self.window.popleft()
+                wb.delete(self._QUEUE_PREFIX + self._SEQ.pack(seq))
+                wb.delete(self._INDEX_PREFIX + key)
+                records.append((key, value))
+                self.head = seq + 1
+        return records
+
+    def _prefetch(self, size):
+        """
+        Load the next batch of pending records into the window.
+        """
+        prefix = self._QUEUE_PREFIX
+        start = prefix + self._SEQ.pack(self._next_load)
+        stop = prefix + self._SEQ.pack(self.tail)
+        with self.db.iterator(start=start, stop=stop) as it:
+            for seq, record in it:
+                if len(self.window) >= size:
+                    break
+                seq = self._SEQ.unpack(seq[len(prefix):])[0]
+                key_size = self._KEY_SIZE.unpack_from(record)[0]
+                key_end = self._KEY_SIZE.size + key_size
+                self.window.append((seq, record[self._KEY_SIZE.size:key_end],
+                                    record[key_end:]))
+                self._next_load = seq + 1
+
+class PriorityFrontier(object):
+    """
+    A frontier of one LinkFrontier per link class, e.g. trending weibo, long
+    texts or user timelines.
+
+    A grab is served from the classes in order of their priorities, FIFO
+    within a class. To keep low priority classes from starving, a class
+    waiting to be served gains one level of priority every aging seconds,
+    counting from when it was last served or became non-empty.
+    """
+    DEFAULT_CLASS = 'UNDEFINED'
+
+    def __init__(self, db_dir, priorities, aging, window_size, sync=False):
+        """
+        Input:
+        - db_dir: A string of the directory of the queues.
+        - priorities: A dict of link class name -> integer priority. Higher
+                      priorities are served first. Links of classes not listed
+                      go to DEFAULT_CLASS.
+        - aging: A float of seconds a waiting class takes to gain a level.
+        - window_size, sync: See LinkFrontier.
+        """
+        self.priorities = dict(priorities)
+        self.priorities.setdefault(self.DEFAULT_CLASS, 0)
+        self.aging = aging
+        self.queues = collections.OrderedDict() # Class name -> LinkFrontier
+        for name in sorted(self.priorities, key=lambda name:
+                           (-self.priorities[name], name)):
+            path = join(db_dir, 'frontier-%s.db' % name.lower())
+            self.queues[name] = LinkFrontier(path, window_size, sync)
+        self.waiting_since = dict() # Class name -> timestamp
+
+    def open(self):
+        now = time.time()
+        for name, queue in self.queues.items():
+            queue.open()
+            self.waiting_since[name] = now
+
+    def close(self):
+        for queue in self.queues.values():
+            queue.close()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def __contains__(self, key):
+        return any(key in queue for queue in self.queues.values())
+
+    def sizes(self):
+        """
+        Return a dict of class name -> number of pending records.
+        """
+        return dict((name, len(queue)) for name, queue in self.queues.items())
+
+    def push(self, link_class, records):
+        """
+        Append records to the queue of the class. Return the number of records
+        appended, see LinkFrontier.push().
+        """
+        if link_class not in self.queues:
+            link_class = self.DEFAULT_CLASS
+        queue = self.queues[link_class]
+        if len(queue) == 0:
+            self.waiting_since[link_class] = time.time()
+        return queue.push(records)
+
+    def priority(self, link_class, now):
+        """
+        Return a float of the priority of the class including its aging.
+        """
+        waited = now - self.waiting_since[link_class]
+        return self.priorities[link_class] + waited / self.aging
+
+    def pop(self, size):
+        """
+        Remove and return at most size (key, value) pairs, taken from the
+        classes of the highest priorities.
+        """
+        now = time.time()
+        names = [name for name, queue in self.queues.items() if len(queue)]
+        names.sort(key=lambda name: self.priority(name, now), reverse=True)
+        records = []
+        for name in names:
+            if len(records) >= size:
+                break
+            records.extend(self.queues[name].pop(size - len(records)))
+            self.waiting_since[name] = now
+        return records
+
+class TopicQueue(object):
+    """
+    A deduplicating FIFO queue of topic links.
+
+    Topic links are re-seeded periodically. A grabbed link is not due again
+    until refresh_interval seconds later, so re-seeding only queues the links
+    which are due and those not seen before. Links already queued are never
+    queued twice. Grabs take O(batch size).
+
+    Links are canonicalized like frontier links, and a link forced by 'uuid',
+    e.g. returned by a downloader which failed on it, is queued even if not
+    due.
+    """
+
+    def __init__(self, refresh_interval):
+        """
+        Input:
+        - refresh_interval: A float of seconds after which a grabbed link is
+                            due again.
+        """
+        self.refresh_interval = refresh_interval
+        self.queue = collections.OrderedDict() # Queued links, as an ordered set
+        self.next_due = dict() # Grabbed link -> timestamp when it is due again
+        self._prune_size = 1024 # Size of next_due to drop the due entries at
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter(self.queue)
+
+    def push(self, links, force=False):
+        """
+        Queue the links which are due. Return a list of the queued links.
+
+        Input:
+        - links: A list of strings of links.
+        - force: A bool of whether to queue the links even if not due.
+        """
+        now = time.time()
+        if len(self.next_due) > self._prune_size:
+            self.next_due = dict((link, due) for link, due in
+                                 self.next_due.items() if due > now)
+            self._prune_size = max(1024, 2 * len(self.next_due))
+        queued = []
+        for link in links:
+            link, _, forced = canonicalize_link(link)
+            if link in self.queue:
+                continue
+            if not (force or forced) and self.next_due.get(link, 0) > now:
+                continue
+            self.queue[link] = None
+            queued.append(link)
+        return queued
+
+    def pop(self, size):
+        """
+        Remove and return at most size links from the head of the queue.
+        """
+        due = time.time() + self.refresh_interval
+        links = []
+        for _ in range(min(size, len(self.queue))):
+            link = self.queue.popitem(last=False)[0]
+            self.next_due[link] = due
+            links.append(link)
+        return links
+
+class RecrawlScheduler(object):
+    """
+    A heap of seed links which are revisited periodically, e.g. the hot weibo
+    rankings and the topic ranking pages.
+
+    Every seed has its own revisit period and is due again period seconds
+    after it was emitted. The period adapts to the content of the seed page
+    reported by the pipeline: it is multiplied by speedup if the content
+    changed since the last visit and by backoff otherwise, bounded by
+    [min_period, max_period]. Only the first report of each emission adapts
+    the period, so that a page downloaded twice does not count twice.
+    Rescheduling a seed leaves its old entry in the heap, which is skipped
+    when it comes out.
+    """
+
+    def __init__(self, min_period, max_period, speedup=0.5, backoff=1.5):
+        """
+        Input:
+        - min_period, max_period: Floats of the bounds of revisit periods in
+                                  seconds.
+        - speedup: A float factor of the period if the content changed.
+        - backoff: A float factor of the period if the content did not change.
+        """
+        self.min_period = min_period
+        self.max_period = max_period
+        self.speedup = speedup
+        self.backoff = backoff
+        self.heap = [] # (due, canonical link)
+        self.seeds = dict() # Canonical link -> dict of the seed state
+
+    def __len__(self):
+        return len(self.seeds)
+
+    def _bound(self, period):
+        return min(max(period, self.min_period), self.max_period)
+
+    def _schedule(self, link, due):
+        self.seeds[link]['due'] = due
+        heapq.heappush(self.heap, (due, link))
+
+    def add(self, link, period, link_type=LinkType.LINK):
+        """
+        Add a seed which is due now. Return False if it is known already.
+
+        Input:
+        - link: A string of the seed link.
+        - period: A float of the initial revisit period in seconds.
+        - link_type: A LinkType of the queue the seed goes to.
+        """
+        link = canonicalize_link(link)[0]
+        if link in self.seeds:
+            return False
+        self.seeds[link] = dict(type=link_type, period=self._bound(period),
+                                due=None, emitted=None, reported=None,
+                                digest=None)
+        self._schedule(link, time.time())
+        return True
+
+    def pop_due(self, now=None):
+        """
+        Return a list of (canonical link, LinkType) of the seeds which are
+        due, and schedule their next visits.
+        """
+        now = time.time() if now is None else now
+        links = []
+        while self.heap and self.heap[0][0] <= now:
+            due, link = heapq.heappop(self.heap)
+            seed = self.seeds[link]
+            if due != seed['due']:
+                continue # Rescheduled
+            seed['emitted'] = now
+            self._schedule(link, now + seed['period'])
+            links.append((link, seed['type']))
+        return links
+
+    def report(self, link, digest):
+        """
+        Adapt the period of a seed to whether the digest of its content
+        changed. Return a bool of whether it changed, or None if the link is
+        not a seed or its last emission was reported already. The first
+        report of a seed only records the digest.
+        """
+        link = canonicalize_link(link)[0]
+        seed = self.seeds.get(link)
+        if seed is None or seed['reported'] == seed['emitted']:
+            return None
+        seed['reported'] = seed['emitted']
+        last, seed['digest'] = seed['digest'], digest
+        if last is None:
+            return False
+        changed = last != digest
+        factor = self.speedup if changed else self.backoff
+        seed['period'] = self._bound(seed['period'] * factor)
+        self._schedule(link, seed['emitted'] + seed['period'])
+        return changed
+
+    def load(self, db):
+        """
+        Restore the state of the seeds added already from a LevelDB written by
+        dump(). Seeds which are no longer added are dropped.
+
+        Input:
+        - db: A plyvel.DB of canonical link -> pickled seed state.
+        """
+        for k, v in db:
+            seed = self.seeds.get(k.decode())
+            if seed is None:
+                continue
+            state = pickle.loads(v)
+            state['period'] = self._bound(state['period'])
+            seed.update(state)
+            self._schedule(k.decode(), seed['due'])
+
+    def dump(self, db):
+        """
+        Replace the content of a LevelDB with the state of the seeds.
+
+        Input:
+        - db: A plyvel.DB to write to.
+        """
+        with db.write_batch() as wb:
+            for k in db.iterator(include_value=False):
+                wb.delete(k)
+            for link, seed in self.seeds.items():
+                state = {key: seed[key] for key in
+                         ('period', 'due', 'emitted', 'reported', 'digest')}
+                wb.put(link.encode(), pickle.dumps(state))
+
 class SchedulerServiceHandler(scheduler_service.Iface):
     """
     A scheduler service.
+
+    The server calls the handler from one thread per connection, so every
+    service method holds self.lock while touching the shared state.
     """
+    _LINK_TRIES = struct.Struct('>H') # Frontier value: tries + canonical link
+    _DEAD_LINKS_VERSION_KEY = b'\x00version'
+    _DEAD_LINKS_VERSION = b'1'
 
     def __init__(self):
         self.logger = None
         self.downloaders = dict() # Keep alive downloaders along with other resources
         self.user_identities = set() # Keep unused user identities
-        self.idle_proxies = set()
-        self.proxies = set() # Keeps all of proxies
-        self.proxy_lock = threading.Lock()
+        self.proxies = ProxyTracker.from_config() # Keeps all of proxies
+        self.lock = threading.RLock() # Guards all of the state above and below
         self.cookies = dict()
         self.idle_cookies = set()
         self._link_batch_size = 0
-        self.topic_links = list()
-        self.links = set()
-        self.ready_links_db = None
+        self.topic_links = TopicQueue(
+            SCHEDULER_CONFIG['topic_link_refresh_interval'])
+        self.recrawl = RecrawlScheduler(SCHEDULER_CONFIG['recrawl_min_period'],
+                                        SCHEDULER_CONFIG['recrawl_max_period'],
+                                        SCHEDULER_CONFIG['recrawl_speedup'],
+                                        SCHEDULER_CONFIG['recrawl_backoff'])
+        self.frontier = None
+        self.links_db = None
         self.dead_links_db = None
-        self.dead_topic_links_db = None
+        self.dead_links_filter = None # Answers "definitely new" in memory
+        self.recrawl_db = None
         self._db_dir = join(dirname(dirname(abspath(__file__))), 'database')
         if not isdir(self._db_dir):
             os.makedirs(self._db_dir)
@@ -56,35 +590,69 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         for ident in SCHEDULER_CONFIG['user_identity']:
             ident = ttypes.UserIdentity(ident['name'], ident['pwd'])
             self.user_identities.add(ident)
+        self.frontier = PriorityFrontier(
+            self._db_dir, SCHEDULER_CONFIG['frontier_priorities'],
+            SCHEDULER_CONFIG['frontier_aging'],
+            SCHEDULER_CONFIG['frontier_window_size'],
+            SCHEDULER_CONFIG['frontier_sync'])
+        self.frontier.open()
+        self._migrate_frontier()
         self.links_db = plyvel.DB(join(self._db_dir, 'links.db'),
                                         create_if_missing=True)
+        legacy_links = list()
+        topic_links = list()
         for k, v in self.links_db:
             ltype = pickle.loads(v)
             link = pickle.loads(k)
             if ltype == LinkType.LINK:
-                self.links.add(link)
+                # Links saved by older versions. Move them into the frontier.
+                legacy_links.append(link)
+                self.links_db.delete(k)
             elif ltype == LinkType.TOPIC_LINK:
-                self.topic_links.append(link)
+                topic_links.append(link)
             else:
                 self.logger.error('Find unkown type link (%s, %s) when recover links' % (link, ltype))
+        self.topic_links.push(topic_links)
+        if legacy_links:
+            self.submit_links(legacy_links)
+            self.logger.info('Migrate %s links into frontier' % len(legacy_links))
         self.dead_links_db = plyvel.DB(join(self._db_dir, 'dead_links.db'),
                                         create_if_missing=True)
-        self.dead_topic_links_db = plyvel.DB(join(self._db_dir, 'dead_topic_links.db'),
-                                            create_if_missing=True)
+        self._migrate_dead_links()
+        self._init_dead_links_filter()
+        links, topic_links = sinaspider.sina_pipeline.seed_links(
+            DOWNLOADER_CONFIG['num_topic_pages'])
+        for link in links:
+            self.recrawl.add(link, SCHEDULER_CONFIG['recrawl_link_period'])
+        for link in topic_links:
+            self.recrawl.add(link, SCHEDULER_CONFIG['recrawl_topic_link_period'],
+                             LinkType.TOPIC_LINK)
+        self.recrawl_db = plyvel.DB(join(self._db_dir, 'recrawl.db'),
+                                    create_if_missing=True)
+        self.recrawl.load(self.recrawl_db)
+        self._update_frontier_metrics()
+        _TOPIC_LINKS.set(len(self.topic_links))
 
+    @sinaspider.utils.synchronized
     def close(self):
         for k, v in self.links_db:
             self.links_db.delete(k)
-        for link in self.links:
-            self.links_db.put(pickle.dumps(link), pickle.dumps(LinkType.LINK))
         for link in self.topic_links:
             self.links_db.put(pickle.dumps(link), pickle.dumps(LinkType.TOPIC_LINK))
+        self.logger.info('%s links left, %s topic links left' % (len(self.frontier),
+                        len(self.topic_links)))
+        self.frontier.close()
         self.links_db.close()
+        self.dead_links_filter.dump(self._dead_links_filter_path())
+        self.logger.info('Dead links filter: %s links, expected error rate %s' %
+                         (len(self.dead_links_filter),
+                          self.dead_links_filter.error_rate()))
         self.dead_links_db.close()
-        self.dead_topic_links_db.close()
-        self.logger.info('%s links left, %s topic links left' % (len(self.links), 
-                        len(self.topic_links)))
+        self.recrawl.dump(self.recrawl_db)
+        self.recrawl_db.close()
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def register_downloader(self, name):
         """
         Register the downloader along with the name.
@@ -99,6 +667,8 @@ class SchedulerServiceHandler(scheduler_service.Iface):
             self.logger.warn('Downloader %s has been registered.' % name)
         return ttypes.RetStatus.SUCCESS
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def unregister_downloader(self, name):
         """
         Unregister the named downloader. Reclaim all of resources of the downloader.
@@ -117,6 +687,8 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         del self.downloaders[name]
         return ttypes.RetStatus.SUCCESS
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def request_user_identity(self, name):
         """
         Get a pair of user name and password. For now, each pair of user name and
@@ -136,6 +708,8 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         self.logger.info('Allocate %s for %s' % (ident, name))
         return ident 
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def resign_user_identity(self, pair, name):
         """
         Give up the user identity.
@@ -151,23 +725,33 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         self.logger.info('%s renounces %s' % (name, pair))
         return ttypes.RetStatus.SUCCESS
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def grab_links(self, size):
         """
         Grab a batch of links.
 
-        In FIFO order.
+        In order of the priorities of link classes, FIFO within a class.
         Parameters:
          - size
         """
         self._link_batch_size = size
+        self._emit_due_seeds()
         ret_links = []
-        for _ in range(min(size, len(self.links))):
-            link = self.links.pop()
-            ret_links.append(link)
-            self.dead_links_db.put(pickle.dumps(link), b'')
-        self.logger.info('%s links left' % len(self.links))
+        with self.dead_links_db.write_batch() as wb:
+            for key, value in self.frontier.pop(size):
+                tries = self._LINK_TRIES.unpack_from(value)[0]
+                link = value[self._LINK_TRIES.size:].decode()
+                ret_links.append(render_link(link, tries))
+                wb.put(key, b'')
+                self.dead_links_filter.add(key)
+        self.logger.info('%s links left' % len(self.frontier))
+        self._update_frontier_metrics()
+        self._update_dead_links_filter_metrics()
         return ret_links 
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def submit_links(self, links):
         """
         Submit a batch of links.
@@ -175,16 +759,13 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         Parameters:
          - links
         """
-        count = 0
-        for link in links:
-            if link in self.links or self.dead_links_db.get(pickle.dumps(link)) == b'':
-                self.logger.debug('bypass: %s' % link)
-                continue
-            self.links.add(link)
-            count += 1
+        count = self._push_links(links)
         self.logger.info('Receive %s links' % count)
+        self._update_frontier_metrics()
         return ttypes.RetStatus.SUCCESS
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def grab_topic_links(self, size):
         """
         Grab a batch of links.
@@ -193,49 +774,114 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         Parameters:
          - size
         """
-        ret_links = []
-        for _ in range(min(size, len(self.topic_links))):
-            link = self.topic_links.pop(0)
-            ret_links.append(link)
+        self._emit_due_seeds()
+        ret_links = self.topic_links.pop(size)
         self.logger.info('%s topic links left.' % len(self.topic_links))
+        _TOPIC_LINKS.set(len(self.topic_links))
         return ret_links
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def submit_topic_links(self, links):
         """
-        Submit a batch of links.
+        Submit a batch of links. Links grabbed recently are ignored unless
+        forced, see TopicQueue.
 
         Parameters:
          - links
         """
-        _links = []
-        for link in links:
-            if 'p/100808' in link and \
-                self.dead_topic_links_db.get(pickle.dumps(link)) == b'':
-                continue
-            _links.append(link)
-        self.topic_links.extend(_links)
+        _links = self.topic_links.push(links)
         self.logger.info('Receive %s topic links' % len(_links))
+        _TOPIC_LINKS.set(len(self.topic_links))
         return ttypes.RetStatus.SUCCESS
  
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
+    def report_seed(self, link, digest):
+        """
+        Report the digest of the content of a downloaded seed page. The
+        scheduler revisits a seed more often if its content keeps changing,
+        see RecrawlScheduler.
+
+        Parameters:
+         - link
+         - digest
+        """
+        changed = self.recrawl.report(link, digest)
+        if changed is None:
+            self.logger.debug('Not a seed or reported already: %s' % link)
+            return ttypes.RetStatus.FAILED
+        _SEED_REPORTS.inc(changed='true' if changed else 'false')
+        return ttypes.RetStatus.SUCCESS
+
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
+    def request_proxy(self, name):
+        """
+        Request a living proxy.
+
+        Parameters:
+         - name
+        """
+        proxy = self.proxies.choose()
+        if proxy is None:
+            self.logger.warn('No proxies for %s' % name)
+            return ttypes.ProxyAddress('NULL', 0)
+        self.logger.info('Allocate %s for %s' % (proxy, name))
+        return proxy
+
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def request_proxies(self, name, size):
         """
-        Request a batch of living proxies.
+        Request a batch of living proxies, drawn by their health.
 
         Parameters:
          - name
          - size
         """
         self.logger.info('%s requests %s proxies' % (name, size))
-        proxies = list()
-        if len(self.idle_proxies) < size:
-            self.idle_proxies.update(self.proxies)
-        for _ in range(min(len(self.idle_proxies), size)):
-            proxy = self.idle_proxies.pop()
-            proxies.append(proxy)
-        left_size = len(self.idle_proxies)
-        self.logger.info('%s proxies left' % left_size)
+        proxies = self.proxies.sample(size)
+        self.logger.info('%s healthy proxies of %s' % (
+            len(self.proxies.healthy()), len(self.proxies)))
         return  proxies
+
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
+    def resign_proxy(self, addr, name):
+        """
+        Resign a proxy. If a downloader find out the proxy is dead, tell the
+        scheduler. The proxy is quarantined and drawn less afterwards, see
+        ProxyTracker.
+
+        Parameters:
+         - addr
+         - name
+        """
+        if addr not in self.proxies:
+            self.logger.debug('%s resigns unknown proxy %s' % (name, addr))
+            return ttypes.RetStatus.FAILED
+        self.proxies.quarantine(addr)
+        self.logger.info('%s resigns %s' % (name, addr))
+        self._update_proxy_metrics()
+        return ttypes.RetStatus.SUCCESS
+
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
+    def submit_proxies(self, addrs):
+        """
+        Submit a batch of proxies to scheduler.
+
+        Parameters:
+         - addrs
+        """
+        count = self.proxies.add(addrs)
+        self.logger.info('Receive %s proxies' % count)
+        self._update_proxy_metrics()
+        return ttypes.RetStatus.SUCCESS
         
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def request_cookie(self, name):
         """
         Request a cookie.
@@ -253,6 +899,8 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         self.logger.info('Allocate %s for %s' % (cookie, name))
         return cookie
 
+    @sinaspider.metrics.timed(_RPC_SECONDS)
+    @sinaspider.utils.synchronized
     def submit_cookies(self, cookies):
         """
         Submit cookies.
@@ -268,6 +916,155 @@ class SchedulerServiceHandler(scheduler_service.Iface):
         return ttypes.RetStatus.SUCCESS
 
     ## Utility methods
+    def _push_links(self, links, force=False):
+        """
+        Push links into the frontier. Return the number of links pushed.
+
+        Input:
+        - links: A list of strings of links.
+        - force: A bool of whether to push dead links as well.
+        """
+        records = dict() # Link class -> records
+        for link in links:
+            canonical, tries, forced = canonicalize_link(link)
+            key = link_fingerprint(canonical)
+            link = strip_link(link)
+            # Retries and forced recrawls are expected to be dead already.
+            if not (force or forced) and tries <= 1 and self._is_dead_link(key):
+                self.logger.debug('bypass: %s' % link)
+                continue
+            link_class = sinaspider.sina_pipeline.classify_link(link).name
+            records.setdefault(link_class, []).append(
+                (key, self._LINK_TRIES.pack(tries) + link.encode()))
+        count = 0
+        for link_class, class_records in records.items():
+            count += self.frontier.push(link_class, class_records)
+        return count
+
+    def _emit_due_seeds(self):
+        """
+        Push the seeds which are due into the frontier or the topic queue.
+        """
+        links = []
+        topic_links = []
+        for link, link_type in self.recrawl.pop_due():
+            if link_type == LinkType.TOPIC_LINK:
+                topic_links.append(link)
+            else:
+                links.append(link)
+        if links:
+            count = self._push_links(links, force=True)
+            self.logger.info('Emit %s seed links' % count)
+            self._update_frontier_metrics()
+        if topic_links:
+            count = len(self.topic_links.push(topic_links, force=True))
+            self.logger.info('Emit %s seed topic links' % count)
+            _TOPIC_LINKS.set(len(self.topic_links))
+
+    def _update_proxy_metrics(self):
+        healthy = len(self.proxies.healthy())
+        _PROXIES.set(healthy, state='healthy')
+        _PROXIES.set(len(self.proxies) - healthy, state='quarantined')
+
+    def _update_frontier_metrics(self):
+        for link_class, size in self.frontier.sizes().items():
+            _FRONTIER_LINKS.set(size, link_class=link_class)
+
+    def _update_dead_links_filter_metrics(self):
+        _DEAD_LINKS_FILTER_SIZE.set(len(self.dead_links_filter))
+        _DEAD_LINKS_FILTER_ERROR_RATE.set(self.dead_links_filter.error_rate())
+
+    def _migrate_frontier(self):
+        """
+        Move links of the single FIFO frontier of older versions into the
+        queues of their classes.
+        """
+        path = join(self._db_dir, 'frontier.db')
+        if not isdir(path):
+            return
+        self.logger.info('Migrating frontier to link classes...')
+        legacy = LinkFrontier(path, SCHEDULER_CONFIG['frontier_window_size'])
+        legacy.open()
+        count = 0
+        while len(legacy):
+            records = dict()
+            for key, value in legacy.pop(10000):
+                link = value[self._LINK_TRIES.size:].decode()
+                link_class = sinaspider.sina_pipeline.classify_link(link).name
+                records.setdefault(link_class, []).append((key, value))
+            for link_class, class_records in records.items():
+                count += self.frontier.push(link_class, class_records)
+        legacy.close()
+        plyvel.destroy_db(path)
+        self.logger.info('Migrate %s links of frontier' % count)
+
+    def _migrate_dead_links(self):
+        """
+        Rewrite pickled link keys written by older versions to fingerprints.
+        """
+        db = self.dead_links_db
+        if db.get(self._DEAD_LINKS_VERSION_KEY) == self._DEAD_LINKS_VERSION:
+            return
+        self.logger.info('Migrating dead links to fingerprints...')
+        count = 0
+        wb = db.write_batch()
+        for key in db.iterator(include_value=False):
+            try:
+                link = pickle.loads(key)
+            except Exception:
+                continue
+            if type(link) is not str:
+                continue
+            wb.delete(key)
+            wb.put(link_fingerprint(canonicalize_link(link)[0]), b'')
+            count += 1
+            if count % 10000 == 0:
+                wb.write()
+                wb = db.write_batch()
+        wb.put(self._DEAD_LINKS_VERSION_KEY, self._DEAD_LINKS_VERSION)
+        wb.write()
+        self.logger.info('Migrate %s dead links' % count)
+
+    def _dead_links_filter_path(self):
+        return join(self._db_dir, 'dead_links.bloom')
+
+    def _init_dead_links_filter(self):
+        """
+        Restore the dead links filter from the snapshot written by close(), or
+        rebuild it from dead_links.db. The snapshot is removed once loaded so
+        that a crash never leaves a stale one behind.
+        """
+        self.dead_links_filter = sinaspider.utils.BloomFilter(
+            SCHEDULER_CONFIG['dead_links_filter_capacity'],
+            SCHEDULER_CONFIG['dead_links_filter_error_rate'])
+        path = self._dead_links_filter_path()
+        if self.dead_links_filter.load(path):
+            self.logger.info('Load dead links filter with %s links' %
+                             len(self.dead_links_filter))
+        else:
+            self.logger.info('Rebuilding dead links filter...')
+            for key in self.dead_links_db.iterator(include_value=False):
+                self.dead_links_filter.add(key)
+            self.logger.info('Rebuild dead links filter with %s links' %
+                             len(self.dead_links_filter))
+        if os.path.isfile(path):
+            os.remove(path)
+        self._update_dead_links_filter_metrics()
+
+    def _is_dead_link(self, key):
+        """
+        Return True if the key was in dead_links.db. Only keys which hit the
+        filter are looked up on disk.
+        """
+        if key not in self.dead_links_filter:
+            _DEAD_LINK_LOOKUPS.inc(result='negative')
+            return False
+        _DEAD_LINK_LOOKUPS.inc(result='positive')
+        if self.dead_links_db.get(key) == b'':
+            return True
+        _DEAD_LINK_LOOKUPS.inc(result='false_positive')
+        return False
+
     def update_proxies_callback(self):
         self.logger.info('Start updating proxies...')
         ret = requests.get(SCHEDULER_CONFIG['proxy_provider'] % SCHEDULER_CONFIG['proxy_pool_size'])
@@ -276,8 +1073,11 @@ class SchedulerServiceHandler(scheduler_service.Iface):
             addr, port = entry.split(':')
             proxy = ttypes.ProxyAddress(addr, int(port))
             new_proxies.add(proxy)
-        self.logger.info('Number of new proxies: %s' % len(new_proxies))
-        self.proxies = new_proxies
+        with self.lock:
+            count = self.proxies.add(new_proxies)
+            self.proxies.prune(SCHEDULER_CONFIG['proxy_pool_size'])
+            self._update_proxy_metrics()
+        self.logger.info('Number of new proxies: %s' % count)
 
 class SchedulerServerDaemon(sinaspider.utils.Daemon, TServer.TServer):
     """
@@ -298,6 +1098,10 @@ class SchedulerServerDaemon(sinaspider.utils.Daemon, TServer.TServer):
         TServer.TServer.__init__(self, processor, server_transport,
                                  tfactory, pfactory)
         self._is_alive = False
+        self._clients = set() # Open client connections
+        self._clients_lock = threading.Lock()
+        self._connection_slots = threading.BoundedSemaphore(
+            SCHEDULER_CONFIG['server_max_connections'])
         self.timer = sinaspider.utils.RepeatingTimer(SCHEDULER_CONFIG['proxy_interval'], self.handler.update_proxies_callback)
 
     def run(self):
@@ -305,6 +1109,7 @@ class SchedulerServerDaemon(sinaspider.utils.Daemon, TServer.TServer):
         signal.signal(signal.SIGINT, self.sig_handler)
         sinaspider.log.configure_logger('.scheduler.log')
         logger = logging.getLogger(self.name)
+        sinaspider.metrics.start(self.name)
         self.handler.init()
         self.timer.start()
         self._is_alive = True
@@ -318,34 +1123,51 @@ class SchedulerServerDaemon(sinaspider.utils.Daemon, TServer.TServer):
                     client = self.serverTransport.accept()
                     if not client:
                         continue
-                    client.handle.settimeout(20)
-                    itrans = self.inputTransportFactory.getTransport(client)
-                    otrans = self.outputTransportFactory.getTransport(client)
-                    iprot = self.inputProtocolFactory.getProtocol(itrans)
-                    oprot = self.outputProtocolFactory.getProtocol(otrans)
-                    try:
-                        while self._is_alive:
-                            self.processor.process(iprot, oprot)
-                    except TTransport.TTransportException:
-                        pass
-                    except Exception as e:
-                        logger.exception(e)
-                        self.serverTransport.handle.shutdown(2)
-                        self.serverTransport.handle.close()
-                        itrans.close()
-                        otrans.close()
-                        break
-                    itrans.close()
-                    otrans.close()
+                    self._connection_slots.acquire()
+                    thread = threading.Thread(target=self.serve_client,
+                                              args=(client,))
+                    thread.daemon = True
+                    thread.start()
             except Exception:
                 if self._is_alive:
                     logger.exception(
                         'Failed. Restarting in %s seconds...' %
                         interval)
                     time.sleep(interval)
+        with self._clients_lock:
+            for client in self._clients:
+                client.close()
         self.handler.close()
+        sinaspider.metrics.stop()
         logger.info('Service stopped.')
 
+    def serve_client(self, client):
+        """
+        Serve requests from a client connection until it is closed. Clients
+        are expected to keep their connections open.
+        """
+        logger = logging.getLogger(self.name)
+        client.handle.settimeout(SCHEDULER_CONFIG['server_client_timeout'])
+        itrans = self.inputTransportFactory.getTransport(client)
+        otrans = self.outputTransportFactory.getTransport(client)
+        iprot = self.inputProtocolFactory.getProtocol(itrans)
+        oprot = self.outputProtocolFactory.getProtocol(otrans)
+        with self._clients_lock:
+            self._clients.add(client)
+        try:
+            while self._is_alive:
+                self.processor.process(iprot, oprot)
+        except (TTransport.TTransportException, socket.timeout, OSError):
+            pass # Closed by the client, or idle for too long.
+        except Exception:
+            logger.exception('Exception while serving a client.')
+        finally:
+            with self._clients_lock:
+                self._clients.discard(client)
+            itrans.close()
+            otrans.close()
+            self._connection_slots.release()
+
     def sig_handler(self, sig, func):
         self._is_alive = False
         self.serverTransport.close()
@@ -363,11 +1185,6 @@ class SchedulerServiceClient(object):
         """
         self.queue = queue
         self.name = self.__class__.__name__
-        self.transport = TSocket.TSocket(SCHEDULER_CONFIG['addr'],
-                                         SCHEDULER_CONFIG['port'])
-        self.transport = TTransport.TBufferedTransport(self.transport)
-        protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
-        self.client = scheduler_service.Client(protocol)
         self.running = False
 
     def run(self):
@@ -377,29 +1194,33 @@ class SchedulerServiceClient(object):
         logger = logging.getLogger(self.name)
         logger.info('Starting %s' % self.name)
         interval = SCHEDULER_CONFIG['client_failover_interval']
+        pool = sinaspider.connection_pool.SchedulerConnectionPool.instance()
         self.running = True
         while self.running:
             try:
-                links, dtype = self.queue.get()
-                # Need to close the connection later to avoid unparallel
-                # threading.
-                if not self.transport.isOpen():
-                    self.transport.open()
-                if dtype == DownloaderType.LINK_DOWNLOADER:
-                    self.client.submit_links(links)
-                elif dtype == DownloaderType.TOPIC_DOWNLOADER:
-                    self.client.submit_topic_links(links)
-                self.transport.close()
-                logger.debug('Submit links: %s' % links)
-            except TTransport.TTransportException:
+                method, args = self.queue.get(timeout=1)
+                pool.call(method, *args)
+                logger.debug('%s: %s' % (method, args))
+            except queue.Empty:
+                continue
+            except sinaspider.connection_pool.CONNECTION_ERRORS:
                 logger.exception('Failed. Restarting in %s seconds' % interval)
                 time.sleep(interval)
-        if self.transport.isOpen():
-            self.transport.close()
+        pool.close()
         logger.info('%s stopped.' % self.name)
 
     def submit_links(self, links, dtype=DownloaderType.LINK_DOWNLOADER):
-        self.queue.put((links, dtype))
+        if dtype == DownloaderType.TOPIC_DOWNLOADER:
+            self.queue.put(('submit_topic_links', (links,)))
+        else:
+            self.queue.put(('submit_links', (links,)))
+
+    def report_seed(self, link, digest):
+        """
+        Report the digest of the content of a seed page, see
+        SchedulerServiceHandler.report_seed().
+        """
+        self.queue.put(('report_seed', (link, digest)))
 
     def stop(self):
         """
@@ -106,5 +106,11 @@ service scheduler_service{
     /**
      * Submit cookies
      */
-    RetStatus submit_cookies(1: required list<Cookie> cookies)
+    RetStatus submit_cookies(1: required list<Cookie> cookies),
+
+    /**
+     * Report the digest of the content of a downloaded seed page. The scheduler
+     * revisits a seed more often if its content keeps changing.
+     */
+    RetStatus report_seed(1: required string link, 2: required string digest)
 }
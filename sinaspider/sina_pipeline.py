@@ -1,19 +1,24 @@
 
 import aenum
 from bs4 import BeautifulSoup
+import hashlib
+import html
 import json
 import logging
+import lxml.etree
+import lxml.html
 import os
 from os.path import dirname, join, abspath, isdir
-import pickle
 import plyvel
 import re
+import struct
 import urllib.parse
 import time
 
 from sinaspider.pipeline import Pipeline, PipelineNode
 from sinaspider.config import  PIPELINE_CONFIG
 from sinaspider.downloader import DownloaderType
+from sinaspider.store import StorageWriter, _WRITE_SECONDS, _BATCH_RECORDS
 
 ### Links
 _USER_TWEETS_LINKS = {
@@ -54,19 +59,74 @@ _TOPIC_PAGE_LINK =  'https://d.weibo.com/100803?pids=Pl_Discover_Pt6Rank__5&cfs=
                     '&Pl_Discover_Pt6Rank__5_filter=hothtlist_type=1&Pl_Discover_Pt6Rank__5_page=%s'
 _TOPIC_LINK = 'https://weibo.com/p/%s?from=faxian_huati'
 
+def seed_links(num_topic_pages):
+    """
+    Return a tuple of (links, topic links) the crawl starts from and revisits:
+    the trending weibo and the hot weibo rankings, and the topic ranking pages.
+    """
+    links = [_TRENDING_TWEETS_LINK]
+    for i in range(1, 21):
+        links.append(_HOT_WEIBO_RANK_HOURLY % (i-1, i))
+        links.append(_HOT_WEIBO_RANK_DAYLY % (i-1, i))
+    topic_links = [_TOPIC_PAGE_LINK % idx for idx in
+                   range(1, num_topic_pages+1)]
+    return (links, topic_links)
+
 
 ### Data Structures
 
 class Serializable(object):
+    """
+    Base of entities. Subclasses declare their fields in __slots__, so
+    instances have no __dict__ and take less memory.
+    """
+    __slots__ = ()
+
+    @property
+    def _fields(self):
+        return self.__slots__
+
     def serialize(self):
         """
-        Serialize the instance to bytes. To deserialize:
+        Serialize the instance to bytes by its RecordCodec. To deserialize:
+
+            object = deserialize(b'...')
+        """
+        return codec_of(self).encode_value(self)
 
-            object = pickle.loads(b'...')
+    def record(self):
         """
-        return pickle.dumps(self)
+        Return the (key, value) of the instance in LevelDB.
+        """
+        codec = codec_of(self)
+        return (codec.encode_key(self), codec.encode_value(self))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def __setstate__(self, state):
+        if type(state) is dict:
+            # Pickled before the entities were slotted.
+            self.__init__()
+            for name, value in state.items():
+                if name in self._fields:
+                    setattr(self, name, value)
+            return
+        for name, value in zip(self._fields, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        L = ['%s=%s' % (name, getattr(self, name)) for name in self._fields]
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(L))
 
 class SinaUser(Serializable):
+    __slots__ = ('uid', 'nick_name', 'gender', 'location', 'brief', 'birth',
+                 'labels', 'homepage', 'num_tweets', 'num_followees',
+                 'num_fans', 'vip_level', 'page_id', 'others')
+
     def __init__(self):
         self.uid = 0 
         self.nick_name = ''
@@ -82,13 +142,13 @@ class SinaUser(Serializable):
         self.vip_level = 0 # 0 indicates not a VIP
         self.page_id = ''
         self.others = dict()
-    
-    def __repr__(self):
-        L = ['%s=%s' % (key, value)
-            for key, value in self.__dict__.items()]
-        return '%s(%s)' % (self.__class__.__name__, ', '.join(L))
 
 class SinaTweet(Serializable):
+    __slots__ = ('tid', 'uid', 'otid', 'ouid', 'content', 'time',
+                 'coordinates', 'platform', 'num_comments', 'num_loves',
+                 'num_reposts', 'num_topics', 'num_atnames', 'num_links',
+                 'num_videos', 'num_images')
+
     def __init__(self):
         self.tid = 0 # Tweet ID
         self.uid = 0 
@@ -107,15 +167,13 @@ class SinaTweet(Serializable):
         self.num_videos = 0
         self.num_images = 0
 
-    def __repr__(self):
-        L = ['%s=%s' % (key, value)
-            for key, value in self.__dict__.items()]
-        return '%s(%s)' % (self.__class__.__name__, ', '.join(L))
-
     def json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.as_dict())
 
 class SinaTopic(Serializable):
+    __slots__ = ('tid', 'brief', 'num_reads', 'num_disscuss', 'num_fans',
+                 'name', 'labels', 'location')
+
     def __init__(self):
         self.tid = ''
         self.brief = ''
@@ -126,23 +184,17 @@ class SinaTopic(Serializable):
         self.labels = ''
         self.location = ''
 
-    def __repr__(self):
-        L = ['%s=%s' % (key, value)
-            for key, value in self.__dict__.items()]
-        return '%s(%s)' % (self.__class__.__name__, ', '.join(L))
-
 class SinaTopicReads(Serializable):
+    __slots__ = ('tid', 'timestamp', 'num_reads')
+
     def __init__(self):
         self.tid = ''
         self.timestamp = 0
         self.num_reads = 0
-    
-    def __repr__(self):
-        L = ['%s=%s' % (key, value)
-            for key, value in self.__dict__.items()]
-        return '%s(%s)' % (self.__class__.__name__, ', '.join(L))
 
 class SinaFlow(Serializable):
+    __slots__ = ('tag', 'a', 'b')
+
     def __init__(self):
         """
         A flow from a to b.
@@ -155,6 +207,154 @@ class SinaFlow(Serializable):
         return '%s(%s)' % (self.__class__.__name__, L)
 
 
+### Record codecs
+
+class RecordCodec(object):
+    """
+    A versioned schema which encodes an entity to a LevelDB record and back.
+
+    A value is a 2-byte header of type id and version, then the fields in
+    schema order. Field kinds:
+    - 'q': A signed 64-bit integer.
+    - 's': A utf-8 string prefixed by its 4-byte length.
+    - 'v': An integer or a string, prefixed by a 1-byte tag.
+    - 'j': A json document, stored as 's'.
+
+    A key is the key prefix followed by the key fields. Integers of keys are
+    unsigned big-endian so that ids scan in order, and a string key field is
+    stored as is, so it must be the last one. A 'v' key field is prefixed by
+    its tag.
+    """
+    _HEADER = struct.Struct('>BB')
+    _INT = struct.Struct('>q')
+    _UINT = struct.Struct('>Q')
+    _SIZE = struct.Struct('>I')
+    _TAG_INT = 0
+    _TAG_STR = 1
+
+    def __init__(self, cls, type_id, version, fields, key_prefix, key_fields):
+        """
+        Input:
+        - cls: A Serializable class.
+        - type_id: An integer of the type id stored in values.
+        - version: An integer of the schema version.
+        - fields: A list of (attribute, kind) of the value.
+        - key_prefix: Bytes of the key prefix.
+        - key_fields: A list of attributes of the key.
+        """
+        self.cls = cls
+        self.type_id = type_id
+        self.version = version
+        self.fields = fields
+        self.key_prefix = key_prefix
+        self.key_fields = key_fields
+        self.header = self._HEADER.pack(type_id, version)
+
+    def encode_key(self, entity):
+        parts = [self.key_prefix]
+        kinds = dict(self.fields)
+        for name in self.key_fields:
+            value = getattr(entity, name)
+            if kinds[name] == 'v':
+                # Keep integers and strings apart.
+                parts.append(bytes([self._TAG_INT if type(value) is int
+                                    else self._TAG_STR]))
+            if type(value) is int:
+                parts.append(self._UINT.pack(value))
+            else:
+                parts.append(value.encode())
+        return b''.join(parts)
+
+    def encode_value(self, entity):
+        parts = [self.header]
+        for name, kind in self.fields:
+            value = getattr(entity, name)
+            if kind == 'q':
+                parts.append(self._INT.pack(value))
+            elif kind == 'v' and type(value) is int:
+                parts.append(bytes([self._TAG_INT]))
+                parts.append(self._INT.pack(value))
+            else:
+                if kind == 'j':
+                    value = json.dumps(value)
+                elif kind == 'v':
+                    parts.append(bytes([self._TAG_STR]))
+                data = value.encode()
+                parts.append(self._SIZE.pack(len(data)))
+                parts.append(data)
+        return b''.join(parts)
+
+    def decode_value(self, data):
+        entity = self.cls()
+        offset = self._HEADER.size
+        for name, kind in self.fields:
+            if kind == 'v':
+                tag = data[offset]
+                offset += 1
+                kind = 'q' if tag == self._TAG_INT else 's'
+            if kind == 'q':
+                value = self._INT.unpack_from(data, offset)[0]
+                offset += self._INT.size
+            else:
+                size = self._SIZE.unpack_from(data, offset)[0]
+                offset += self._SIZE.size
+                value = data[offset:offset + size].decode()
+                offset += size
+                if kind == 'j':
+                    value = json.loads(value)
+            setattr(entity, name, value)
+        return entity
+
+
+_CODECS = dict() # (type id, version) -> RecordCodec
+_LATEST_CODECS = dict() # class -> RecordCodec of the latest version
+
+def register_codec(codec):
+    """
+    Register a codec. Values are decoded by any registered version and
+    encoded by the latest one.
+    """
+    _CODECS[(codec.type_id, codec.version)] = codec
+    latest = _LATEST_CODECS.get(codec.cls)
+    if latest is None or latest.version < codec.version:
+        _LATEST_CODECS[codec.cls] = codec
+
+def codec_of(entity):
+    return _LATEST_CODECS[type(entity)]
+
+def deserialize(data):
+    """
+    Return the entity encoded in the value bytes.
+    """
+    type_id, version = RecordCodec._HEADER.unpack_from(data)
+    return _CODECS[(type_id, version)].decode_value(data)
+
+register_codec(RecordCodec(SinaUser, 1, 1, [
+    ('uid', 'q'), ('nick_name', 's'), ('gender', 's'), ('location', 's'),
+    ('brief', 's'), ('birth', 's'), ('labels', 's'), ('homepage', 's'),
+    ('num_tweets', 'q'), ('num_followees', 'q'), ('num_fans', 'q'),
+    ('vip_level', 'q'), ('page_id', 's'), ('others', 'j')],
+    b'', ['uid']))
+register_codec(RecordCodec(SinaTweet, 2, 1, [
+    ('tid', 'q'), ('uid', 'q'), ('otid', 'q'), ('ouid', 'q'),
+    ('content', 's'), ('time', 'q'), ('coordinates', 's'), ('platform', 's'),
+    ('num_comments', 'q'), ('num_loves', 'q'), ('num_reposts', 'q'),
+    ('num_topics', 'q'), ('num_atnames', 'q'), ('num_links', 'q'),
+    ('num_videos', 'q'), ('num_images', 'q')],
+    b'', ['tid']))
+register_codec(RecordCodec(SinaTopic, 3, 1, [
+    ('tid', 's'), ('brief', 's'), ('num_reads', 'q'), ('num_disscuss', 'q'),
+    ('num_fans', 'q'), ('name', 's'), ('labels', 's'), ('location', 's')],
+    b'topic', ['tid']))
+register_codec(RecordCodec(SinaTopicReads, 4, 1, [
+    ('tid', 's'), ('timestamp', 'q'), ('num_reads', 'q')],
+    b'reads', ['timestamp', 'tid']))
+# The tag is the integer id of the original tweet of a repost, or empty.
+register_codec(RecordCodec(SinaFlow, 5, 1, [
+    ('a', 'v'), ('b', 'v'), ('tag', 'v')],
+    b'', ['a']))
+
+
 ### Pipeline definitions
 class SinaResponseType(aenum.Enum):
     TRENDING_WEIBO = 0          # d.weibo.com
@@ -169,12 +369,17 @@ class SinaResponseType(aenum.Enum):
     UNDEFINED = aenum.auto()    
 
 class SinaResponse(object):
-    def __init__(self, res_type, response):
+    def __init__(self, res_type, page):
+        """
+        Input:
+        - res_type: A SinaResponseType.
+        - page: A FetchedPage.
+        """
         self.type = res_type
-        self.response = response
+        self.page = page
     
     def __repr__(self):
-        return '<%s, %s>' % (self.type, self.response)
+        return '<%s, %s>' % (self.type, self.page)
 
 class SinaPipeline(Pipeline):
     """
@@ -197,11 +402,17 @@ class SinaPipeline(Pipeline):
                         \-------->TrendingTopicPageProcessor--->LevelDBWriter
 
     """
-    def __init__(self, queue):
+    def __init__(self, queue, db_dir=None):
+        """
+        Input:
+        - queue: A queue of pages, see Pipeline.
+        - db_dir: A string of the database directory. Default to 'database'
+                  under the project root.
+        """
         router = Router()
         Pipeline.__init__(self, self.__class__.__name__,
                           router, queue)
-        wtlevdb = LevelDBWriter()
+        wtlevdb = LevelDBWriter(db_dir)
         pltextweibo = LongTextWeiboProcessor()
         pltextweibo.forward(wtlevdb)
         ptrweibo = TrendingWeiboProcessor()
@@ -225,38 +436,55 @@ class SinaPipeline(Pipeline):
         router.forward(puhome)
         router.forward(ptopic)
         router.forward(pptopic)
+        self.storage_writer = StorageWriter(wtlevdb.db_dir)
+        wtlevdb.register_storage_writer(self.storage_writer)
+
+    def open(self):
+        self.storage_writer.start()
+
+    def close(self):
+        logger = logging.getLogger(self.name)
+        self.storage_writer.stop()
+        logger.info('Storage writer: %s' % self.storage_writer.metrics())
+
 
+def classify_link(link):
+    """
+    Return the SinaResponseType of the page of a link. The scheduler uses it to
+    prioritize links and the Router to route downloaded pages.
+    """
+    url = urllib.parse.urlsplit(link)
+    if url.netloc == 'd.weibo.com':
+        if 'mblog/mbloglist' in url.path:
+            return SinaResponseType.TRENDING_WEIBO
+        elif '100803' in url.path:
+            return SinaResponseType.TRENDING_TOPIC_PAGE
+    elif 'weibo.com' in url.netloc:
+        if 'mblog/getlongtext' in url.path:
+            return SinaResponseType.LONG_TEXT_WEIBO
+        elif 'mblog/info/big' in url.path:
+            return SinaResponseType.REPOST_LIST
+        elif '/info' in url.path:
+            return SinaResponseType.USER_INFO
+        elif '/p/aj/v6/mblog/mbloglist' == url.path:
+            return SinaResponseType.USER_WEIBO
+        elif 'p/100808' in url.path:
+            return SinaResponseType.TRENDING_TOPIC
+        elif '/sorry' in url.path:
+            pass # Bypass
+        else:
+            return SinaResponseType.USER_HOME
+    return SinaResponseType.UNDEFINED
 
 class Router(PipelineNode):
     def __init__(self):
         PipelineNode.__init__(self, self.__class__.__name__)
 
-    def run(self, client, response):
+    def run(self, client, page):
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
-        url = urllib.parse.urlsplit(response.url)
-        response = SinaResponse(SinaResponseType.UNDEFINED, response)
-        if url.netloc == 'd.weibo.com':
-            if 'mblog/mbloglist' in url.path:
-                response.type = SinaResponseType.TRENDING_WEIBO
-            elif '100803' in url.path:
-                response.type = SinaResponseType.TRENDING_TOPIC_PAGE
-        elif 'weibo.com' in url.netloc:
-            if 'mblog/getlongtext' in url.path:
-                response.type = SinaResponseType.LONG_TEXT_WEIBO
-            elif 'mblog/info/big' in url.path:
-                response.type = SinaResponseType.REPOST_LIST
-            elif '/info' in url.path:
-                response.type = SinaResponseType.USER_INFO
-            elif '/p/aj/v6/mblog/mbloglist' == url.path:
-                response.type = SinaResponseType.USER_WEIBO
-            elif 'p/100808' in url.path:
-                response.type = SinaResponseType.TRENDING_TOPIC
-            elif '/sorry' in url.path: 
-                pass # Bypass
-            else:
-                response.type = SinaResponseType.USER_HOME
-        logger.debug('Route %s for %s' % (response.type, response.response.url))
+        logger.debug('Get response: %s' % debug_str_page(page))
+        response = SinaResponse(classify_link(page.final_url), page)
+        logger.debug('Route %s for %s' % (response.type, page.final_url))
         return (response,)
 
 class UndefinedProcessor(PipelineNode):
@@ -266,10 +494,10 @@ class UndefinedProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.UNDEFINED:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.warn('Get response: %s' % debug_str_response(response))
-        logger.warn('Content: %s' % response.text)
+        logger.warn('Get response: %s' % debug_str_page(page))
+        logger.warn('Content: %s' % page.text)
         
 
 class TrendingWeiboProcessor(PipelineNode):
@@ -279,19 +507,19 @@ class TrendingWeiboProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.TRENDING_WEIBO:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
+        logger.debug('Get response: %s' % debug_str_page(page))
  
         links = set()
         tweets = []
         flows = []
         try:
-            content_json = decode_response_text(response)
+            content_json = decode_response_text(page)
             assert type(content_json) == type(dict())
             if content_json['code'] != '100000':
-                logger.debug('%s failed.' % response.url)
-                client.submit_links(response.url)
+                logger.debug('%s failed.' % page.url)
+                client.submit_links([page.url])
                 return # Failed, need retry.
             content = strip_text_wight_blank(content_json['data'])
             tweets, ltext_tweets, flows, pages = tweet_page_parser(content)
@@ -312,9 +540,12 @@ class TrendingWeiboProcessor(PipelineNode):
                 link = _TWEET_LONGTEXT_LINK % (tweet.tid, urllib.parse.quote(tweet.json()))
                 links.add(link)
             client.submit_links(links.union(_links))
+            if tweets:
+                client.report_seed(page.url, content_digest(
+                    tweet.tid for tweet in tweets))
         except Exception:
-            logger.exception('Exception while handling %s' % debug_str_response(response))
-            response = None # Exiting
+            logger.exception('Exception while handling %s' % debug_str_page(page))
+            page = None # Exiting
         return (tweets, flows)
 
 class RepostListProcessor(PipelineNode):
@@ -324,10 +555,10 @@ class RepostListProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.REPOST_LIST:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
-        res_parse = urllib.parse.urlparse(response.url)
+        logger.debug('Get response: %s' % debug_str_page(page))
+        res_parse = urllib.parse.urlparse(page.url)
         dic_query = urllib.parse.parse_qs(res_parse.query)
         otid = int(dic_query['id'][0])
         ouid = int(dic_query['ouid'][0])
@@ -336,11 +567,11 @@ class RepostListProcessor(PipelineNode):
         tweets = []
         flows = []
         try:
-            content_json = decode_response_text(response)
+            content_json = decode_response_text(page)
             assert type(content_json) == type(dict())
             if content_json['code'] != '100000':
-                client.submit_links(response.url)
-                logger.debug('%s failed.' % response.url)
+                client.submit_links([page.url])
+                logger.debug('%s failed.' % page.url)
                 return # Failed, need retry.
             total_pages = content_json['data']['page']['totalpage']
             content = strip_text_wight_blank(content_json['data']['html'])
@@ -362,8 +593,8 @@ class RepostListProcessor(PipelineNode):
             _links = generate_user_links(tweets)
             client.submit_links(links.union(_links))
         except Exception:
-            logger.exception('Exception while handling %s' % debug_str_response(response))
-            response = None # Exiting
+            logger.exception('Exception while handling %s' % debug_str_page(page))
+            page = None # Exiting
         return (tweets, flows)
 
 class UserHomePageProcessor(PipelineNode):
@@ -373,15 +604,14 @@ class UserHomePageProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.USER_HOME:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
-        url_home = response.url.split('?')[0]
+        logger.debug('Get response: %s' % debug_str_page(page))
+        url_home = page.final_url.split('?')[0]
         try:
             links = set()
-            content = decode_response_text(response)
-            content = strip_text_wight_blank(content)
-            page_id, uid = user_home_config_parser(content)
+            content = decode_response_text(page)
+            page_id, uid = user_home_config_parser(PageScripts(content))
             if page_id:
                 link = _USER_INFO_LINK % (page_id, url_home)
                 links.add(link)
@@ -399,7 +629,7 @@ class UserHomePageProcessor(PipelineNode):
             else:
                 logger.warn('%s does not have a page_id field.' % url_home)
         except Exception:
-            logger.exception('Exception while handling %s' % debug_str_response(response))
+            logger.exception('Exception while handling %s' % debug_str_page(page))
 
 
 
@@ -410,23 +640,22 @@ class UserInfoProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.USER_INFO:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
-        logger.debug('%s' % response.url)
-        res_parse = urllib.parse.urlparse(response.url)
+        logger.debug('Get response: %s' % debug_str_page(page))
+        logger.debug('%s' % page.url)
+        res_parse = urllib.parse.urlparse(page.url)
         dic_query = urllib.parse.parse_qs(res_parse.query)
         url_home = dic_query['home'][0]
         users = []
         try:
-            content = decode_response_text(response)
-            content = strip_text_wight_blank(content)
+            content = decode_response_text(page)
             user = SinaUser()
             user.homepage = url_home
-            user_info_html_parser(content, user)
+            user_info_html_parser(PageScripts(content), user)
             users.append(user)
         except Exception:
-            logger.exception('Exception while handling %s' % debug_str_response(response))
+            logger.exception('Exception while handling %s' % debug_str_page(page))
         return (users, )
 
 
@@ -437,8 +666,8 @@ class UserWeiboProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.USER_WEIBO:
             return None
-        response = response.response
-        res_parse = urllib.parse.urlparse(response.url)
+        page = response.page
+        res_parse = urllib.parse.urlparse(page.url)
         dic_query = urllib.parse.parse_qs(res_parse.query)
         domain = int(dic_query['domain'][0])
         page_id= int(dic_query['id'][0])
@@ -452,13 +681,13 @@ class UserWeiboProcessor(PipelineNode):
         logger = logging.getLogger(self.name)
         try:
             links = set()
-            content_json = decode_response_text(response)
+            content_json = decode_response_text(page)
             assert type(content_json) == type(dict())
             if content_json['code'] != '100000' or content_json['data'].strip() == '':
-                logger.debug('%s failed.' % response.url)
+                logger.debug('%s failed.' % page.url)
                 if tries < PIPELINE_CONFIG['link_max_retries']:
                     tries += 1
-                    link = '%s&_tries=%s' % (response.url, tries)
+                    link = '%s&_tries=%s' % (page.url, tries)
                     client.submit_links([link])
                 return 
             content = strip_text_wight_blank(content_json['data'])
@@ -493,8 +722,8 @@ class UserWeiboProcessor(PipelineNode):
                 links.add(link)
             client.submit_links(links.union(_links))
         except Exception:
-            logger.exception('Exception while handling %s' % debug_str_response(response))
-            response = None # Exiting
+            logger.exception('Exception while handling %s' % debug_str_page(page))
+            page = None # Exiting
         return (tweets, flows)
 
 class LongTextWeiboProcessor(PipelineNode):
@@ -504,10 +733,10 @@ class LongTextWeiboProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.LONG_TEXT_WEIBO:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
-        res_parse = urllib.parse.urlparse(response.url)
+        logger.debug('Get response: %s' % debug_str_page(page))
+        res_parse = urllib.parse.urlparse(page.url)
         dict_query = urllib.parse.parse_qs(res_parse.query)
         tweet = dict_query.get('tweet', [''])[0]
         tries = int(dict_query.get('_tries', ['1'])[0])
@@ -515,16 +744,16 @@ class LongTextWeiboProcessor(PipelineNode):
             tweet = json.loads(urllib.parse.unquote(tweet))
             _tweet = SinaTweet()
             for key, value in tweet.items():
-                if key in _tweet.__dict__:
-                    _tweet.__dict__[key] = value
+                if key in _tweet._fields:
+                    setattr(_tweet, key, value)
             try:
-                content_json = decode_response_text(response)
+                content_json = decode_response_text(page)
                 assert type(content_json) == dict
                 if content_json['code'] != '100000' or content_json['data']['html'].strip() == '':
-                    logger.debug('%s failed.' % response.url)
+                    logger.debug('%s failed.' % page.url)
                     if tries < PIPELINE_CONFIG['link_max_retries']:
                         tries += 1
-                        link = '%s&_tries=%s' % (response.url, tries)
+                        link = '%s&_tries=%s' % (page.url, tries)
                         client.submit_links([link])
                     return # Failed, need retry.
                 content = strip_text_wight_blank(content_json['data']['html'])
@@ -557,7 +786,7 @@ class LongTextWeiboProcessor(PipelineNode):
                         _tweet.content += inner
                 return ([_tweet],)
             except Exception:
-                logger.exception('Exception while handling %s' % debug_str_response(response))
+                logger.exception('Exception while handling %s' % debug_str_page(page))
         return (list(),)
 
 class TrendingTopicPageProcessor(PipelineNode):
@@ -567,21 +796,23 @@ class TrendingTopicPageProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.TRENDING_TOPIC_PAGE:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
+        logger.debug('Get response: %s' % debug_str_page(page))
         topics = list()
         try:
-            content = decode_response_text(response)
-            content = strip_text_wight_blank(content)
-            topics = topic_page_parser(content)
+            content = decode_response_text(page)
+            topics = topic_page_parser(PageScripts(content))
             links = set()
             for topic in topics:
                 link = _TOPIC_LINK % topic.tid
                 links.add(link)
             client.submit_links(links, DownloaderType.TOPIC_DOWNLOADER)
+            if topics:
+                client.report_seed(page.url, content_digest(
+                    topic.tid for topic in topics))
         except Exception:
-            logger.exception('Exception while handling %s' % debug_str_response(response))
+            logger.exception('Exception while handling %s' % debug_str_page(page))
         return (topics, )
 
 class TrendingTopicProcessor(PipelineNode):
@@ -591,25 +822,33 @@ class TrendingTopicProcessor(PipelineNode):
     def run(self, client, response):
         if response.type != SinaResponseType.TRENDING_TOPIC:
             return None
-        response = response.response
+        page = response.page
         logger = logging.getLogger(self.name)
-        logger.debug('Get response: %s' % debug_str_response(response))
+        logger.debug('Get response: %s' % debug_str_page(page))
         topics = list()
         try:
-            content = decode_response_text(response)
-            content = strip_text_wight_blank(content)
+            content = decode_response_text(page)
             topic = SinaTopic()
-            topic_parser(content, topic)
+            topic_parser(PageScripts(content), topic)
             topics.append(topic)
         except Exception:
-            logger.exception('Exception while handling %s' % debug_str_response(response))
+            logger.exception('Exception while handling %s' % debug_str_page(page))
         return (topics, )
 
 
 class LevelDBWriter(PipelineNode):
-    def __init__(self):
+    """
+    Write entries to LevelDB. Within a batch, entries are buffered and each
+    database gets a single write batch when the batch ends.
+
+    Records are sent to the StorageWriter if registered, otherwise written
+    here directly.
+    """
+    def __init__(self, db_dir=None):
         PipelineNode.__init__(self, self.__class__.__name__)
-        self.db_dir = join(dirname(dirname(abspath(__file__))), 'database')
+        self.db_dir = db_dir
+        if db_dir is None:
+            self.db_dir = join(dirname(dirname(abspath(__file__))), 'database')
         if not isdir(self.db_dir):
             os.makedirs(self.db_dir)
         self.db_name_map = {
@@ -619,153 +858,223 @@ class LevelDBWriter(PipelineNode):
             'SinaTopic': 'topics.db',
             'SinaTopicReads': 'topics.db'
         }
-    
+        self.batching = False
+        self.pending = dict() # Database name -> list of (key, value)
+        self.storage_writer = None
+
+    def register_storage_writer(self, writer):
+        self.storage_writer = writer
+
+    def begin_batch(self):
+        self.batching = True
+
+    def end_batch(self):
+        self.batching = False
+        self.flush()
+
     def run(self, client, *kws):
         if not kws:
             return
-        logger = logging.getLogger(self.name)
-        db = None
-        for _entries in kws:
-            if _entries is None or len(_entries) == 0:
+        for entries in kws:
+            if entries is None or len(entries) == 0:
                 continue
-            entries = _entries
+            for entry in entries:
+                db_name = self.db_name_map.get(entry.__class__.__name__,
+                                               'error.db')
+                self.pending.setdefault(db_name, []).append(entry.record())
+        if not self.batching:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending entries with one write batch per database.
+        """
+        logger = logging.getLogger(self.name)
+        pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+        if self.storage_writer:
+            self.storage_writer.put(pending)
+            return
+        start = time.time()
+        for db_name, records in pending.items():
             for _ in range(PIPELINE_CONFIG['leveldb_max_retries']):
+                db = None
                 try:
-                    logger.debug('Writing: %s' % entries)
-                    entry = entries.pop()
-                    db_name = self.db_name_map.get(entry.__class__.__name__, 'error.db')
-                    db = plyvel.DB(join(self.db_dir, db_name), create_if_missing=True) 
-                    wb = db.write_batch()
-                    if type(entry) is SinaFlow:
-                        wb.put(pickle.dumps(entry.a), pickle.dumps(entry.b))
-                        for entry in entries:
-                            wb.put(pickle.dumps(entry.a), pickle.dumps(entry.b))
-                    elif type(entry) is SinaUser:
-                        wb.put(pickle.dumps(entry.uid), entry.serialize())
-                        for entry in entries:
-                            wb.put(pickle.dumps(entry.uid), entry.serialize())
-                    elif type(entry) is SinaTweet:
-                        wb.put(pickle.dumps(entry.tid), entry.serialize())
-                        for entry in entries:
-                            wb.put(pickle.dumps(entry.tid), entry.serialize())
-                    elif type(entry) is SinaTopic:
-                        wb.put(pickle.dumps(('topic'+entry.tid)), entry.serialize())
-                        for entry in entries:
-                            wb.put(pickle.dumps(('topic'+entry.tid)), entry.serialize())
-                    elif type(entry) is SinaTopicReads:
-                        wb.put(pickle.dumps('reads%s%s' % (entry.timestamp, entry.tid)), entry.serialize())
-                        for entry in entries:
-                            wb.put(pickle.dumps('reads%s%s' % (entry.timestamp, entry.tid)), entry.serialize())
-                    wb.write()
-                    db.close()
+                    logger.debug('Writing %s records to %s' %
+                                 (len(records), db_name))
+                    db = plyvel.DB(join(self.db_dir, db_name),
+                                   create_if_missing=True)
+                    with db.write_batch() as wb:
+                        for key, value in records:
+                            wb.put(key, value)
                     break
                 except plyvel._plyvel.IOError:
-                    logger.error('Error during writing %s, retry later.' % entries)
+                    logger.error('Error during writing %s, retry later.' %
+                                 db_name)
                     time.sleep(PIPELINE_CONFIG['leveldb_retry_delay'])
                 except Exception:
-                    logger.exception('Error while writing %s to LevelDB' % entries)
+                    logger.exception('Error while writing %s records to %s' %
+                                     (len(records), db_name))
                     break
                 finally:
                     if db and not db.closed:
                         db.close()
+        _WRITE_SECONDS.observe(time.time() - start, writer=self.name)
+        _BATCH_RECORDS.observe(sum(len(records) for records in pending.values()),
+                               writer=self.name)
 
 ### Utility functions 
 
-# requests.Response utility
-def decode_response_text(response): 
+# FetchedPage utility
+def decode_response_text(page): 
     """
-    Return the string of text decoded via response's content-type and charset.
-
+    Return the text decoded via page's content-type and charset: a json object
+    for 'application/json', otherwise the text cleaned by
+    strip_text_wight_blank(). The page is cleaned once and the result is kept
+    on the page.
     """
-    type_entry = response.headers.get('content-type', None)
-    if type_entry is None:
+    content_type = page.content_type
+    if content_type is None:
         return None
-    content_type, char_set = type_entry.split(';')
-    char_set = char_set.split('=')[-1]
-    response.encoding = char_set
-    ret = response.text
     if content_type == 'application/json':
-        ret = json.loads(ret)
-        # Default is 'text/html'
-    elif content_type == 'text/html':
-        ret = strip_text_wight_blank(ret)
-    return ret
+        return json.loads(page.text)
+    # Default is 'text/html'
+    if not page.cleaned:
+        page.cleaned_text = strip_text_wight_blank(page.text)
+        page.cleaned = True
+    return page.cleaned_text
 
-def debug_str_response(response):
+def content_digest(keys):
     """
-    Return a string of useful information of the response
+    Return a hex string digest of the keys of the records found in a page,
+    regardless of their order. The scheduler compares the digests of a seed
+    page to tell whether its content changed.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for key in sorted(set(str(key) for key in keys)):
+        digest.update(key.encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def debug_str_page(page):
+    """
+    Return a string of useful information of the page
     
     Input:
-    - response: A requests.Response.
+    - page: A FetchedPage.
     """
-    if response is None:
+    if page is None:
         return 'None'
-    history = list()
-    if response.history:
-        history = [res.url for res in response.history]
     ret = {
-        'url': response.url,
-        'headers': response.headers,
-        'link': response.url,
-        'history': history
+        'url': page.final_url,
+        'status': page.status,
+        'content_type': page.content_type,
+        'charset': page.charset,
+        'link': page.url
     }
     return str(ret)
 
+_BLANK_PATTERN = re.compile(r'\\[rnt]|\r|&nbsp;|\\([/"])')
+
 def strip_text_wight_blank(text):
-    text = re.sub(r'(\\r)|(\\n)|(\r)|(\\t)', '', text)
-    text = re.sub(r'\\/', '/', text)
-    text = re.sub(r'\\"', '"', text)
-    text = re.sub('&nbsp;', '', text)
-    return text
+    """
+    Remove escaped blanks (\\r, \\n, \\t), carriage returns and &nbsp;, and
+    unescape \\/ and \\" in a single pass.
+    """
+    return _BLANK_PATTERN.sub(r'\1', text)
  
 
 # Html parser
 
-def user_home_config_parser(html):
+_OUID_PATTERN = re.compile(r'(ouid=([0-9]*))')
+_ROUID_PATTERN = re.compile(r'.*(rouid=([0-9]*))')
+_NUMBER_PATTERN = re.compile('[0-9]+')
+_USERCARD_ID_PATTERN = re.compile(r'(id=([0-9]+))')
+_TOPIC_ID_PATTERN = re.compile(r'.*/(.*)\?.*')
+
+class PageScripts(object):
+    """
+    The $CONFIG values and the FM.view fragments of a page. The raw text is
+    scanned once, and each fragment is parsed at most once, on first use.
+
+    Fragments are keyed by domid, e.g. 'Pl_Core_T8CustomTriColumn__3'.
+    """
+    _SCRIPT = re.compile(r'<script[^>]*>.*?</script>', re.S | re.I)
+    _CONFIG = re.compile(r"\$CONFIG\['(\w+)'\]\s*=\s*'([^']*)'")
+    _DOMID = re.compile(r'"domid":"([^"]+)"')
+    _META = re.compile(r'<meta\s[^>]*>', re.I)
+    _ATTR = re.compile(r'([\w-]+)\s*=\s*"([^"]*)"')
+
+    def __init__(self, text):
+        """
+        Input:
+        - text: A string of the page stripped by strip_text_wight_blank().
+        """
+        self.config = dict() # $CONFIG key -> value
+        self.views = dict() # domid -> html fragment
+        self.meta = dict() # Meta name -> content
+        self._soups = dict()
+        for match in self._SCRIPT.finditer(text):
+            script = match.group(0)
+            if '$CONFIG[' in script:
+                for key, value in self._CONFIG.findall(script):
+                    self.config.setdefault(key, value)
+            elif 'FM.view(' in script:
+                domid = self._DOMID.search(script)
+                if domid:
+                    self.views[domid.group(1)] = extract_html_from_script(script)
+        for match in self._META.finditer(text):
+            attrs = dict(self._ATTR.findall(match.group(0)))
+            if 'name' in attrs and 'content' in attrs:
+                self.meta.setdefault(attrs['name'], html.unescape(attrs['content']))
+
+    def view(self, prefix):
+        """
+        Return the domid of the fragment whose domid starts with prefix, or
+        None.
+        """
+        found = None
+        for domid in self.views:
+            if domid.startswith(prefix):
+                found = domid
+        return found
+
+    def soup(self, prefix):
+        """
+        Return the parsed fragment whose domid starts with prefix, or None.
+        """
+        domid = self.view(prefix)
+        if domid is None or not self.views[domid]:
+            return None
+        if domid not in self._soups:
+            self._soups[domid] = BeautifulSoup(self.views[domid], 'lxml')
+        return self._soups[domid]
+
+def user_home_config_parser(scripts):
     """
     Return page_id, uid
+
+    Input:
+    - scripts: A PageScripts of the user home page.
     """
-    page_id = ''
-    uid = ''
-    config_box = ''
-    for script in BeautifulSoup(html, 'lxml').find_all('script'):
-        if "$CONFIG['page_id']" in str(script):
-            config_box = script.contents[0]
-            break
-    if config_box:
-        for value in config_box.split(';'):
-            if "['page_id']" in value:
-                page_id = value.split("'")[-2]
-            elif "['oid']" in value:
-                uid = value.split("'")[-2]
-    return (page_id, uid)
+    return (scripts.config.get('page_id', ''), scripts.config.get('oid', ''))
  
-def user_info_html_parser(html, user):
-    config_box = ''
-    number_box = ''
-    info_box = ''
-    level_box = ''
-    for script in BeautifulSoup(html, 'lxml').find_all('script'):
-        if "$CONFIG['page_id']" in str(script):
-            config_box = script.contents[0]
-        elif '"domid":"Pl_Core_T8CustomTriColumn__' in str(script):
-            number_box = str(script)
-        elif '"domid":"Pl_Core_UserInfo__' in str(script) or \
-            '"domid":"Pl_Official_PersonalInfo__' in str(script):
-            info_box = str(script)
-        elif '"domid":"Pl_Official_RightGrowNew__' in str(script):
-            level_box = str(script)
-    if config_box:
-        for value in config_box.split(';'):
-            if "['oid']" in value:
-                user.uid = int(value.split("'")[-2])
-            elif "['page_id']" in value:
-                user.page_id = value.split("'")[-2]
-            elif "['onick']" in value:
-                user.nick_name = value.split("'")[-2]
+def user_info_html_parser(scripts, user):
+    """
+    Input:
+    - scripts: A PageScripts of the user info page.
+    - user: A SinaUser to fill.
+    """
+    config = scripts.config
+    if 'oid' in config:
+        user.uid = int(config['oid'])
+    if 'page_id' in config:
+        user.page_id = config['page_id']
+    if 'onick' in config:
+        user.nick_name = config['onick']
+    number_box = scripts.soup('Pl_Core_T8CustomTriColumn__')
     if number_box:
-        number_box = extract_html_from_script(number_box)
-        number_box = BeautifulSoup(number_box, 'lxml')
         for box in number_box.find_all('td', 'S_line1'):
             name = box.span.contents[0].strip()
             number = box.strong.contents[0].strip()
@@ -775,9 +1084,9 @@ def user_info_html_parser(html, user):
                 user.num_fans = int(number)
             elif name == '微博':
                 user.num_tweets = int(number)
+    info_box = scripts.soup('Pl_Core_UserInfo__') or \
+        scripts.soup('Pl_Official_PersonalInfo__')
     if info_box:
-        info_box = extract_html_from_script(info_box)
-        info_box = BeautifulSoup(info_box, 'lxml')
         for box in info_box.find_all('li', 'li_1'):
             title_box = box.find('span', 'pt_title')
             detail_box = box.find('span', 'pt_detail')
@@ -799,9 +1108,8 @@ def user_info_html_parser(html, user):
                 user.labels = detail
             else:
                 user.others[title] = detail
+    level_box = scripts.soup('Pl_Official_RightGrowNew__')
     if level_box:
-        level_box = extract_html_from_script(level_box)
-        level_box = BeautifulSoup(level_box, 'lxml')
         level_box = level_box.find('div', 'level_box')
         if level_box:
             title = level_box.find('a')
@@ -813,13 +1121,21 @@ def tweet_page_parser(html, paging_info=False):
     """
     Returns a list of tweets along with their path. The returned tweet only contains
     its own content.
+
+    The parser backend is chosen by PIPELINE_CONFIG['parser_backend'].
+    """
+    if PIPELINE_CONFIG['parser_backend'] == 'lxml':
+        return lxml_tweet_page_parser(html, paging_info)
+    return bs4_tweet_page_parser(html, paging_info)
+
+def bs4_tweet_page_parser(html, paging_info=False):
+    """
+    BeautifulSoup implementation of tweet_page_parser().
     """
     tweets = []
     ltext_tweets = []
     flows = []
     pages = 0
-    ouidp = re.compile(r'(ouid=([0-9]*))')
-    rouidp = re.compile(r'.*(rouid=([0-9]*))')
     box = BeautifulSoup(html, 'lxml')
     for wrap_box in box.find_all('div', 'WB_cardwrap'):
         if paging_info:
@@ -839,7 +1155,7 @@ def tweet_page_parser(html, paging_info=False):
         tweet.tid = int(wrap_box.attrs.get('mid', 0))
         tbinfo = wrap_box.attrs.get('tbinfo', '')
         if tbinfo:
-            uid = ouidp.match(tbinfo)
+            uid = _OUID_PATTERN.match(tbinfo)
             tweet.uid = int(uid.groups()[1])
         flow, is_ltext_tweet = tweet_box_parser(tweet_box, tweet)
         handle_box = wrap_box.find('div', 'WB_feed_handle')
@@ -849,7 +1165,7 @@ def tweet_page_parser(html, paging_info=False):
             otweet = SinaTweet()
             otweet.tid = int(wrap_box.attrs.get('omid', 0))
             if tbinfo:
-                ouid = rouidp.match(tbinfo)
+                ouid = _ROUID_PATTERN.match(tbinfo)
                 if ouid is None:
                     continue# Weibo already deleted.
                 otweet.uid = int(ouid.groups()[1])
@@ -954,11 +1270,10 @@ def tweet_handle_box_parser(box, tweet):
     """
     Parse number of retweets, comments, loves.
     """
-    p = re.compile('[0-9]+')
     for inner in box.find_all('a'):
         action_type = inner.attrs.get('action-type', '')
         _action_suda = inner.attrs.get('suda-uatrack', '')
-        em = inner.find('em', text=p)
+        em = inner.find('em', text=_NUMBER_PATTERN)
         if action_type == 'fl_like' and em:
             tweet.num_loves = int(em.get_text())
         elif (action_type == 'fl_forward' or 'transfer' in _action_suda) and em:
@@ -981,10 +1296,19 @@ def paging_info_parser(box):
 def retweet_list_page_parser(html, otid, ouid):
     """
     Return a list tweets along with retweeting relations.
+
+    The parser backend is chosen by PIPELINE_CONFIG['parser_backend'].
+    """
+    if PIPELINE_CONFIG['parser_backend'] == 'lxml':
+        return lxml_retweet_list_page_parser(html, otid, ouid)
+    return bs4_retweet_list_page_parser(html, otid, ouid)
+
+def bs4_retweet_list_page_parser(html, otid, ouid):
+    """
+    BeautifulSoup implementation of retweet_list_page_parser().
     """
     tweets = []
     flows = []
-    uidp = re.compile(r'(id=([0-9]+))')
     box = BeautifulSoup(html, 'lxml')
     for tweet_box in box.find_all(attrs={'action-type':'feed_list_item'}):
         tweet = SinaTweet()
@@ -992,7 +1316,7 @@ def retweet_list_page_parser(html, otid, ouid):
         tweet.otid = otid
         tweet.ouid = ouid
         face_box = tweet_box.find('div', 'WB_face')
-        uid = uidp.match(face_box.a.attrs.get('usercard', ''))
+        uid = _USERCARD_ID_PATTERN.match(face_box.a.attrs.get('usercard', ''))
         tweet.uid = int(uid.groups()[1])
         from_box = tweet_box.find('div', 'WB_from')
         tweet_from_box_parser(from_box, tweet)
@@ -1010,7 +1334,286 @@ def retweet_list_page_parser(html, otid, ouid):
         if path:
             flow = SinaFlow()
             flow.a = ouid
-            for _ in range(path):
+            for _ in range(len(path)):
+                e = path.pop()
+                flow.b = e
+                flows.append(flow)
+                flow = SinaFlow()
+                flow.a = e
+            flow.b = tweet.uid
+            flows.append(flow)
+        else:
+            flow = SinaFlow()
+            flow.a = ouid
+            flow.b = tweet.uid
+        tweets.append(tweet)
+    return (tweets, flows)
+
+# lxml backend. Mirrors the BeautifulSoup parsers above with compiled XPath.
+
+def _xpath_class(tag, name):
+    return lxml.etree.XPath(
+        './/%s[contains(concat(" ", normalize-space(@class), " "), " %s ")]' %
+        (tag, name))
+
+_X_CARDWRAP = _xpath_class('div', 'WB_cardwrap')
+_X_CARDTITLE = _xpath_class('div', 'WB_cardtitle_b')
+_X_DETAIL = _xpath_class('div', 'WB_detail')
+_X_IGNORE = lxml.etree.XPath('.//a[@ignore="ignore"]')
+_X_FEED_HANDLE = _xpath_class('div', 'WB_feed_handle')
+_X_HANDLE = _xpath_class('div', 'WB_handle')
+_X_EXPAND = _xpath_class('div', 'WB_expand')
+_X_FROM = _xpath_class('div', 'WB_from')
+_X_MEDIA = _xpath_class('div', 'WB_media_wrap')
+_X_PIC = _xpath_class('li', 'WB_pic')
+_X_TEXT = _xpath_class('div', 'WB_text')
+_X_FACE = _xpath_class('div', 'WB_face')
+_X_A = lxml.etree.XPath('.//a')
+_X_EM = lxml.etree.XPath('.//em')
+_X_PAGE = lxml.etree.XPath('.//*[@bpfilter="page"]')
+_X_FEED_ITEM = lxml.etree.XPath('.//*[@action-type="feed_list_item"]')
+_X_NODE_TEXT = lxml.etree.XPath('.//*[@node-type="text"]')
+
+def _first(xpath, element):
+    found = xpath(element)
+    return found[0] if found else None
+
+def _lxml_document(html):
+    if not html.strip():
+        return None
+    return lxml.html.document_fromstring(html)
+
+def _lxml_contents(element):
+    """
+    Yield (tag, node) of the children of element the way BeautifulSoup lists
+    .contents: strings have a None tag, comments included.
+    """
+    if element.text:
+        yield (None, element.text)
+    for child in element:
+        if isinstance(child.tag, str):
+            yield (child.tag, child)
+        elif child.text:
+            # Comments and processing instructions.
+            yield (None, child.text)
+        if child.tail:
+            yield (None, child.tail)
+
+def _lxml_string(element):
+    """
+    Return the single string of element like BeautifulSoup .string.
+    """
+    if len(element) == 0:
+        return element.text
+    if len(element) == 1 and not element.text and not element[0].tail and \
+        isinstance(element[0].tag, str):
+        return _lxml_string(element[0])
+    return None
+
+def lxml_tweet_page_parser(html, paging_info=False):
+    """
+    lxml implementation of tweet_page_parser().
+    """
+    tweets = []
+    ltext_tweets = []
+    flows = []
+    pages = 0
+    box = _lxml_document(html)
+    if box is None:
+        return (tweets, ltext_tweets, flows, pages)
+    for wrap_box in _X_CARDWRAP(box):
+        attrs = wrap_box.attrib
+        if paging_info:
+            node_type = attrs.get('node-type', '')
+            if node_type == 'feed_list_page':
+                pages = lxml_paging_info_parser(wrap_box)
+        if 'mid' not in attrs or _X_CARDTITLE(wrap_box):
+            #Bypass mysterious box
+            continue
+        tweet_box = _first(_X_DETAIL, wrap_box)
+        if _X_IGNORE(tweet_box):
+            continue
+        is_forward = attrs.get('isforward', '')
+        tweet = SinaTweet()
+        tweet.tid = int(attrs.get('mid', 0))
+        tbinfo = attrs.get('tbinfo', '')
+        if tbinfo:
+            uid = _OUID_PATTERN.match(tbinfo)
+            tweet.uid = int(uid.groups()[1])
+        flow, is_ltext_tweet = lxml_tweet_box_parser(tweet_box, tweet)
+        handle_box = _first(_X_FEED_HANDLE, wrap_box)
+        handle_box = _first(_X_HANDLE, handle_box)
+        lxml_tweet_handle_box_parser(handle_box, tweet)
+        if is_forward == '1':
+            otweet = SinaTweet()
+            otweet.tid = int(attrs.get('omid', 0))
+            if tbinfo:
+                ouid = _ROUID_PATTERN.match(tbinfo)
+                if ouid is None:
+                    continue# Weibo already deleted.
+                otweet.uid = int(ouid.groups()[1])
+            otweet_box = _first(_X_EXPAND, tweet_box)
+            _, is_ltext_otweet = lxml_tweet_box_parser(otweet_box, otweet)
+            tweet.otid = otweet.tid
+            tweet.ouid = otweet.uid
+            f = SinaFlow()
+            f.a = otweet.uid
+            if flow:
+                f.b = flow[0].a
+            else:
+                f.b = tweet.uid
+            flow.append(f)
+            for f in flow:
+                f.tag = otweet.tid
+            handle_box = _first(_X_HANDLE, otweet_box)
+            lxml_tweet_handle_box_parser(handle_box, otweet)
+            if is_ltext_otweet:
+                ltext_tweets.append(otweet)
+            else:
+                tweets.append(otweet)
+        if is_ltext_tweet:
+            ltext_tweets.append(tweet)
+        else:
+            tweets.append(tweet)
+        flows.extend(flow)
+    return (tweets, ltext_tweets, flows, pages)
+
+def lxml_tweet_box_parser(box, tweet):
+    """
+    lxml implementation of tweet_box_parser().
+    """
+    path = []
+    from_box = _first(_X_FROM, box)
+    lxml_tweet_from_box_parser(from_box, tweet)
+    for media_box in _X_MEDIA(box):
+        tweet.num_images += len(_X_PIC(media_box))
+    text_box = _first(_X_TEXT, box)
+    bypass = False
+    is_long_text = False
+    for tag, inner in _lxml_contents(text_box):
+        if tag == 'img':
+            continue # Emoij
+        elif tag == 'a':
+            _type = inner.get('extra-data', '')
+            __type = inner.get('action-type', '')
+            if 'topic' in _type and not bypass:
+                tweet.num_topics += 1
+                tweet.content += inner.text_content()
+            elif 'atname' in _type:
+                tweet.num_atnames += 1
+                if len(tweet.content) >= 2 and tweet.content[-2:] == '//':
+                    bypass = True
+                    path.append(inner.text_content()[1:])
+                    continue
+            elif 'widget_photoview' in __type:
+                continue
+            elif 'feed_list_url' in __type and not bypass:
+                if '视频' in inner.text_content():
+                    tweet.num_videos += 1
+                else:
+                    tweet.num_links += 1 
+                tweet.content += inner.text_content()
+            elif 'fl_unfold' in __type and not bypass:
+                is_long_text = True
+            elif not bypass:
+                logger = logging.getLogger()
+                logger.warn('Missed tweet text: %s' %
+                            lxml.html.tostring(inner, encoding='unicode',
+                                               with_tail=False))
+        elif tag is None and not bypass:
+            tweet.content += inner
+    tweet.content = tweet.content.strip()
+    flows = []
+    if path:
+        flow = SinaFlow()
+        flow.a = path.pop()
+        for _ in range(len(path)):
+            e = path.pop()
+            flow.b = e
+            flows.append(flow)
+            flow = SinaFlow()
+            flow.a = e
+        flow.b = tweet.uid
+        flows.append(flow)
+    return (flows, is_long_text)
+
+def lxml_tweet_from_box_parser(box, tweet):
+    for inner in _X_A(box):
+        _date = inner.get('date', '')
+        if _date:
+            tweet.time = int(_date[:11])
+        action_type = inner.get('action-type', '')
+        if action_type == 'app_source':
+            tweet.platform = inner.text_content()
+
+def lxml_tweet_handle_box_parser(box, tweet):
+    """
+    Parse number of retweets, comments, loves.
+    """
+    for inner in _X_A(box):
+        action_type = inner.get('action-type', '')
+        _action_suda = inner.get('suda-uatrack', '')
+        em = None
+        for _em in _X_EM(inner):
+            string = _lxml_string(_em)
+            if string is not None and _NUMBER_PATTERN.search(string):
+                em = _em
+                break
+        if action_type == 'fl_like' and em is not None:
+            tweet.num_loves = int(em.text_content())
+        elif (action_type == 'fl_forward' or 'transfer' in _action_suda) and \
+            em is not None:
+            tweet.num_reposts = int(em.text_content())
+        elif (action_type == 'fl_comment' or 'comment' in _action_suda) and \
+            em is not None:
+            tweet.num_comments = int(em.text_content())
+
+def lxml_paging_info_parser(box):
+    pages = 0
+    for page_box in _X_PAGE(box):
+        link = page_box.get('href', '')
+        if link == '':
+            continue
+        url_parse = urllib.parse.urlparse(link)
+        url_query = urllib.parse.parse_qs(url_parse.query)
+        page = int(url_query.get('page', ['0'])[0])
+        pages = max(pages, page)
+    return pages
+
+def lxml_retweet_list_page_parser(html, otid, ouid):
+    """
+    lxml implementation of retweet_list_page_parser().
+    """
+    tweets = []
+    flows = []
+    box = _lxml_document(html)
+    if box is None:
+        return (tweets, flows)
+    for tweet_box in _X_FEED_ITEM(box):
+        tweet = SinaTweet()
+        tweet.tid = int(tweet_box.get('mid', 0))
+        tweet.otid = otid
+        tweet.ouid = ouid
+        face_box = _first(_X_FACE, tweet_box)
+        uid = _USERCARD_ID_PATTERN.match(_first(_X_A, face_box).get('usercard', ''))
+        tweet.uid = int(uid.groups()[1])
+        from_box = _first(_X_FROM, tweet_box)
+        lxml_tweet_from_box_parser(from_box, tweet)
+        text_box = _first(_X_NODE_TEXT, tweet_box)
+        bypass = False
+        path = []
+        for tag, inner in _lxml_contents(text_box):
+            if tag == 'img':
+                continue
+            elif tag == 'a':
+                bypass = True
+                path.append(inner.text_content()[1:])
+            elif tag is None and not bypass:
+                tweet.content += inner
+        if path:
+            flow = SinaFlow()
+            flow.a = ouid
+            for _ in range(len(path)):
                 e = path.pop()
                 flow.b = e
                 flows.append(flow)
@@ -1026,26 +1629,24 @@ def retweet_list_page_parser(html, otid, ouid):
     return (tweets, flows)
 
 # Trending topics
-def topic_page_parser(html):
+def topic_page_parser(scripts):
     """
     Return a list of links of topics.
+
+    Input:
+    - scripts: A PageScripts of the topic list page.
     """
-    pidx = re.compile('.*/(.*)\?.*')
     timestamp = round(time.time())
     topics = list()
-    topics_box = ''
-    for script in BeautifulSoup(html, 'lxml').find_all('script'):
-        if '"domid":"Pl_Discover_Pt6Rank__5"' in str(script):
-            topics_box = str(script)
-            break
-    topics_box = extract_html_from_script(topics_box)
-    topics_box = BeautifulSoup(topics_box, 'lxml')
+    topics_box = scripts.soup('Pl_Discover_Pt6Rank__5')
+    if not topics_box:
+        return topics
     for topic_box in topics_box.find_all('div', 'pic_txt'):
         topic = SinaTopicReads()
         topic.timestamp = timestamp
         link_box = topic_box.find('div', 'pic_box')
         if link_box:
-            m = pidx.match(link_box.a.attrs['href'])
+            m = _TOPIC_ID_PATTERN.match(link_box.a.attrs['href'])
             if m:
                 topic.tid = m.groups()[0]
         if topic.tid == '':
@@ -1056,30 +1657,21 @@ def topic_page_parser(html):
         topics.append(topic)
     return topics
 
-def topic_parser(html, topic):
-    soup = BeautifulSoup(html, 'lxml')
-    desc_box = soup.find('meta', attrs={'name': 'description'})
-    if desc_box:
-        topic.brief = desc_box.attrs['content']
-    config_box = ''
-    number_box = ''
-    lable_box = ''
-    for script in soup.find_all('script'):
-        if "$CONFIG['page_id']" in str(script):
-            config_box = script.contents[0]
-        elif '"domid":"Pl_Core_T8CustomTriColumn' in str(script):
-            number_box = str(script)
-        elif '"domid":"Pl_Core_T5MultiText' in str(script):
-            lable_box = str(script)
-    if config_box:
-        for value in config_box.split(';'):
-            if "['page_id']" in value:
-                topic.tid = value.split("'")[-2]
-            elif "['onick']" in value:
-                topic.name = value.split("'")[-2]
+def topic_parser(scripts, topic):
+    """
+    Input:
+    - scripts: A PageScripts of the topic page.
+    - topic: A SinaTopic to fill.
+    """
+    if 'description' in scripts.meta:
+        topic.brief = scripts.meta['description']
+    config = scripts.config
+    if 'page_id' in config:
+        topic.tid = config['page_id']
+    if 'onick' in config:
+        topic.name = config['onick']
+    number_box = scripts.soup('Pl_Core_T8CustomTriColumn')
     if number_box:
-        number_box = extract_html_from_script(number_box)
-        number_box = BeautifulSoup(number_box, 'lxml')
         for box in number_box.find_all('td', 'S_line1'):
             name = box.span.contents[0].strip()
             number = box.strong.contents[0].strip()
@@ -1089,9 +1681,8 @@ def topic_parser(html, topic):
                 topic.num_disscuss = wordsToNum(number)
             elif name == '粉丝':
                 topic.num_fans = wordsToNum(number)
+    lable_box = scripts.soup('Pl_Core_T5MultiText')
     if lable_box:
-        lable_box = extract_html_from_script(lable_box)
-        lable_box = BeautifulSoup(lable_box, 'lxml')
         for box in lable_box.find_all('li', 'li_1'):
             title_box = box.find('span', 'pt_title')
             detail_box = box.find('span', 'pt_detail')
@@ -2,9 +2,26 @@
 A simple driver for data store.
 """
 
+import logging
+import multiprocessing
+import os
+from os.path import abspath, join, dirname, isdir
 import plyvel
+import queue
+import signal
 import threading
-from os.path import abspath, join, dirname
+import time
+
+from sinaspider.config import *
+import sinaspider.metrics
+
+_WRITE_SECONDS = sinaspider.metrics.histogram(
+    'sinaspider_storage_write_seconds',
+    'Seconds of writing a batch of records to LevelDB.', ['writer'])
+_BATCH_RECORDS = sinaspider.metrics.histogram(
+    'sinaspider_storage_batch_records',
+    'Records written to LevelDB at once.', ['writer'],
+    (1, 4, 16, 64, 256, 1024, 4096, 16384))
 
 class Store(object):
     """
@@ -30,3 +47,159 @@ class Store(object):
             cls._instance_lock.release()
         return cls._instance.db
 
+
+
+class StorageWriter(object):
+    """
+    A process which owns all of LevelDB handles of the pipeline. The handles
+    are opened once and kept open, so pipeline workers never open a database
+    nor contend for its lock. Workers send records through put().
+
+    Records are group committed: records of many puts are coalesced into one
+    write batch per database, flushed every flush_interval seconds or once
+    flush_size records are pending, whichever comes first.
+
+    Usage:
+
+        writer = StorageWriter(db_dir)
+        writer.start()
+        writer.put({'tweets.db': [(key, value)]})
+        writer.stop()
+    """
+
+    def __init__(self, db_dir, flush_interval=None, flush_size=None,
+                 sync=None):
+        """
+        Input:
+        - db_dir: A string of the directory holding the databases.
+        - flush_interval: A float of maximum seconds a record stays pending.
+        - flush_size: An integer of pending records which triggers a flush.
+        - sync: A boolean of whether a flush waits for the disk.
+        Unspecified options are read from PIPELINE_CONFIG.
+        """
+        self.db_dir = db_dir
+        self.flush_interval = flush_interval
+        if flush_interval is None:
+            self.flush_interval = PIPELINE_CONFIG['storage_flush_interval']
+        self.flush_size = flush_size
+        if flush_size is None:
+            self.flush_size = PIPELINE_CONFIG['storage_flush_size']
+        self.sync = sync
+        if sync is None:
+            self.sync = PIPELINE_CONFIG['storage_sync']
+        self.queue = multiprocessing.Queue(PIPELINE_CONFIG['storage_queue_size'])
+        self.process = None
+        self.name = self.__class__.__name__
+        # Shared with the writer process.
+        self.flushes = multiprocessing.RawValue('Q', 0)
+        self.records = multiprocessing.RawValue('Q', 0)
+        self.flush_seconds = multiprocessing.RawValue('d', 0)
+        self.max_flush_seconds = multiprocessing.RawValue('d', 0)
+
+    def start(self):
+        self.process = multiprocessing.Process(name=self.name, target=self.run)
+        self.process.start()
+
+    def stop(self):
+        """
+        Write the remaining records and wait for the writer to exit.
+        """
+        self.queue.put(None)
+        self.process.join()
+
+    def put(self, records):
+        """
+        Send records to the writer. Block if the writer falls behind.
+
+        Input:
+        - records: A dict of database name -> list of (key, value) bytes.
+        """
+        self.queue.put(records)
+
+    def metrics(self):
+        """
+        Return a dict of group commit statistics. 'batch_size' is the average
+        number of records per flush and 'flush_latency' the average seconds
+        spent writing a flush.
+        """
+        flushes = self.flushes.value
+        return {
+            'flushes': flushes,
+            'records': self.records.value,
+            'batch_size': self.records.value / flushes if flushes else 0,
+            'flush_latency': self.flush_seconds.value / flushes if flushes else 0,
+            'max_flush_latency': self.max_flush_seconds.value
+        }
+
+    def run(self):
+        """
+        Entry of the writer process.
+        """
+        # Stopped by the owner after all of the producers.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        logger = logging.getLogger(self.name)
+        sinaspider.metrics.start(self.name)
+        if not isdir(self.db_dir):
+            os.makedirs(self.db_dir)
+        self.dbs = dict()
+        pending = dict()
+        count = 0
+        deadline = None
+        try:
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0, deadline - time.time())
+                try:
+                    records = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    records = dict()
+                if records is None:
+                    break
+                if not pending:
+                    deadline = time.time() + self.flush_interval
+                for db_name, items in records.items():
+                    pending.setdefault(db_name, []).extend(items)
+                    count += len(items)
+                if count >= self.flush_size or (pending and
+                                                time.time() >= deadline):
+                    self._flush(pending, count)
+                    pending = dict()
+                    count = 0
+        finally:
+            if pending:
+                self._flush(pending, count)
+            for db in self.dbs.values():
+                db.close()
+            sinaspider.metrics.stop()
+        logger.info('Storage writer stopped: %s' % self.metrics())
+
+    def _flush(self, pending, count):
+        """
+        Write the pending records with one write batch per database.
+        """
+        logger = logging.getLogger(self.name)
+        start = time.time()
+        for db_name, items in pending.items():
+            try:
+                db = self.dbs.get(db_name)
+                if db is None:
+                    db = plyvel.DB(join(self.db_dir, db_name),
+                                   create_if_missing=True)
+                    self.dbs[db_name] = db
+                with db.write_batch(sync=self.sync) as wb:
+                    for key, value in items:
+                        wb.put(key, value)
+            except Exception:
+                logger.exception('Error while writing %s records to %s' %
+                                 (len(items), db_name))
+        elapsed = time.time() - start
+        _WRITE_SECONDS.observe(elapsed, writer=self.name)
+        _BATCH_RECORDS.observe(count, writer=self.name)
+        self.flushes.value += 1
+        self.records.value += count
+        self.flush_seconds.value += elapsed
+        self.max_flush_seconds.value = max(self.max_flush_seconds.value,
+                                           elapsed)
+        logger.debug('Flushed %s records in %.3f seconds' % (count, elapsed))
@@ -3,8 +3,12 @@ Useful utilities.
 """
 
 import atexit
+import functools
+import hashlib
+import math
 import os
 from signal import SIGTERM
+import struct
 import sys
 import time
 import threading
@@ -143,6 +147,17 @@ class UnimplementedException(Exception):
     pass
 
 
+def synchronized(method):
+    """
+    Decorate a method to run while holding the instance's lock attribute.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class RepeatingTimer(threading.Thread):
     def __init__(self, interval, function, args=[], kwargs={}):
         threading.Thread.__init__(self)
@@ -165,3 +180,85 @@ class RepeatingTimer(threading.Thread):
                 self.flag_run = False
 
 
+class BloomFilter(object):
+    """
+    A bloom filter over bytes keys. A negative answer is always right, a
+    positive answer is wrong with a probability of about error_rate as long as
+    no more than capacity keys are added.
+    """
+    _HEADER = struct.Struct('>4sQIQ')
+    _MAGIC = b'BLMF'
+
+    def __init__(self, capacity, error_rate):
+        """
+        Input:
+        - capacity: An integer of expected number of keys.
+        - error_rate: A float of expected false positive rate.
+        """
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for idx in self._indexes(key):
+            self.bits[idx >> 3] |= 1 << (idx & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for idx in self._indexes(key):
+            if not self.bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def error_rate(self):
+        """
+        Return the estimated false positive rate under current load.
+        """
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) \
+            ** self.num_hashes
+
+    def dump(self, path):
+        """
+        Write a snapshot of the filter to path.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(self._HEADER.pack(self._MAGIC, self.num_bits,
+                                       self.num_hashes, self.count))
+            fd.write(self.bits)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Restore the filter from a snapshot written by dump(). Return False if
+        the snapshot is missing or was built with a different size.
+        """
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as fd:
+            header = fd.read(self._HEADER.size)
+            if len(header) != self._HEADER.size:
+                return False
+            magic, num_bits, num_hashes, count = self._HEADER.unpack(header)
+            if magic != self._MAGIC or num_bits != self.num_bits or \
+                    num_hashes != self.num_hashes:
+                return False
+            bits = fd.read()
+        if len(bits) != len(self.bits):
+            return False
+        self.bits = bytearray(bits)
+        self.count = count
+        return True
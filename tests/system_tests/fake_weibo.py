@@ -0,0 +1,303 @@
+"""
+A local fake Weibo for end-to-end tests of the downloaders without network.
+
+FakeWeiboServer is both the forward proxy handed out to the downloaders and
+the origin behind it. Links must use the http scheme (see fake_link) so that
+requests sends them through the proxy as absolute urls instead of opening a
+CONNECT tunnel. The final url of a page then keeps the weibo.com host and is
+routed by the pipeline as usual.
+
+Faults are injected per request at the configured rates:
+- sysbusy: Redirect to weibo.com/sorry?sysbusy.
+- passport: Redirect to the visitor passport, i.e. the session expired.
+- slow: Delay the response by slow_delay seconds.
+- timeout: Hold the response for hang seconds, beyond the client timeout.
+
+Direct requests to the server are answered with:
+- /proxies: The server address as a proxy provider, one addr:port per line.
+- /stats: A json of request counters.
+"""
+
+import collections
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+from sinaspider.downloader import DownloaderType
+from sinaspider.replay import read_corpus
+from sinaspider.services.ttypes import Cookie, ProxyAddress
+
+_SYSBUSY_LINK = 'http://weibo.com/sorry?sysbusy'
+_PASSPORT_LINK = 'http://passport.weibo.com/visitor/visitor?entry=miniblog'
+
+
+def fake_link(link):
+    """
+    Return the link to be downloaded through the fake proxy.
+    """
+    if link.startswith('https://'):
+        return 'http://' + link[len('https://'):]
+    return link
+
+
+def _page_key(url):
+    """
+    Return the key of a url ignoring the scheme and the uuid appended to
+    resubmitted links.
+    """
+    url = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(url.query,
+                                                       keep_blank_values=True)
+             if k != 'uuid']
+    return (url.netloc, url.path, urllib.parse.urlencode(query))
+
+
+def default_page(url):
+    """
+    Return a tuple of (content type, body) of an empty but well-formed page
+    of the url shapes in sinaspider.sina_pipeline.
+    """
+    path = urllib.parse.urlsplit(url).path
+    if 'mblog/info/big' in path:
+        data = {'html': '', 'page': {'totalpage': 1, 'pagenum': 1}}
+    elif 'mblog/getlongtext' in path:
+        data = {'html': ''}
+    elif 'mblog/mbloglist' in path:
+        data = ''
+    else:
+        return ('text/html; charset=utf-8',
+                b'<html><head></head><body></body></html>')
+    return ('application/json; charset=utf-8',
+            json.dumps({'code': '100000', 'data': data}).encode())
+
+
+class FakeWeiboHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/'):
+            self._direct()
+            return
+        url = self.path
+        server.count('requests')
+        split = urllib.parse.urlsplit(url)
+        if split.path == '/sorry' or 'passport.weibo.com' in split.netloc:
+            self._reply(200, 'text/html; charset=utf-8', b'<html></html>')
+            return
+        fault = server.draw_fault()
+        if fault:
+            server.count(fault)
+        if fault == 'sysbusy':
+            self._redirect(_SYSBUSY_LINK)
+        elif fault == 'passport':
+            self._redirect(_PASSPORT_LINK)
+        elif fault == 'timeout':
+            time.sleep(server.hang)
+            self.close_connection = True
+        else:
+            if fault == 'slow':
+                time.sleep(server.slow_delay)
+            content_type, body = server.page(url)
+            server.count('served')
+            self._reply(200, content_type, body)
+
+    def _direct(self):
+        server = self.server
+        if self.path.startswith('/proxies'):
+            body = '%s:%s' % server.server_address[:2]
+            self._reply(200, 'text/plain', body.encode())
+        elif self.path.startswith('/stats'):
+            self._reply(200, 'application/json',
+                        json.dumps(server.stats()).encode())
+        else:
+            self._reply(404, 'text/plain', b'Not found')
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWeiboServer(http.server.ThreadingHTTPServer):
+    """
+    A fake Weibo serving on a local port from its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, corpus=None, sysbusy=0, passport=0, slow=0,
+                 timeout=0, slow_delay=1, hang=30, seed=None):
+        """
+        Input:
+        - port: An integer of the port to listen on. 0 picks a free one.
+        - corpus: A string of a corpus directory recorded by
+                  sinaspider.replay.CorpusWriter. Pages not in the corpus are
+                  served by default_page().
+        - sysbusy, passport, slow, timeout: Floats of fault rates.
+        - slow_delay: A float of seconds to delay a slow response.
+        - hang: A float of seconds to hold a timed out response.
+        - seed: A seed of the fault generator.
+        """
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', port),
+                                                 FakeWeiboHandler)
+        self.faults = [('sysbusy', sysbusy), ('passport', passport),
+                       ('slow', slow), ('timeout', timeout)]
+        self.slow_delay = slow_delay
+        self.hang = hang
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.pages = dict() # _page_key -> (content type, body)
+        if corpus:
+            for page in read_corpus(corpus):
+                content_type = page.content_type or 'text/html'
+                if page.charset:
+                    content_type += '; charset=%s' % page.charset
+                self.pages[_page_key(page.url)] = (content_type, page.body)
+        self.thread = None
+
+    @property
+    def proxy(self):
+        """
+        A ProxyAddress of the server.
+        """
+        return ProxyAddress(*self.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(name=self.__class__.__name__,
+                                       target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def draw_fault(self):
+        """
+        Return the name of a fault to inject, or None.
+        """
+        with self.lock:
+            value = self.random.random()
+        for name, rate in self.faults:
+            if value < rate:
+                return name
+            value -= rate
+        return None
+
+    def page(self, url):
+        page = self.pages.get(_page_key(url))
+        if page is None:
+            page = default_page(url)
+        return page
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class LocalScheduler(object):
+    """
+    An in-process scheduler which replaces the SchedulerConnectionPool of
+    downloaders. Links are handed out once; resubmitted links are queued
+    again.
+    """
+
+    def __init__(self, links, proxies, topic_links=()):
+        """
+        Input:
+        - links: A list of strings of links.
+        - proxies: A list of ProxyAddress.
+        - topic_links: A list of strings of topic links.
+        """
+        self.lock = threading.Lock()
+        self.links = {DownloaderType.LINK_DOWNLOADER: list(links),
+                      DownloaderType.TOPIC_DOWNLOADER: list(topic_links)}
+        self.proxies = list(proxies)
+        self.resubmitted = 0
+        self.resigned = list() # Resigned ProxyAddress
+
+    def call(self, method, *args):
+        with self.lock:
+            return getattr(self, '_' + method)(*args)
+
+    def _register_downloader(self, name):
+        pass
+
+    def _unregister_downloader(self, name):
+        pass
+
+    def _request_user_identity(self, name):
+        return None
+
+    def _request_cookie(self, name):
+        return Cookie('fake', 'SUB=fake;SUBP=fake;')
+
+    def _request_proxies(self, name, size):
+        return self.proxies[:size]
+
+    def _resign_proxy(self, addr, name):
+        self.resigned.append(addr)
+
+    def _grab(self, dtype, size):
+        links = self.links[dtype]
+        batch = links[:size]
+        del links[:size]
+        return batch
+
+    def _grab_links(self, size):
+        return self._grab(DownloaderType.LINK_DOWNLOADER, size)
+
+    def _grab_topic_links(self, size):
+        return self._grab(DownloaderType.TOPIC_DOWNLOADER, size)
+
+    def _submit_links(self, links):
+        # Strip the uuid appended by Downloader._resubmit().
+        self.resubmitted += len(links)
+        self.links[DownloaderType.LINK_DOWNLOADER].extend(
+            link.rsplit('&uuid=', 1)[0] for link in links)
+
+    def _submit_topic_links(self, links):
+        self.resubmitted += len(links)
+        self.links[DownloaderType.TOPIC_DOWNLOADER].extend(links)
+
+    def pending(self):
+        with self.lock:
+            return sum(len(links) for links in self.links.values())
+
+
+class PageSink(object):
+    """
+    A stand-in of Pipeline for downloaders, which only collects the pages.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = list()
+
+    def congested(self):
+        return False
+
+    def feed(self, page):
+        with self.lock:
+            self.pages.append(page)
+        return True
@@ -0,0 +1,156 @@
+import json
+import socket
+import time
+import urllib.parse
+
+import pytest
+import requests
+
+import sinaspider.downloader
+from sinaspider.downloader import Downloader, DownloaderType
+from sinaspider.proxy import ProxyTracker
+import sinaspider.ratelimit
+from sinaspider.ratelimit import RateLimiter
+from sinaspider.sina_pipeline import (_RETWEET_LINKS, _TOPIC_PAGE_LINK,
+                                      _TRENDING_TWEETS_LINK, _USER_TWEETS_LINKS)
+from tests.system_tests.fake_weibo import *
+
+
+@pytest.fixture
+def server():
+    server = FakeWeiboServer(sysbusy=0.1, passport=0.05, slow=0.05,
+                             timeout=0.05, slow_delay=0.05, hang=1, seed=7)
+    server.start()
+    yield server
+    server.stop()
+
+
+def _links(count):
+    links = [fake_link(_TRENDING_TWEETS_LINK)]
+    for idx in range(count - 1):
+        if idx % 3 == 0:
+            link = _RETWEET_LINKS % (idx, 1, idx)
+        elif idx % 3 == 1:
+            link = _USER_TWEETS_LINKS['top_page'] % (100505, idx, 100505, 100505, 2018)
+        else:
+            link = _TOPIC_PAGE_LINK % idx
+        links.append(fake_link(link))
+    return links
+
+
+def test_direct_endpoints(server):
+    base = 'http://%s:%s' % server.server_address[:2]
+    assert requests.get(base + '/proxies').text == '%s:%s' % server.server_address[:2]
+    assert json.loads(requests.get(base + '/stats').text) == {}
+
+
+def test_downloaders(server, monkeypatch):
+    config = sinaspider.downloader.DOWNLOADER_CONFIG
+    monkeypatch.setitem(config, 'requests_timeout', 0.5)
+    monkeypatch.setitem(config, 'cookie_update_interval', 0)
+    monkeypatch.setitem(sinaspider.downloader.SCHEDULER_CONFIG,
+                        'client_failover_interval', 0.1)
+    sysbusy = sinaspider.downloader._SYSBUSY.series.get((), 0)
+    expired = sinaspider.downloader._EXPIRED.series.get((), 0)
+    slowdowns = sinaspider.ratelimit._SLOWDOWNS.series.get((), 0)
+    links = _links(60)
+    scheduler = LocalScheduler(links, [server.proxy])
+    sink = PageSink()
+    # Fast enough for the test, while sysbusy still slows the pairs down.
+    limiter = RateLimiter(200, 20, 50, 400, 10, 0.5, 0.1)
+    downloaders = list()
+    for idx in range(4):
+        downloader = Downloader('fake-%s' % idx, sink,
+                                DownloaderType.LINK_DOWNLOADER)
+        downloader.pool = scheduler
+        downloader.limiter = limiter
+        downloader.update_proxies_callback()
+        downloader.start()
+        downloaders.append(downloader)
+    deadline = time.time() + 60
+    while len(sink.pages) < len(links) and time.time() < deadline:
+        time.sleep(0.1)
+    for downloader in downloaders:
+        downloader.stop()
+    for downloader in downloaders:
+        downloader.join()
+
+    assert sorted(page.url for page in sink.pages) == sorted(links)
+    for page in sink.pages:
+        assert page.status == 200
+        assert urllib.parse.urlsplit(page.final_url).netloc.endswith('weibo.com')
+        assert 'sorry' not in page.final_url
+        assert 'passport' not in page.final_url
+    stats = server.stats()
+    assert stats['served'] == len(links)
+    for fault in ('sysbusy', 'passport', 'slow', 'timeout'):
+        assert stats[fault] > 0
+    assert sinaspider.downloader._SYSBUSY.series[()] - sysbusy == stats['sysbusy']
+    assert sinaspider.downloader._EXPIRED.series[()] - expired == stats['passport']
+    assert sinaspider.ratelimit._SLOWDOWNS.series[()] - slowdowns > 0
+
+
+def test_dead_proxy_resigned(monkeypatch):
+    monkeypatch.setitem(sinaspider.downloader.DOWNLOADER_CONFIG,
+                        'cookie_update_interval', 0)
+    monkeypatch.setitem(sinaspider.downloader.SCHEDULER_CONFIG,
+                        'client_failover_interval', 0.1)
+    # No faults, so that only the dead proxy fails.
+    server = FakeWeiboServer()
+    server.start()
+    try:
+        # A port nobody listens on.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = ProxyAddress(*sock.getsockname())
+        sock.close()
+        links = _links(10)
+        scheduler = LocalScheduler(links, [dead, server.proxy])
+        sink = PageSink()
+        downloader = Downloader('fake-0', sink, DownloaderType.LINK_DOWNLOADER)
+        downloader.pool = scheduler
+        downloader.limiter = RateLimiter(200, 20, 50, 400, 10, 0.5, 0.1)
+        # The seed draws the dead proxy first.
+        downloader.proxies = ProxyTracker(max_failures=1, seed=0)
+        downloader.update_proxies_callback()
+        downloader.start()
+        deadline = time.time() + 30
+        while len(sink.pages) < len(links) and time.time() < deadline:
+            time.sleep(0.1)
+        downloader.stop()
+        downloader.join()
+    finally:
+        server.stop()
+
+    assert len(sink.pages) == len(links)
+    assert scheduler.resigned == [dead]
+    assert downloader.proxies.healthy() == [server.proxy]
+
+
+def test_throttled_proxy_not_scored(monkeypatch):
+    monkeypatch.setitem(sinaspider.downloader.DOWNLOADER_CONFIG,
+                        'cookie_update_interval', 0)
+    monkeypatch.setitem(sinaspider.downloader.SCHEDULER_CONFIG,
+                        'client_failover_interval', 0.1)
+    server = FakeWeiboServer(sysbusy=1)
+    server.start()
+    try:
+        scheduler = LocalScheduler(_links(1), [server.proxy])
+        downloader = Downloader('fake-0', PageSink(),
+                                DownloaderType.LINK_DOWNLOADER)
+        downloader.pool = scheduler
+        downloader.limiter = RateLimiter(200, 20, 50, 400, 10, 0.5, 0.1)
+        downloader.update_proxies_callback()
+        downloader.start()
+        deadline = time.time() + 10
+        while server.stats().get('sysbusy', 0) < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        downloader.stop()
+        downloader.join()
+    finally:
+        server.stop()
+
+    assert server.stats()['sysbusy'] >= 3
+    # Sysbusy responses neither vouch for the proxy nor count as failures.
+    stats = downloader.proxies.stats[server.proxy]
+    assert (stats.ok, stats.latency, stats.failures) == (1.0, 1.0, 0)
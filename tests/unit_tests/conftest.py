@@ -7,3 +7,12 @@ def init_logger():
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
     yield None
+
+@pytest.fixture(autouse=True)
+def metrics_dir(tmpdir, monkeypatch):
+    """
+    Keep metrics snapshots of the tested processes out of the project.
+    """
+    import sinaspider.metrics
+    monkeypatch.setitem(sinaspider.metrics.METRICS_CONFIG, 'dir',
+                        str(tmpdir.join('metrics')))
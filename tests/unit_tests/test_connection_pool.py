@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+from thrift.protocol import TBinaryProtocol
+from thrift.server import TServer
+from thrift.transport import TTransport, TSocket
+
+from sinaspider.connection_pool import CONNECTION_ERRORS, SchedulerConnectionPool
+import sinaspider.services.scheduler_service as scheduler_service
+
+
+class EchoHandler(scheduler_service.Iface):
+    def __init__(self):
+        self.calls = 0
+
+    def grab_links(self, size):
+        self.calls += 1
+        if size < 0:
+            time.sleep(0.5) # Longer than the client timeout
+        return ['http://%s' % i for i in range(size)]
+
+    def submit_links(self, links):
+        self.calls += 1
+        time.sleep(0.5)
+        return 0
+
+
+class TestSchedulerConnectionPool:
+    def setup_method(self, method):
+        self.handler = EchoHandler()
+        server_transport = TSocket.TServerSocket('127.0.0.1', 0)
+        self.server = TServer.TThreadedServer(
+            scheduler_service.Processor(self.handler), server_transport,
+            TTransport.TBufferedTransportFactory(),
+            TBinaryProtocol.TBinaryProtocolFactory(), daemon=True)
+        server_transport.listen()
+        server_transport.listen = lambda: None
+        self.port = server_transport.handle.getsockname()[1]
+        thread = threading.Thread(target=self.server.serve)
+        thread.daemon = True
+        thread.start()
+        self.pool = SchedulerConnectionPool('127.0.0.1', self.port, 4, 5, 60, 3,
+                                            0.01, 0.1)
+
+    def teardown_method(self, method):
+        self.pool.close()
+
+    def test_reuse(self):
+        assert self.pool.call('grab_links', 2) == ['http://0', 'http://1']
+        conn = self.pool.idle[-1]
+        assert self.pool.call('grab_links', 1) == ['http://0']
+        assert len(self.pool.idle) == 1
+        assert self.pool.idle[-1] is conn
+
+    def test_reconnect(self):
+        self.pool.call('grab_links', 1)
+        conn = self.pool.idle[-1]
+        conn.socket.handle.close()
+        assert self.pool.call('grab_links', 1) == ['http://0']
+        assert self.pool.idle[-1] is not conn
+
+    def test_lost_reply(self):
+        pool = SchedulerConnectionPool('127.0.0.1', self.port, 4, 0.1, 60, 3,
+                                       0.01, 0.1)
+        try:
+            # The links granted are not asked for again.
+            with pytest.raises(CONNECTION_ERRORS):
+                pool.call('grab_links', -1)
+            assert self.handler.calls == 1
+            with pytest.raises(CONNECTION_ERRORS):
+                pool.call('submit_links', ['http://0'])
+            assert self.handler.calls == 4
+        finally:
+            pool.close()
+
+    def test_instance_per_process(self):
+        assert SchedulerConnectionPool.instance() is \
+            SchedulerConnectionPool.instance()
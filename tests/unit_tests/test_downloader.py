@@ -0,0 +1,26 @@
+import pickle
+import requests
+
+from sinaspider.downloader import FetchedPage, parse_content_type
+
+
+def test_parse_content_type():
+    assert parse_content_type('text/html; charset=utf-8') == ('text/html', 'utf-8')
+    assert parse_content_type('application/json;charset="GBK"') == \
+        ('application/json', 'GBK')
+    assert parse_content_type('text/html') == ('text/html', None)
+    assert parse_content_type(None) == (None, None)
+
+
+def test_fetched_page():
+    response = requests.Response()
+    response.status_code = 200
+    response.url = 'https://weibo.com/u/1?is_all=1'
+    response.headers['content-type'] = 'text/html; charset=gbk'
+    response._content = '微博'.encode('gbk')
+    page = FetchedPage.from_response('https://weibo.com/u/1', response)
+    assert page.url == 'https://weibo.com/u/1'
+    assert page.final_url == 'https://weibo.com/u/1?is_all=1'
+    assert page.text == '微博'
+    page = pickle.loads(pickle.dumps(page))
+    assert (page.status, page.content_type, page.charset) == (200, 'text/html', 'gbk')
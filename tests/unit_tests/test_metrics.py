@@ -0,0 +1,132 @@
+import json
+import multiprocessing
+import os
+import threading
+from os.path import join
+import time
+
+import pytest
+import requests
+
+import sinaspider.metrics
+from sinaspider.metrics import *
+
+
+def test_counter_and_gauge():
+    counter = Counter('test_total', 'Test.', ['status'])
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    counter.inc(status=404)
+    assert counter.series == {('200',): 3, ('404',): 1}
+    gauge = Gauge('test_gauge', 'Test.')
+    gauge.set(5)
+    gauge.dec(2)
+    assert gauge.series == {(): 3}
+
+
+def test_histogram():
+    histogram = Histogram('test_seconds', 'Test.', ['method'], (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, method='grab')
+    # Buckets of <= 0.1, <= 1 and +Inf, then sum and count
+    assert histogram.series[('grab',)] == [2, 1, 1, 2.65, 4]
+
+    @timed(histogram)
+    def submit(value):
+        return value
+    assert submit(1) == 1
+    assert submit.__name__ == 'submit'
+    assert histogram.series[('submit',)][-1] == 1
+
+
+def test_register():
+    metric = sinaspider.metrics.counter('test_register_total', 'Test.')
+    assert sinaspider.metrics.counter('test_register_total', 'Test.') is metric
+    with pytest.raises(AssertionError):
+        sinaspider.metrics.gauge('test_register_total', 'Test.')
+
+
+def _snapshot(directory, name, now, metrics):
+    with open(join(directory, '%s.json' % name), 'w') as fd:
+        json.dump({'name': name, 'pid': 1, 'time': now, 'metrics': metrics}, fd)
+
+
+def test_collect_and_render(tmpdir):
+    directory = str(tmpdir)
+    now = time.time()
+    histogram = {'kind': 'histogram', 'help': 'Latency.', 'labels': ['method'],
+                 'buckets': [0.1, 1], 'series': [[['grab'], [1, 1, 0, 0.6, 2]]]}
+    _snapshot(directory, 'a', now - 120, {
+        'requests_total': {'kind': 'counter', 'help': 'Requests.',
+                           'labels': ['status'], 'series': [[['200'], 3]]},
+        'depth': {'kind': 'gauge', 'help': 'Depth.', 'labels': [],
+                  'series': [[[], 9]]},
+        'latency': histogram})
+    _snapshot(directory, 'b', now - 2, {
+        'requests_total': {'kind': 'counter', 'help': 'Requests.',
+                           'labels': ['status'],
+                           'series': [[['200'], 1], [['302'], 2]]},
+        'depth': {'kind': 'gauge', 'help': 'Depth.', 'labels': [],
+                  'series': [[[], 4]]},
+        'latency': histogram})
+    _snapshot(directory, 'c', now - 1, {
+        'depth': {'kind': 'gauge', 'help': 'Depth.', 'labels': [],
+                  'series': [[[], 5]]}})
+    merged = collect(directory, 60)
+    # Counters of exited processes are kept, stale gauges are not.
+    assert merged['requests_total']['series'] == {('200',): 4, ('302',): 2}
+    assert merged['depth']['series'] == {(): 5}
+    assert merged['latency']['series'] == {('grab',): [2, 2, 0, 1.2, 4]}
+    text = render(merged)
+    assert '# TYPE requests_total counter\n' in text
+    assert 'requests_total{status="302"} 2\n' in text
+    assert 'depth 5\n' in text
+    assert 'latency_bucket{method="grab",le="0.1"} 2\n' in text
+    assert 'latency_bucket{method="grab",le="1.0"} 4\n' in text
+    assert 'latency_bucket{method="grab",le="+Inf"} 4\n' in text
+    assert 'latency_count{method="grab"} 4\n' in text
+
+
+def _child(name):
+    sinaspider.metrics.start(name)
+    sinaspider.metrics.counter('test_fork_total', 'Test.').inc()
+    sinaspider.metrics.stop()
+
+
+def test_snapshots_across_processes(tmpdir, monkeypatch):
+    monkeypatch.setitem(sinaspider.metrics.METRICS_CONFIG, 'dir', str(tmpdir))
+    counter = sinaspider.metrics.counter('test_fork_total', 'Test.')
+    sinaspider.metrics.start('parent')
+    try:
+        counter.inc(5)
+        process = multiprocessing.get_context('fork').Process(
+            target=_child, args=('child',))
+        process.start()
+        process.join()
+    finally:
+        sinaspider.metrics.stop()
+    names = sorted(os.listdir(str(tmpdir)))
+    assert names == ['child-%s.json' % process.pid,
+                     'parent-%s.json' % os.getpid()]
+    # The child does not count the updates inherited from the parent.
+    merged = collect(str(tmpdir), 60)
+    assert merged['test_fork_total']['series'] == {(): 6}
+
+
+def test_metrics_server(tmpdir):
+    _snapshot(str(tmpdir), 'a', time.time(), {
+        'requests_total': {'kind': 'counter', 'help': 'Requests.',
+                           'labels': [], 'series': [[[], 3]]}})
+    server = MetricsServer('127.0.0.1', 0, str(tmpdir), 60)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        base = 'http://%s:%s' % server.server_address[:2]
+        response = requests.get(base + '/metrics')
+        assert response.status_code == 200
+        assert 'requests_total 3\n' in response.text
+        assert requests.get(base + '/other').status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
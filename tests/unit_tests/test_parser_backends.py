@@ -0,0 +1,44 @@
+"""
+Golden tests of the tweet page parsers. Every backend must produce the
+output recorded in fixtures/<page>.json.
+"""
+
+import json
+from os.path import join, abspath, dirname
+import pytest
+
+import sinaspider.sina_pipeline
+from sinaspider.sina_pipeline import *
+
+_FIXTURES = join(dirname(abspath(__file__)), 'fixtures')
+_BACKENDS = ['bs4', 'lxml']
+
+def _read(name):
+    with open(join(_FIXTURES, name), encoding='utf-8') as fd:
+        return fd.read()
+
+def _normalize(result):
+    """
+    Turn parser output into json-compatible lists.
+    """
+    return [[[type(entry).__name__, entry.as_dict()] for entry in part]
+            if type(part) is list else part for part in result]
+
+@pytest.fixture(params=_BACKENDS)
+def backend(request, monkeypatch):
+    monkeypatch.setitem(sinaspider.sina_pipeline.PIPELINE_CONFIG,
+                        'parser_backend', request.param)
+    return request.param
+
+def test_tweet_page_parser(backend):
+    result = tweet_page_parser(_read('tweet_page.html'), paging_info=True)
+    assert _normalize(result) == json.loads(_read('tweet_page.json'))
+
+def test_retweet_list_page_parser(backend):
+    result = retweet_list_page_parser(_read('retweet_list_page.html'),
+                                      4215800000000000, 1618051664)
+    assert _normalize(result) == json.loads(_read('retweet_list_page.json'))
+
+def test_empty_page(backend):
+    assert tweet_page_parser('') == ([], [], [], 0)
+    assert retweet_list_page_parser('', 1, 2) == ([], [])
@@ -0,0 +1,135 @@
+import queue
+
+import pytest
+
+import sinaspider.pipeline
+from sinaspider.downloader import FetchedPage
+from sinaspider.pipeline import Pipeline, PipelineNode
+
+
+def _page(idx):
+    return FetchedPage('http://weibo.com/%s' % idx, 'http://weibo.com/%s' % idx,
+                       200, 'text/html', 'utf-8', b'')
+
+
+def _configure(monkeypatch, policy):
+    config = sinaspider.pipeline.PIPELINE_CONFIG
+    monkeypatch.setitem(config, 'high_watermark', 4)
+    monkeypatch.setitem(config, 'low_watermark', 2)
+    monkeypatch.setitem(config, 'overflow_policy', policy)
+    monkeypatch.setitem(config, 'block_timeout', 0.2)
+
+
+def test_congested(monkeypatch):
+    _configure(monkeypatch, 'shed')
+    pipeline = Pipeline('test', None, queue.Queue())
+    for idx in range(3):
+        assert pipeline.feed(_page(idx))
+        assert not pipeline.congested()
+    assert pipeline.feed(_page(3))
+    assert pipeline.congested()
+    # Stays congested until drained to the low watermark.
+    pipeline.eat()
+    assert pipeline.congested()
+    pipeline.eat()
+    assert not pipeline.congested()
+
+
+def test_feed_shed(monkeypatch):
+    _configure(monkeypatch, 'shed')
+    pipeline = Pipeline('test', None, queue.Queue())
+    for idx in range(4):
+        assert pipeline.feed(_page(idx))
+    assert not pipeline.feed(_page(4))
+    assert pipeline.queue.qsize() == 4
+
+
+def test_feed_block(monkeypatch):
+    _configure(monkeypatch, 'block')
+    pipeline = Pipeline('test', None, queue.Queue())
+    for idx in range(4):
+        assert pipeline.feed(_page(idx))
+    # Held until the block timeout expires, then shed.
+    assert not pipeline.feed(_page(4))
+    pipeline.eat()
+    pipeline.eat()
+    assert pipeline.feed(_page(4))
+    assert pipeline.queue.qsize() == 3
+
+
+class BatchRecorder(PipelineNode):
+    def __init__(self, name, events):
+        PipelineNode.__init__(self, name)
+        self.events = events
+
+    def begin_batch(self):
+        self.events.append((self.name, 'begin'))
+
+    def run(self, client, page):
+        self.events.append((self.name, page.url))
+        return (page, )
+
+    def end_batch(self):
+        self.events.append((self.name, 'end'))
+
+
+def test_eat_batch():
+    pipeline = Pipeline('test', None, queue.Queue())
+    with pytest.raises(queue.Empty):
+        pipeline.eat_batch(4, 0.01, 0.01)
+    for idx in range(6):
+        pipeline.feed(_page(idx))
+    assert [page.url for page in pipeline.eat_batch(4, 1)] == \
+        ['http://weibo.com/%s' % idx for idx in range(4)]
+    # Returns what arrived once latency expires.
+    assert len(pipeline.eat_batch(4, 0.01)) == 2
+
+
+def test_start_batch():
+    events = []
+    head = BatchRecorder('head', events)
+    left = BatchRecorder('left', events)
+    right = BatchRecorder('right', events)
+    tail = BatchRecorder('tail', events)
+    head.forward(left)
+    head.forward(right)
+    left.forward(tail)
+    right.forward(tail)
+    pipeline = Pipeline('test', head, queue.Queue())
+    pipeline.register_scheduler_client(object())
+    assert pipeline.nodes() == [head, left, tail, right]
+    pipeline.start_batch([_page(0), _page(1)])
+    # Shared nodes see the batch hooks once.
+    assert events.count(('tail', 'begin')) == 1
+    assert events.count(('tail', 'end')) == 1
+    assert events.count(('tail', 'http://weibo.com/1')) == 2
+    assert events[:4] == [(node, 'begin') for node in
+                          ('head', 'left', 'tail', 'right')]
+    assert events[-4:] == [(node, 'end') for node in
+                           ('head', 'left', 'tail', 'right')]
+
+
+def test_observer_and_recorder():
+    head = BatchRecorder('head', [])
+    tail = BatchRecorder('tail', [])
+    head.forward(tail)
+    pipeline = Pipeline('test', head, queue.Queue())
+    pipeline.register_scheduler_client(object())
+    observed = []
+    pipeline.register_observer(lambda node, seconds: observed.append(
+        (node.name, seconds >= 0)))
+    recorded = []
+    pipeline.register_recorder(FakeRecorder(recorded))
+    pipeline.feed(_page(0))
+    pipeline.start(pipeline.eat())
+    assert observed == [('head', True), ('tail', True)]
+    assert sinaspider.pipeline._NODE_SECONDS.series[('tail',)][-1] >= 1
+    assert [page.url for page in recorded] == ['http://weibo.com/0']
+
+
+class FakeRecorder(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def write(self, page):
+        self.pages.append(page)
@@ -0,0 +1,91 @@
+import collections
+
+from sinaspider.proxy import *
+from sinaspider.services.ttypes import ProxyAddress
+
+
+def _proxies(num):
+    return [ProxyAddress('10.10.18.%s' % i, 8000 + i) for i in range(num)]
+
+
+def test_is_banned():
+    assert not is_banned(200, 'https://weibo.com/u/1')
+    assert not is_banned(302, 'https://passport.weibo.com/visitor/visitor')
+    assert is_banned(407, 'https://weibo.com/u/1')
+    assert not is_banned(200, 'https://login.sina.com.cn:443/sso/login.php')
+    assert is_banned(200, 'http://10.0.0.1:8080/login')
+    assert is_banned(200, 'https://notweibo.com/u/1')
+    assert is_banned(200, 'https://weibo.com.evil.net/u/1')
+
+
+def test_weighted_sample():
+    tracker = ProxyTracker(seed=1)
+    fast, slow = _proxies(2)
+    tracker.update([fast, slow])
+    for _ in range(20):
+        tracker.success(fast, 0.1)
+        tracker.success(slow, 2)
+    counts = collections.Counter(tracker.choose() for _ in range(1000))
+    assert counts[fast] > 10 * counts[slow] > 0
+    assert sorted(tracker.sample(5), key=str) == sorted([fast, slow], key=str)
+    # Health is kept for the proxies granted again.
+    tracker.update([fast, _proxies(3)[2]])
+    assert len(tracker) == 2
+    assert tracker.stats[fast].latency < 0.2
+
+
+def test_quarantine():
+    tracker = ProxyTracker(max_failures=2, quarantine=10, max_strikes=3)
+    good, bad = _proxies(2)
+    tracker.add([good, bad])
+    assert not tracker.failure(bad, now=0)
+    assert tracker.failure(bad, now=1)
+    assert tracker.healthy(now=5) == [good]
+    assert tracker.sample(5, now=5) == [good]
+    assert sorted(tracker.healthy(now=11), key=str) == sorted([good, bad], key=str)
+    # Quarantined again without a success in between, for twice as long.
+    assert tracker.quarantine(bad, now=12)
+    assert tracker.healthy(now=31) == [good]
+    assert tracker.healthy(now=32) != [good]
+    # All in quarantine, the ones released the soonest are drawn.
+    assert tracker.quarantine(good, now=30)
+    assert not tracker.quarantine(good, now=31)
+    assert tracker.sample(1, now=31) == [bad]
+    # Dropped after max_strikes quarantines.
+    assert tracker.quarantine(bad, now=33)
+    assert bad not in tracker
+    assert not tracker.failure(bad)
+    # A success resets the strikes.
+    tracker.success(good, 0.5)
+    assert tracker.stats[good].strikes == 0
+
+
+def test_prune():
+    tracker = ProxyTracker()
+    proxies = _proxies(4)
+    assert tracker.add(proxies) == 4
+    assert tracker.add(proxies[:1]) == 0
+    for proxy in proxies[:2]:
+        tracker.success(proxy, 0.1)
+    tracker.prune(2)
+    assert sorted(tracker, key=str) == sorted(proxies[:2], key=str)
+
+
+def test_prune_quarantined_and_stale():
+    # As the scheduler sees them: only quarantines, no successes.
+    tracker = ProxyTracker()
+    old = _proxies(3)
+    new = [ProxyAddress('10.10.19.%s' % i, 9000 + i) for i in range(3)]
+    tracker.add(old)
+    tracker.quarantine(old[0])
+    tracker.quarantine(old[1])
+    # A resigned proxy is drawn less once released.
+    assert tracker.stats[old[0]].ok < tracker.stats[old[2]].ok
+    tracker.add(new)
+    tracker.prune(3)
+    assert sorted(tracker, key=str) == sorted(new, key=str)
+    # Listed again by the provider, a proxy is recent again.
+    tracker.add(new[:1])
+    tracker.add(old[2:])
+    tracker.prune(2)
+    assert sorted(tracker, key=str) == sorted([new[0], old[2]], key=str)
@@ -0,0 +1,54 @@
+import pytest
+
+from sinaspider.ratelimit import *
+
+
+def _bucket(now):
+    return TokenBucket(rate=2, burst=2, min_rate=0.5, max_rate=4, increase=1,
+                       decrease=0.5, cooldown=1, now=now)
+
+
+def test_reserve():
+    bucket = _bucket(0)
+    assert bucket.reserve(0) == 0
+    assert bucket.reserve(0) == 0
+    # Requests beyond the burst are spaced by 1 / rate.
+    assert bucket.reserve(0) == pytest.approx(0.5)
+    assert bucket.reserve(0) == pytest.approx(1)
+    assert bucket.reserve(10) == 0
+    assert bucket.tokens == 1
+
+
+def test_aimd():
+    bucket = _bucket(0)
+    assert bucket.sysbusy(0)
+    assert bucket.rate == 1
+    assert bucket.tokens == 0
+    # Sysbusy responses within the cooldown count as one.
+    assert not bucket.sysbusy(0.5)
+    assert bucket.rate == 1
+    assert bucket.sysbusy(1)
+    assert bucket.sysbusy(2)
+    assert bucket.rate == 0.5
+    bucket.success(3)
+    assert bucket.rate == 2.5
+    bucket.success(3)
+    assert bucket.rate == 2.9
+    for _ in range(10):
+        bucket.success(3)
+    assert bucket.rate == 4
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(2, 1, 0.5, 4, 1, 0.5, 1)
+    assert limiter.reserve('weibo.com', 'http://a:1') == 0
+    assert limiter.reserve('weibo.com', 'http://a:1') > 0
+    # Pairs of host and proxy are limited separately.
+    assert limiter.reserve('weibo.com', 'http://b:1') == 0
+    assert limiter.reserve('d.weibo.com', 'http://a:1') == 0
+    limiter.sysbusy('weibo.com', 'http://a:1')
+    assert limiter.rate('weibo.com', 'http://a:1') == 1
+    assert limiter.rate('weibo.com', 'http://b:1') == 2
+    limiter.success('weibo.com', 'http://b:1')
+    assert limiter.rate('weibo.com', 'http://b:1') == 2.5
+    assert RateLimiter.instance() is RateLimiter.instance()
@@ -0,0 +1,44 @@
+from sinaspider.downloader import DownloaderType, FetchedPage
+from sinaspider.replay import *
+
+
+def test_corpus_round_trip(tmpdir):
+    path = str(tmpdir.join('corpus'))
+    pages = [FetchedPage('http://weibo.com/1', 'https://weibo.com/1', 200,
+                         'text/html', 'utf-8', '微博'.encode(), 1528000000.5),
+             FetchedPage('http://weibo.com/2', 'http://weibo.com/sorry', 302,
+                         None, None, b'\x00\xff', 1528000001)]
+    writer = CorpusWriter(path)
+    writer.write(pages[0])
+    writer.close()
+    # Appends to an existing corpus.
+    writer = CorpusWriter(path)
+    writer.write(pages[1])
+    writer.close()
+    replayed = list(read_corpus(path))
+    assert len(replayed) == 2
+    for page, other in zip(pages, replayed):
+        assert (page.url, page.final_url, page.status, page.content_type,
+                page.charset, page.body, page.fetched_at) == \
+            (other.url, other.final_url, other.status, other.content_type,
+             other.charset, other.body, other.fetched_at)
+    assert replayed[0].text == '微博'
+
+
+def test_stub_scheduler_client():
+    client = StubSchedulerClient()
+    client.submit_links(['a', 'b'])
+    client.submit_links(['c'], DownloaderType.TOPIC_DOWNLOADER)
+    assert client.links[DownloaderType.LINK_DOWNLOADER] == 2
+    assert client.links[DownloaderType.TOPIC_DOWNLOADER] == 1
+
+
+def test_node_timer():
+    class Node(object):
+        name = 'node'
+    timer = NodeTimer()
+    assert timer.percentiles('node') == [0, 0, 0]
+    for idx in range(100):
+        timer(Node(), idx / 1000)
+    assert timer.percentiles('node') == [0.05, 0.09, 0.099]
+    assert timer.percentiles('node', (0, 100)) == [0, 0.099]
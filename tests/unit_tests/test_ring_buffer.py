@@ -0,0 +1,88 @@
+import multiprocessing
+import queue
+
+import pytest
+
+from sinaspider.downloader import FetchedPage
+from sinaspider.ring_buffer import *
+
+
+def _page(idx, size=16):
+    return FetchedPage('http://weibo.com/%s' % idx, 'https://weibo.com/%s' % idx,
+                       200, 'text/html', 'utf-8', bytes([idx % 256]) * size)
+
+
+def _consume(ring, count, results):
+    for _ in range(count):
+        page = ring.get(timeout=5)
+        results.put((page.url, page.final_url, len(page.body)))
+
+
+class TestPageRingBuffer(object):
+    def setup_method(self):
+        self.ring = PageRingBuffer(4, 1024)
+
+    def teardown_method(self):
+        self.ring.close()
+
+    def test_put_get(self):
+        page = _page(1)
+        self.ring.put(page)
+        assert self.ring.qsize() == 1
+        got = self.ring.get()
+        assert self.ring.qsize() == 0
+        assert got.url == page.url
+        assert got.final_url == page.final_url
+        assert got.status == 200
+        assert got.content_type == 'text/html'
+        assert got.charset == 'utf-8'
+        assert got.body == page.body
+        assert got.fetched_at == page.fetched_at
+
+    def test_empty_charset(self):
+        page = FetchedPage('http://weibo.com/1', 'http://weibo.com/1', 302,
+                           None, None, b'')
+        self.ring.put(page)
+        got = self.ring.get()
+        assert got.content_type is None
+        assert got.charset is None
+        assert got.body == b''
+
+    def test_wrap_around(self):
+        for idx in range(10):
+            self.ring.put(_page(idx))
+            assert self.ring.get().url == 'http://weibo.com/%s' % idx
+
+    def test_full_and_empty(self):
+        with pytest.raises(queue.Empty):
+            self.ring.get(timeout=0.01)
+        for idx in range(4):
+            self.ring.put(_page(idx))
+        with pytest.raises(queue.Full):
+            self.ring.put(_page(4), timeout=0.01)
+        assert [self.ring.get().url for _ in range(4)] == \
+            ['http://weibo.com/%s' % idx for idx in range(4)]
+
+    def test_too_large(self):
+        self.ring.put(_page(1))
+        self.ring.put(_page(2, 1024))
+        self.ring.put(_page(3))
+        assert self.ring.qsize() == 3
+        pages = [self.ring.get(timeout=5) for _ in range(3)]
+        assert [page.url for page in pages] == \
+            ['http://weibo.com/%s' % idx for idx in (1, 2, 3)]
+        assert pages[1].body == _page(2, 1024).body
+
+    def test_across_processes(self):
+        results = multiprocessing.Queue()
+        consumer = multiprocessing.Process(target=_consume,
+                                           args=(self.ring, 20, results))
+        consumer.start()
+        sizes = [2048 if idx % 5 == 0 else 512 for idx in range(20)]
+        for idx, size in enumerate(sizes):
+            self.ring.put(_page(idx, size), timeout=5)
+        consumer.join(10)
+        got = [results.get(timeout=5) for _ in range(20)]
+        assert got == [('http://weibo.com/%s' % idx,
+                        'https://weibo.com/%s' % idx, size)
+                       for idx, size in enumerate(sizes)]
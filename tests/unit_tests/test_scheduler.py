@@ -1,15 +1,32 @@
+import os
+import time
+
+import pytest
+
 from sinaspider.config import *
 from sinaspider.services.ttypes import *
-from sinaspider.scheduler import SchedulerServiceHandler
+from sinaspider.scheduler import *
+import sinaspider.sina_pipeline
+
+
+@pytest.fixture(autouse=True)
+def no_seeds(monkeypatch):
+    # Seeds would be emitted ahead of the links under test.
+    monkeypatch.setattr(sinaspider.sina_pipeline, 'seed_links',
+                        lambda num_topic_pages: ([], []))
 
 
 class TestSchedulerServiceHandler:
-    def setup_method(self, method):
+    @pytest.fixture(autouse=True)
+    def open_handler(self, tmpdir):
+        # Every test opens the LevelDBs of its own, and closes them so that
+        # their locks are released.
         self.handler = SchedulerServiceHandler()
+        self.handler._db_dir = str(tmpdir)
         self.handler.init()
         self.downloaders = ['downloader-'+str(i) for i in range(5)]
-    
-    def teardown_method(self, method):
+        yield
+        self.handler.close()
         self.handler = None
 
     def test_downloader(self):
@@ -57,7 +74,7 @@ class TestSchedulerServiceHandler:
         for i in range(num_batch):
             links = list()
             for j in range(batch):
-                links.append('http://%s' % j)
+                links.append('http://weibo.com/%s?j=%s' % (i, j))
             linkss.append(links)
         for i in range(int(num_batch/2)):
             assert self.handler.submit_links(linkss[i]) == RetStatus.SUCCESS
@@ -69,6 +86,9 @@ class TestSchedulerServiceHandler:
         for i in range(int(num_batch/4), num_batch):
             assert self.handler.grab_links(batch) == linkss[i]
         assert self.handler.grab_links(batch) == []
+        # Links handed out already are dead.
+        assert self.handler.submit_links(linkss[0]) == RetStatus.SUCCESS
+        assert self.handler.grab_links(batch) == []
     
     def test_proxies(self):
         proxies = list()
@@ -95,4 +115,306 @@ class TestSchedulerServiceHandler:
 
     @staticmethod
     def teardown_class(cls):
-        pass
\ No newline at end of file
+        pass
+
+
+class TestLinkFrontier:
+    def test_fifo(self, tmpdir):
+        frontier = LinkFrontier(str(tmpdir.join('frontier.db')), 3)
+        frontier.open()
+        records = [(b'%d' % i, b'http://%d' % i) for i in range(10)]
+        assert frontier.push(records) == 10
+        assert frontier.push(records[:5]) == 0
+        assert len(frontier) == 10
+        assert frontier.pop(4) == records[:4]
+        assert frontier.pop(4) == records[4:8]
+        assert b'8' in frontier
+        assert b'0' not in frontier
+        assert frontier.push(records[:1]) == 1
+        assert frontier.pop(10) == records[8:] + records[:1]
+        assert frontier.pop(10) == []
+        assert len(frontier) == 0
+        frontier.close()
+
+    def test_recover(self, tmpdir):
+        path = str(tmpdir.join('frontier.db'))
+        frontier = LinkFrontier(path, 2)
+        frontier.open()
+        records = [(b'%d' % i, b'http://%d' % i) for i in range(6)]
+        frontier.push(records)
+        assert frontier.pop(1) == records[:1]
+        frontier.close()
+        frontier = LinkFrontier(path, 2)
+        frontier.open()
+        assert len(frontier) == 5
+        assert frontier.pop(5) == records[1:]
+        frontier.close()
+
+
+class TestPriorityFrontier:
+    def setup_method(self, method):
+        self.priorities = {'TRENDING_WEIBO': 2, 'USER_WEIBO': 0}
+
+    def test_priorities(self, tmpdir):
+        frontier = PriorityFrontier(str(tmpdir), self.priorities, 3600, 3)
+        frontier.open()
+        low = [(b'l%d' % i, b'%d' % i) for i in range(4)]
+        high = [(b'h%d' % i, b'%d' % i) for i in range(3)]
+        assert frontier.push('USER_WEIBO', low) == 4
+        assert frontier.push('TRENDING_WEIBO', high) == 3
+        # Unknown classes are queued as undefined.
+        assert frontier.push('NEW_CLASS', [(b'u', b'')]) == 1
+        assert len(frontier) == 8
+        assert frontier.sizes() == {'TRENDING_WEIBO': 3, 'USER_WEIBO': 4,
+                                    'UNDEFINED': 1}
+        assert b'u' in frontier
+        assert frontier.pop(2) == high[:2]
+        # Spills over to the next class once a class is drained.
+        assert frontier.pop(3) == high[2:] + low[:2]
+        frontier.close()
+
+    def test_aging(self, tmpdir):
+        frontier = PriorityFrontier(str(tmpdir), self.priorities, 10, 3)
+        frontier.open()
+        frontier.push('USER_WEIBO', [(b'l', b'')])
+        frontier.push('TRENDING_WEIBO', [(b'h1', b''), (b'h2', b'')])
+        # Waited long enough to outrank the higher class.
+        frontier.waiting_since['USER_WEIBO'] -= 25
+        assert frontier.pop(1) == [(b'l', b'')]
+        assert frontier.pop(1) == [(b'h1', b'')]
+        frontier.close()
+
+    def test_recover(self, tmpdir):
+        frontier = PriorityFrontier(str(tmpdir), self.priorities, 3600, 3)
+        frontier.open()
+        frontier.push('USER_WEIBO', [(b'l', b'')])
+        frontier.push('TRENDING_WEIBO', [(b'h', b'')])
+        frontier.close()
+        frontier = PriorityFrontier(str(tmpdir), self.priorities, 3600, 3)
+        frontier.open()
+        assert frontier.pop(5) == [(b'h', b''), (b'l', b'')]
+        frontier.close()
+
+
+class TestTopicQueue:
+    def test_dedup(self):
+        queue = TopicQueue(3600)
+        links = ['https://d.weibo.com/100803?page=%d' % i for i in range(3)]
+        assert queue.push(links + links[:1]) == links
+        assert queue.push(links) == []
+        assert len(queue) == 3
+        assert queue.pop(2) == links[:2]
+        assert list(queue) == links[2:]
+
+    def test_next_due(self):
+        queue = TopicQueue(3600)
+        links = ['https://weibo.com/p/100808%d?from=faxian_huati' % i
+                 for i in range(3)]
+        queue.push(links)
+        assert queue.pop(2) == links[:2]
+        # Re-seeding queues only the links which are due.
+        assert queue.push(links) == []
+        queue.next_due[links[0]] -= 3600
+        assert queue.push(links) == links[:1]
+        # Forced links are queued anyway.
+        assert queue.push([links[1] + '&uuid=ff']) == links[1:2]
+        assert queue.pop(5) == [links[2], links[0], links[1]]
+
+    def test_prune(self):
+        queue = TopicQueue(0)
+        links = ['https://weibo.com/p/100808%d' % i for i in range(2000)]
+        queue.push(links)
+        queue.pop(2000)
+        assert len(queue.next_due) == 2000
+        assert queue.push(links[:1]) == links[:1]
+        assert len(queue.next_due) == 0
+
+
+class TestRecrawlScheduler:
+    def test_due(self):
+        scheduler = RecrawlScheduler(10, 100)
+        link = 'https://d.weibo.com/p/aj/v6/mblog/mbloglist?page=1'
+        topic_link = 'https://d.weibo.com/100803?page=1'
+        assert scheduler.add(link + '&uuid=ff', 20)
+        assert not scheduler.add(link, 20)
+        assert scheduler.add(topic_link, 1000, LinkType.TOPIC_LINK)
+        now = time.time()
+        assert scheduler.pop_due(now) == [(link, LinkType.LINK),
+                                          (topic_link, LinkType.TOPIC_LINK)]
+        assert scheduler.pop_due(now + 19) == []
+        assert scheduler.pop_due(now + 20) == [(link, LinkType.LINK)]
+        # The period is bounded by max_period.
+        assert scheduler.pop_due(now + 100) == [(link, LinkType.LINK),
+                                                (topic_link, LinkType.TOPIC_LINK)]
+
+    def test_adaptive_period(self):
+        scheduler = RecrawlScheduler(10, 100, speedup=0.5, backoff=2)
+        link = 'https://d.weibo.com/p/aj/v6/mblog/mbloglist?page=1'
+        scheduler.add(link, 40)
+        now = time.time()
+        scheduler.pop_due(now)
+        assert scheduler.report(link + '&_tries=2', 'a') is False
+        assert scheduler.seeds[link]['period'] == 40
+        # Repeated reports of an emission are ignored.
+        assert scheduler.report(link, 'b') is None
+        assert scheduler.pop_due(now + 40) == [(link, LinkType.LINK)]
+        # Unchanged content backs off from when the seed was emitted.
+        assert scheduler.report(link, 'a') is False
+        assert scheduler.seeds[link]['period'] == 80
+        assert scheduler.pop_due(now + 119) == []
+        assert scheduler.pop_due(now + 120) == [(link, LinkType.LINK)]
+        # Changed content speeds up, down to min_period.
+        due = now + 120
+        for digest in ('b', 'c', 'b'):
+            assert scheduler.report(link, digest) is True
+            due += scheduler.seeds[link]['period']
+            assert scheduler.pop_due(due) == [(link, LinkType.LINK)]
+        assert scheduler.seeds[link]['period'] == 10
+        assert scheduler.report('https://weibo.com/u/1', 'a') is None
+
+
+def test_recrawl_seeds(tmpdir, monkeypatch):
+    link = 'https://d.weibo.com/p/aj/v6/mblog/mbloglist?page=1'
+    topic_link = 'https://d.weibo.com/100803?page=1'
+    monkeypatch.setattr(sinaspider.sina_pipeline, 'seed_links',
+                        lambda num_topic_pages: ([link], [topic_link]))
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    handler.init()
+    # Seeds are due at start, and are emitted even if crawled before.
+    assert handler.grab_links(5) == [link]
+    assert handler.grab_topic_links(5) == [topic_link]
+    assert handler.grab_links(5) == []
+    handler.recrawl.seeds[link]['due'] = 0
+    handler.recrawl.heap = [(0, link)]
+    assert handler.grab_links(5) == [link]
+    assert handler.report_seed(link, 'a') == RetStatus.SUCCESS
+    assert handler.report_seed(link, 'a') == RetStatus.FAILED
+    assert handler.report_seed('https://weibo.com/u/1', 'a') == RetStatus.FAILED
+    seeds = handler.recrawl.seeds
+    handler.close()
+    # The seed state survives restarts, so seeds are not due again at start.
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    handler.init()
+    assert handler.recrawl.seeds == seeds
+    assert handler.grab_links(5) == []
+    assert handler.grab_topic_links(5) == []
+    handler.close()
+
+
+def test_proxy_health(tmpdir, monkeypatch):
+    monkeypatch.setitem(SCHEDULER_CONFIG, 'proxy_max_strikes', 2)
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    handler.init()
+    assert handler.request_proxy('downloader-0') == ProxyAddress('NULL', 0)
+    proxies = [ProxyAddress('10.10.18.%s' % i, 8000 + i) for i in range(3)]
+    assert handler.submit_proxies(proxies) == RetStatus.SUCCESS
+    assert handler.resign_proxy(proxies[0], 'downloader-0') == RetStatus.SUCCESS
+    # Quarantined proxies are not handed out.
+    for _ in range(5):
+        assert sorted(handler.request_proxies('downloader-0', 5), key=str) == \
+            proxies[1:]
+        assert handler.request_proxy('downloader-0') in proxies[1:]
+    handler.proxies.stats[proxies[0]].released = 0
+    assert handler.resign_proxy(proxies[0], 'downloader-0') == RetStatus.SUCCESS
+    assert proxies[0] not in handler.proxies
+    assert handler.resign_proxy(proxies[0], 'downloader-0') == RetStatus.FAILED
+    handler.close()
+
+
+def test_topic_links(tmpdir):
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    handler.init()
+    links = ['https://d.weibo.com/100803?page=%d' % i for i in range(3)]
+    handler.submit_topic_links(links)
+    assert handler.grab_topic_links(2) == links[:2]
+    handler.submit_topic_links(links)
+    assert handler.grab_topic_links(5) == links[2:]
+    fresh = 'https://d.weibo.com/100803?page=3'
+    handler.submit_topic_links(links[:1] + [fresh])
+    handler.close()
+    # Queued topic links survive a restart.
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    handler.init()
+    assert handler.grab_topic_links(5) == [fresh]
+    handler.close()
+
+
+def test_grab_links_by_priority(tmpdir):
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    # Links left by the FIFO frontier of older versions are migrated.
+    legacy = LinkFrontier(str(tmpdir.join('frontier.db')), 10)
+    legacy.open()
+    user_weibo = 'https://weibo.com/p/aj/v6/mblog/mbloglist?id=1'
+    link, tries, _ = canonicalize_link(user_weibo)
+    legacy.push([(link_fingerprint(link),
+                  handler._LINK_TRIES.pack(tries) + link.encode())])
+    legacy.close()
+    handler.init()
+    assert not os.path.exists(str(tmpdir.join('frontier.db')))
+    trending = 'https://d.weibo.com/p/aj/v6/mblog/mbloglist?id=2'
+    long_text = 'https://weibo.com/p/aj/mblog/getlongtext?mid=3'
+    handler.submit_links([trending, long_text])
+    assert handler.grab_links(5) == [trending, long_text, user_weibo]
+    handler.close()
+
+
+def test_canonicalize_link():
+    link = 'HTTPS://Weibo.com/p/aj?b=2&a=1&uuid=ff&_tries=2&__rnd=123#top'
+    assert canonicalize_link(link) == ('https://weibo.com/p/aj?a=1&b=2', 2, True)
+    assert canonicalize_link('https://weibo.com') == ('https://weibo.com/', 1, False)
+    assert canonicalize_link('https://weibo.com/u/1&uuid=ff') == \
+        ('https://weibo.com/u/1', 1, True)
+    assert link_fingerprint(canonicalize_link(link)[0]) == \
+        link_fingerprint(canonicalize_link('https://weibo.com/p/aj?a=1&b=2')[0])
+    assert len(link_fingerprint('https://weibo.com/')) == 8
+    assert render_link('https://weibo.com/p/aj?a=1', 3) == \
+        'https://weibo.com/p/aj?a=1&_tries=3'
+    assert render_link('https://weibo.com/u/1', 1) == 'https://weibo.com/u/1'
+    assert render_link('https://weibo.com/u/1&a=1', 2) == \
+        'https://weibo.com/u/1&a=1&_tries=2'
+    assert strip_link(link) == 'HTTPS://Weibo.com/p/aj?b=2&a=1&__rnd=123#top'
+    assert strip_link('https://weibo.com/u/1&uuid=ff') == 'https://weibo.com/u/1'
+    assert strip_link('https://weibo.com/p/aj?uuid=ff') == 'https://weibo.com/p/aj'
+
+
+def test_submit_links_dedup(tmpdir):
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    handler.init()
+    link = 'https://weibo.com/p/aj?a=1'
+    assert handler.submit_links([link, link + '&uuid=1']) == RetStatus.SUCCESS
+    assert handler.grab_links(5) == [link]
+    handler.submit_links([link, link + '&__rnd=2'])
+    assert handler.grab_links(5) == []
+    handler.submit_links([link + '&uuid=2'])
+    assert handler.grab_links(5) == [link]
+    handler.submit_links([link + '&_tries=2'])
+    assert handler.grab_links(5) == [link + '&_tries=2']
+    # Links are handed out as submitted, not in their canonical form.
+    handler.submit_links(['https://weibo.com/p/aj?c=3&b=2&uuid=3'])
+    assert handler.grab_links(5) == ['https://weibo.com/p/aj?c=3&b=2']
+    handler.close()
+
+
+def test_dead_links_filter_metrics(tmpdir):
+    handler = SchedulerServiceHandler()
+    handler._db_dir = str(tmpdir)
+    handler.init()
+    before = dict(sinaspider.scheduler._DEAD_LINK_LOOKUPS.series)
+    size = sinaspider.scheduler._DEAD_LINKS_FILTER_SIZE.series[()]
+    link = 'https://weibo.com/p/aj?a=1'
+    handler.submit_links([link])
+    handler.grab_links(5)
+    handler.submit_links([link, link + '&b=2'])
+    lookups = sinaspider.scheduler._DEAD_LINK_LOOKUPS.series
+    assert lookups[('negative',)] - before.get(('negative',), 0) == 2
+    assert lookups[('positive',)] - before.get(('positive',), 0) == 1
+    assert sinaspider.scheduler._DEAD_LINKS_FILTER_SIZE.series[()] == size + 1
+    assert 0 < sinaspider.scheduler._DEAD_LINKS_FILTER_ERROR_RATE.series[()] < 1
+    handler.close()
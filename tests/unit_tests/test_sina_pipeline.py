@@ -1,9 +1,17 @@
 
 from os.path import join, abspath, dirname, isdir
+import json
 import os
+import pickle
+import plyvel
 import requests
+import struct
 
+from sinaspider.downloader import FetchedPage
 from sinaspider.sina_pipeline import *
+from sinaspider.sina_pipeline import (_TRENDING_TWEETS_LINK, _TWEET_LONGTEXT_LINK,
+                                      _USER_TWEETS_LINKS, _TOPIC_LINK,
+                                      _TOPIC_PAGE_LINK)
 import sinaspider.sina_login
 import sinaspider.services.ttypes
 
@@ -50,7 +58,190 @@ class SinaPipelineDummy(Pipeline):
         router.forward(puinfo)
         router.forward(puweibo)
 
+
+def test_router_offline():
+    router = Router()
+    pages = {
+        'https://d.weibo.com/p/aj/v6/mblog/mbloglist?ajwvr=6': SinaResponseType.TRENDING_WEIBO,
+        'https://weibo.com/p/1005052840177141/info?mod=pedit_more': SinaResponseType.USER_INFO,
+        'https://weibo.com/aj/v6/mblog/info/big?ajwvr=6&id=1&page=2': SinaResponseType.REPOST_LIST,
+        'https://weibo.com/u/2840177141': SinaResponseType.USER_HOME,
+    }
+    for url, res_type in pages.items():
+        page = FetchedPage(url, url, 200, 'text/html', 'utf-8', b'')
+        response, = router.run(None, page)
+        assert response.type == res_type
+        assert response.page is page
+
+def test_classify_link():
+    assert classify_link(_TRENDING_TWEETS_LINK) == SinaResponseType.TRENDING_WEIBO
+    assert classify_link(_TWEET_LONGTEXT_LINK % (1, 2)) == \
+        SinaResponseType.LONG_TEXT_WEIBO
+    assert classify_link(_USER_TWEETS_LINKS['mid_page'] % (
+        (1,) * _USER_TWEETS_LINKS['mid_page'].count('%s'))) == \
+        SinaResponseType.USER_WEIBO
+    assert classify_link(_TOPIC_LINK % '100808abc') == \
+        SinaResponseType.TRENDING_TOPIC
+    assert classify_link(_TOPIC_PAGE_LINK % 1) == \
+        SinaResponseType.TRENDING_TOPIC_PAGE
+    assert classify_link('https://weibo.com/sorry?sysbusy') == \
+        SinaResponseType.UNDEFINED
+    assert classify_link('http://0') == SinaResponseType.UNDEFINED
+
+def test_decode_response_text():
+    page = FetchedPage('https://d.weibo.com/', 'https://d.weibo.com/', 200,
+                       'application/json', 'utf-8', b'{"code": "100000"}')
+    assert decode_response_text(page) == {'code': '100000'}
+    page.content_type = 'text/html'
+    page.body = '<div>\\r\\n&nbsp;微博</div>'.encode()
+    assert decode_response_text(page) == '<div>微博</div>'
+    page.content_type = None
+    assert decode_response_text(page) is None
+
     
+def test_leveldb_writer_batch(tmpdir):
+    writer = LevelDBWriter()
+    writer.db_dir = str(tmpdir)
+    tweets = []
+    for tid in range(3):
+        tweet = SinaTweet()
+        tweet.tid = tid
+        tweets.append(tweet)
+    user = SinaUser()
+    user.uid = 7
+    writer.begin_batch()
+    writer.run(None, tweets[:2], [user])
+    writer.run(None, tweets[2:])
+    assert not os.path.exists(join(str(tmpdir), 'tweets.db'))
+    writer.end_batch()
+    assert writer.pending == {}
+    db = plyvel.DB(join(str(tmpdir), 'tweets.db'))
+    assert [deserialize(value).tid for _, value in db] == [0, 1, 2]
+    db.close()
+    db = plyvel.DB(join(str(tmpdir), 'users.db'))
+    assert deserialize(db.get(user.record()[0])).uid == 7
+    db.close()
+    # Written at once outside of a batch.
+    writer.run(None, [SinaFlow()])
+    assert os.path.exists(join(str(tmpdir), 'flows.db'))
+
+def test_record_codecs():
+    tweet = SinaTweet()
+    tweet.tid = 4215871378431270
+    tweet.uid = 1642634100
+    tweet.content = '微博 content'
+    tweet.num_loves = 3
+    key, value = tweet.record()
+    assert key == struct.pack('>Q', tweet.tid)
+    assert deserialize(value).as_dict() == tweet.as_dict()
+    # Keys of integer ids scan in numeric order.
+    keys = []
+    for tid in (256, 1, 65536):
+        tweet.tid = tid
+        keys.append(tweet.record()[0])
+    assert sorted(keys) == [keys[1], keys[0], keys[2]]
+
+    user = SinaUser()
+    user.uid = 7
+    user.others = {'博客': 'http://blog.sina.com.cn'}
+    assert deserialize(user.serialize()).as_dict() == user.as_dict()
+
+    reads = SinaTopicReads()
+    reads.tid = '100808abc'
+    reads.timestamp = 1528000000
+    reads.num_reads = 10000
+    key, value = reads.record()
+    assert key.startswith(b'reads')
+    assert deserialize(value).as_dict() == reads.as_dict()
+
+    flows = []
+    for a, b in ((1, 'nick'), ('nick', 2)):
+        flow = SinaFlow()
+        flow.a, flow.b = a, b
+        flows.append(flow)
+        assert deserialize(flow.serialize()).as_dict() == flow.as_dict()
+    assert flows[0].record()[0] != flows[1].record()[0]
+    # Flows of reposts are tagged by the id of the original tweet.
+    flows[0].tag = 4215800000000000
+    assert deserialize(flows[0].serialize()).as_dict() == flows[0].as_dict()
+
+def test_strip_text_wight_blank():
+    text = '<div class=\\"WB\\">a\\r\\n\\tb\r&nbsp;<\\/div>\n\t'
+    assert strip_text_wight_blank(text) == '<div class="WB">ab</div>\n\t'
+
+def test_decode_response_cleaned_once():
+    page = FetchedPage('https://weibo.com/u/1', 'https://weibo.com/u/1', 200,
+                       'text/html', 'utf-8', b'<a href=\\"x\\">&nbsp;</a>')
+    assert not page.cleaned
+    text = decode_response_text(page)
+    assert text == '<a href="x"></a>'
+    assert page.cleaned
+    page.body = b'changed'
+    assert decode_response_text(page) is text
+
+def test_seed_links_and_content_digest():
+    links, topic_links = seed_links(3)
+    assert len(links) == 41 and links[0] == _TRENDING_TWEETS_LINK
+    assert len(topic_links) == 3
+    assert content_digest([2, 1, 1]) == content_digest(['1', '2'])
+    assert content_digest([1, 2]) != content_digest([1, 3])
+
+def test_slotted_entities():
+    tweet = SinaTweet()
+    assert not hasattr(tweet, '__dict__')
+    tweet.tid = 1
+    tweet.content = 'content'
+    assert pickle.loads(pickle.dumps(tweet)).as_dict() == tweet.as_dict()
+    assert json.loads(tweet.json())['content'] == 'content'
+    # Entities pickled as plain objects are still readable.
+    legacy = SinaTweet.__new__(SinaTweet)
+    legacy.__setstate__({'tid': 2, 'content': 'old', 'removed': 0})
+    assert (legacy.tid, legacy.content, legacy.num_loves) == (2, 'old', 0)
+
+_USER_INFO_PAGE = (
+    '<html><head><meta name="description" content="A &amp; B">'
+    '<script type="text/javascript">var $CONFIG = {};'
+    "$CONFIG['oid']='1642634100';$CONFIG['page_id']='1005051642634100';"
+    "$CONFIG['onick']='新浪科技';</script></head><body>"
+    '<script>FM.view({"ns":"pl.content.homeFeed.index",'
+    '"domid":"Pl_Core_T8CustomTriColumn__3","css":[],"html":"'
+    '<div class="PCD_counter"><table><tr>'
+    '<td class="S_line1"><strong>120</strong><span>关注</span></td>'
+    '<td class="S_line1"><strong>3000</strong><span>粉丝</span></td>'
+    '<td class="S_line1"><strong>45</strong><span>微博</span></td>'
+    '</tr></table></div>"})</script>'
+    '<script>FM.view({"ns":"pl.content.homeFeed.index",'
+    '"domid":"Pl_Official_PersonalInfo__58","css":[],"html":"'
+    '<div class="WB_cardwrap"><ul>'
+    '<li class="li_1"><span class="pt_title">所在地：</span>'
+    '<span class="pt_detail">北京 海淀区</span></li>'
+    '<li class="li_1"><span class="pt_title">注册时间：</span>'
+    '<span class="pt_detail">2010-01-01</span></li>'
+    '</ul></div>"})</script>'
+    '</body></html>')
+
+def test_page_scripts():
+    scripts = PageScripts(_USER_INFO_PAGE)
+    assert scripts.config['page_id'] == '1005051642634100'
+    assert scripts.meta['description'] == 'A & B'
+    assert set(scripts.views) == {'Pl_Core_T8CustomTriColumn__3',
+                                  'Pl_Official_PersonalInfo__58'}
+    assert scripts.view('Pl_Core_T8CustomTriColumn__') == \
+        'Pl_Core_T8CustomTriColumn__3'
+    assert scripts.soup('Pl_Missing__') is None
+    # Parsed once.
+    assert scripts.soup('Pl_Official_PersonalInfo__') is \
+        scripts.soup('Pl_Official_PersonalInfo__58')
+    assert user_home_config_parser(scripts) == ('1005051642634100',
+                                                '1642634100')
+    user = SinaUser()
+    user_info_html_parser(scripts, user)
+    assert (user.uid, user.nick_name) == (1642634100, '新浪科技')
+    assert (user.num_followees, user.num_fans, user.num_tweets) == \
+        (120, 3000, 45)
+    assert user.location == '北京 海淀区'
+    assert user.others == {'注册时间：': '2010-01-01'}
+
 class TestSpiderPipeline:
     pipeline = None
     session = None
@@ -71,7 +262,7 @@ class TestSpiderPipeline:
                 'https://weibo.com/aj/v6/mblog/info/big?ajwvr=6&id=4185163515138322&max_id=4185211120618742&page=2&__rnd=1513315560511']
         for link in links:
             res = self.session.get(link)
-            self.pipeline.start(res)
+            self.pipeline.start(FetchedPage.from_response(link, res))
 
     def test_trending_weibo_processor(self):
         pass
@@ -0,0 +1,48 @@
+from os.path import join
+import plyvel
+import time
+
+from sinaspider.store import StorageWriter
+
+
+def test_storage_writer(tmpdir):
+    writer = StorageWriter(str(tmpdir))
+    writer.start()
+    writer.put({'tweets.db': [(b'1', b'a'), (b'2', b'b')],
+                'users.db': [(b'3', b'c')]})
+    writer.put({'tweets.db': [(b'4', b'd')]})
+    writer.stop()
+    assert not writer.process.is_alive()
+    db = plyvel.DB(join(str(tmpdir), 'tweets.db'))
+    assert list(db) == [(b'1', b'a'), (b'2', b'b'), (b'4', b'd')]
+    db.close()
+    db = plyvel.DB(join(str(tmpdir), 'users.db'))
+    assert db.get(b'3') == b'c'
+    db.close()
+
+
+def test_storage_writer_group_commit(tmpdir):
+    writer = StorageWriter(str(tmpdir), flush_interval=60, flush_size=3)
+    writer.start()
+    for idx in range(7):
+        writer.put({'tweets.db': [(b'%d' % idx, b'')]})
+    writer.stop()
+    metrics = writer.metrics()
+    # Two full batches, then the rest on stop.
+    assert metrics['flushes'] == 3
+    assert metrics['records'] == 7
+    assert metrics['batch_size'] == 7 / 3
+    db = plyvel.DB(join(str(tmpdir), 'tweets.db'))
+    assert len(list(db)) == 7
+    db.close()
+
+
+def test_storage_writer_flush_interval(tmpdir):
+    writer = StorageWriter(str(tmpdir), flush_interval=0.05, flush_size=100,
+                           sync=True)
+    writer.start()
+    writer.put({'tweets.db': [(b'1', b'')]})
+    time.sleep(0.5)
+    assert writer.metrics()['flushes'] == 1
+    writer.stop()
+    assert writer.metrics()['flushes'] == 1
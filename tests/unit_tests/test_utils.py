@@ -0,0 +1,28 @@
+from sinaspider.utils import BloomFilter
+
+
+class TestBloomFilter:
+    def test_membership(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = [('http://%s' % i).encode() for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            assert key in bloom
+        false_positives = sum(1 for i in range(1000, 11000)
+                              if ('http://%s' % i).encode() in bloom)
+        assert false_positives < 300
+        assert len(bloom) == 1000
+        assert 0 < bloom.error_rate() < 0.05
+
+    def test_snapshot(self, tmpdir):
+        path = str(tmpdir.join('bloom'))
+        bloom = BloomFilter(100, 0.01)
+        bloom.add(b'http://1')
+        bloom.dump(path)
+        _bloom = BloomFilter(100, 0.01)
+        assert _bloom.load(path)
+        assert b'http://1' in _bloom
+        assert len(_bloom) == 1
+        assert not BloomFilter(200, 0.01).load(path)
+        assert not BloomFilter(100, 0.01).load(str(tmpdir.join('missing')))